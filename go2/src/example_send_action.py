@@ -11,6 +11,8 @@ The usage of this file:
 1. Create an instance of ActionPostprocessor.
 2. Call the run() method to start the postprocessing thread.
 """
+import ast
+import json
 import logging
 import threading
 
@@ -20,15 +22,19 @@ import threading
 
 import logging
 import time
-from collections import deque
-from dataclasses import dataclass
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 
 # from actions import RemixAction
-from typing import Union, Tuple
+from typing import Callable, Optional, Union
+
+import numpy as np
 
 # import config as velocity_profile_config
 
 # logger = get_logger()
+logger = logging.getLogger(__name__)
 
 # set_log_level(logging.DEBUG)
 
@@ -47,19 +53,159 @@ WINDOW_HEIGHT = 1440
 TRAFFIC_LIGHT_POS = (WINDOW_WIDTH - 150, 50)
 TEXT_OFFSET = 100
 
-HEARTBEAT_TIMEOUT = 0.5  # seconds
+HEARTBEAT_TIMEOUT = 0.5  # seconds. Without a new action for this long, the robot is stopped.
+
+CONTROL_RATE_HZ = 50.0
+
+SIMULATED_WAIT_POLL = 0.001  # real seconds. How often a thread waiting on a SimulatedClock checks its event.
+
+# Tick modes of ActionPostprocessor.run: only on the fixed-rate schedule, or also as soon as an action arrives.
+TICK_PERIODIC = "periodic"
+TICK_HYBRID = "hybrid"
+MIN_TICK_INTERVAL = 0.005  # seconds. Action-triggered ticks are at least this far apart.
+ACTION_LATENCY_SAMPLES = 1000
+
+STATE_POLL_RATE_HZ = 10.0
+STATE_MAX_AGE = 0.5  # seconds. A cached robot state older than this is treated as unknown.
+STATE_CODE_STALE = -1
+
+COMMAND_KEEPALIVE_INTERVAL = 0.5  # seconds. Identical commands are re-sent at most this often. None to never re-send.
+COMMAND_MAX_IN_FLIGHT = 3
+CODE_SUPERSEDED = -2  # Reported to the callback of a queued command replaced before it was sent. Not an SDK code.
+
+ESTOP_MAX_ATTEMPTS = 3  # Damp() is retried right away if the robot does not acknowledge it.
+
+# Command channels. A new command on a channel supersedes the previous one on the same channel.
+CHANNEL_VELOCITY = "velocity"  # Move / StopMove
+CHANNEL_EULER = "euler"
+CHANNEL_BODY_HEIGHT = "body_height"
+CHANNEL_MODE = "mode"  # SwitchGait / BalanceStand
+
+STATE_KEYS = [
+    "state", "bodyHeight", "footRaiseHeight", "speedLevel",
+    "gait", "joystick", "dance", "continuousGait", "economicGait"
+]
 
 VELOCITY_TOPIC = '/gogogo/velocity'
 
+# Bits of WirelessController_.keys, from bit 0 up.
+KEY_NAMES = ("R1", "L1", "start", "select", "R2", "L2", "F1", "F2", "A", "B", "X", "Y", "up", "right", "down", "left")
+KEY = {name: 1 << bit for bit, name in enumerate(KEY_NAMES)}
+KEY_L2_B = KEY["L2"] | KEY["B"]
+KEY_L2_A = KEY["L2"] | KEY["A"]
+NUM_KEY_MASKS = 1 << len(KEY_NAMES)
+
+# Chord kinds, see ChordEngine.
+CHORD_PRESS = "press"
+CHORD_HOLD = "hold"
+CHORD_DOUBLE_TAP = "double_tap"
+
+
+def key_names(mask):
+    """
+    Names of the keys set in a WirelessController_.keys mask. Only meant for logging.
+    """
+    return [name for name in KEY_NAMES if mask & KEY[name]]
+
+
+def chord_mask(keys):
+    """
+    Key mask of a chord given as a mask, a "+"-separated string ("L2+B") or a sequence of key names.
+    """
+    if isinstance(keys, int):
+        return keys
+    if isinstance(keys, str):
+        keys = keys.split("+")
+    mask = 0
+    for name in keys:
+        mask |= KEY[name.strip()]
+    return mask
+
+
+class Clock(ABC):
+    """
+    Time source of the postprocessing pipeline. All timestamps in this file come from a Clock, and every timed wait
+    goes through sleep() or wait(), so the pipeline can be driven by simulated time in tests and benchmarks.
+    """
+
+    @abstractmethod
+    def now(self) -> float:
+        pass
+
+    @abstractmethod
+    def sleep(self, seconds):
+        pass
+
+    @abstractmethod
+    def wait(self, event, timeout):
+        """
+        Wait for a threading.Event for at most timeout seconds (forever if None) and return whether it is set.
+        """
+        pass
 
-@dataclass
-class StepAction:
-    action: Union[int, Tuple[float, float]]
-    time: float
 
-    def __repr__(self):
-        return "StepAction(action={}, time={:.2f})".format(RemixAction.get_string(self.action),
-                                                           -(time.time() - self.time))
+class MonotonicClock(Clock):
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(None if timeout is None else max(timeout, 0.0))
+
+
+class SimulatedClock(Clock):
+    """
+    Clock that only moves when told to.
+
+    The thread that creates the clock drives it: its sleep() and wait() advance the simulated time and return
+    immediately, so a loop driven by it (e.g. ActionPostprocessor.run) executes as fast as the CPU allows. In any other
+    thread (RobotStatePoller, HeartbeatWatchdog, ...), sleep() and wait() block until the driver has moved the time
+    past their deadline, so background loops follow the simulated time instead of advancing it themselves.
+    """
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.driver = threading.current_thread()
+        self.cond = threading.Condition()
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        if threading.current_thread() is self.driver:
+            self.advance(seconds)
+            return
+        with self.cond:
+            deadline = self.time + seconds
+            while self.time < deadline:
+                self.cond.wait()
+
+    def wait(self, event, timeout):
+        if threading.current_thread() is self.driver:
+            if timeout is None:
+                return event.wait()
+            # Nothing else moves the time while we wait: either the event is already set, or it times out.
+            if not event.is_set():
+                self.advance(timeout)
+            return event.is_set()
+        with self.cond:
+            deadline = None if timeout is None else self.time + timeout
+            while not event.is_set() and (deadline is None or self.time < deadline):
+                # Setting the event does not notify self.cond, so check it again every SIMULATED_WAIT_POLL seconds.
+                self.cond.wait(SIMULATED_WAIT_POLL)
+            return event.is_set()
+
+    def advance(self, seconds):
+        if seconds > 0:
+            with self.cond:
+                self.time += seconds
+                self.cond.notify_all()
+
+
+DEFAULT_CLOCK = MonotonicClock()
 
 
 @dataclass
@@ -74,6 +220,16 @@ class Velocity:
         return "Velocity(vx={:.2f}, vy={:.2f}, vyaw={:.2f}, stop={})".format(self.vx, self.vy, self.vyaw, self.stop)
 
 
+@dataclass
+class VelocityTrajectory:
+    # Arrays of shape (..., T), as returned by VelocityProfile.rollout().
+    vx: np.ndarray
+    vy: np.ndarray
+    vyaw: np.ndarray
+    stop: np.ndarray
+    time: np.ndarray
+
+
 @dataclass
 class VelocityProfile:
     # Unit: m/(s^2)
@@ -106,14 +262,19 @@ class VelocityProfile:
 
     should_run = None
 
-    last_update_time: float = time.time()
+    last_update_time: Optional[float] = None  # Defaults to clock.now() at construction.
+    clock: Clock = field(default=DEFAULT_CLOCK, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.last_update_time is None:
+            self.last_update_time = self.clock.now()
 
     def update(self, dvx=None, dvy=None, dvyaw=None, vx=None, vy=None, vyaw=None, stop=False):
 
         # TODO: vy increase rate is not defined / used.
         assert dvy is None
 
-        dt = time.time() - self.last_update_time
+        dt = self.clock.now() - self.last_update_time
 
         if dt > 0.2:
             # Something wrong, just stop.
@@ -188,72 +349,985 @@ class VelocityProfile:
 
         stop = stop or (self.vx == 0.0 and self.vy == 0.0 and self.vyaw == 0.0)
 
-        self.last_update_time = time.time()
+        self.last_update_time = self.clock.now()
         ret = Velocity(self.vx, self.vy, self.vyaw, stop, time=self.last_update_time)
         logger.debug("[VelocityProfile.update] Velocity is updated to: {}".format(ret))
         return ret
 
+    def rollout(self, times, dvx=None, dvyaw=None, vx=None, vy=None, vyaw=None, stop=None, start_time=None):
+        """
+        Vectorized equivalent of calling update() once per timestamp, for offline replay and simulation.
+
+        times has shape (..., T), e.g. (num_episodes, T). The commands broadcast against it and use NaN where update()
+        would get None (and False for stop). The deadzone, decay, clamp and dt > 0.2 semantics are the same as
+        update(). Episodes start from the current vx / vy / vyaw, and dt of the first step is measured from start_time
+        (defaults to times[..., 0], i.e. dt = 0). The profile itself is not modified.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        shape = times.shape
+
+        def command(value):
+            if value is None:
+                return np.full(shape, np.nan)
+            return np.broadcast_to(np.asarray(value, dtype=np.float64), shape)
+
+        dvx, dvyaw, vx, vy, vyaw = command(dvx), command(dvyaw), command(vx), command(vy), command(vyaw)
+        stop = np.zeros(shape, dtype=bool) if stop is None else np.broadcast_to(np.asarray(stop, dtype=bool), shape)
+        start_time = times[..., :1] if start_time is None else np.asarray(start_time, dtype=np.float64)[..., None]
+        dt = np.diff(times, axis=-1, prepend=start_time)
+        stop = stop | (dt > 0.2)
+        no_command = np.full(shape, np.nan)
+
+        out_vx, out_vy, out_vyaw = np.empty(shape), np.empty(shape), np.empty(shape)
+        cur_vx = np.full(shape[:-1], self.vx, dtype=np.float64)
+        cur_vy = np.full(shape[:-1], self.vy, dtype=np.float64)
+        cur_vyaw = np.full(shape[:-1], self.vyaw, dtype=np.float64)
+        for t in range(shape[-1]):
+            step_dt, step_stop = dt[..., t], stop[..., t]
+            cur_vx = self._rollout_axis(cur_vx, step_dt, step_stop, dvx[..., t], vx[..., t], self.deadzone_vx,
+                                        self.vx_decrease_rate_positive, self.vx_decrease_rate_negative,
+                                        self.vx_min, self.vx_max)
+            cur_vy = self._rollout_axis(cur_vy, step_dt, step_stop, no_command[..., t], vy[..., t], self.deadzone_vy,
+                                        self.vy_decrease_rate, self.vy_decrease_rate, self.vy_min, self.vy_max)
+            cur_vyaw = self._rollout_axis(cur_vyaw, step_dt, step_stop, dvyaw[..., t], vyaw[..., t],
+                                          self.deadzone_vyaw, self.vyaw_decrease_rate, self.vyaw_decrease_rate,
+                                          self.vyaw_min, self.vyaw_max)
+            out_vx[..., t], out_vy[..., t], out_vyaw[..., t] = cur_vx, cur_vy, cur_vyaw
+
+        out_stop = stop | ((out_vx == 0.0) & (out_vy == 0.0) & (out_vyaw == 0.0))
+        return VelocityTrajectory(vx=out_vx, vy=out_vy, vyaw=out_vyaw, stop=out_stop, time=times)
+
+    @staticmethod
+    def _rollout_axis(v, dt, stop, dv, target, deadzone, decrease_rate_positive, decrease_rate_negative, v_min, v_max):
+        # One update() step of a single axis, for all episodes at once.
+        has_dv = ~np.isnan(dv)
+        has_target = ~np.isnan(target)
+        v = np.where(stop, 0.0, v)
+        v = np.where(~stop & has_dv, v + np.nan_to_num(dv) * dt, v)
+        v = np.where(~stop & has_target, np.nan_to_num(target), v)
+
+        # Reduce the value as time goes by.
+        decay = ~has_dv & ~has_target
+        v = np.where(
+            decay,
+            np.where(v > deadzone, np.maximum(v - decrease_rate_positive * dt, 0.0),
+                     np.where(v < -deadzone, np.minimum(v + decrease_rate_negative * dt, 0.0), 0.0)),
+            v
+        )
+        return np.clip(v, v_min, v_max)
+
+
+@dataclass
+class SchedulerStats:
+    ticks: int = 0
+    overruns: int = 0  # Number of times a tick started after its deadline had already passed.
+    skipped_ticks: int = 0  # Deadlines dropped by the overrun policy.
+    woken: int = 0  # Ticks started early by the wake event (not counted in the jitter).
+    last_jitter: float = 0.0  # Lateness of the last tick w.r.t. its deadline, in seconds.
+    max_jitter: float = 0.0
+    total_jitter: float = 0.0
+
+    @property
+    def mean_jitter(self):
+        # Over the ticks that had a deadline: woken ticks add no jitter.
+        periodic_ticks = self.ticks - self.woken
+        return self.total_jitter / periodic_ticks if periodic_ticks else 0.0
+
+    def __repr__(self):
+        return "SchedulerStats(ticks={}, overruns={}, skipped_ticks={}, woken={}, mean_jitter={:.2f}ms, " \
+               "max_jitter={:.2f}ms)".format(self.ticks, self.overruns, self.skipped_ticks, self.woken,
+                                             self.mean_jitter * 1e3, self.max_jitter * 1e3)
+
+
+class FixedRateScheduler:
+    """
+    Deadline-driven fixed-rate timer. The n-th tick is due at start + n * period on a monotonic clock, so the time
+    spent inside a tick does not accumulate into the loop period.
+
+    When a tick overruns, the missed deadlines are handled according to the overrun policy:
+
+    - "catch_up": run the missed ticks back-to-back (at most max_catch_up of them) until the schedule is met again.
+    - "skip": drop the missed ticks and re-align to the next deadline.
+
+    wait() can also be given a wake event, which starts a tick early (see wait).
+    """
+    CATCH_UP = "catch_up"
+    SKIP = "skip"
+
+    def __init__(self, rate_hz=CONTROL_RATE_HZ, overrun_policy=SKIP, max_catch_up=5, clock=DEFAULT_CLOCK):
+        assert rate_hz > 0
+        assert overrun_policy in (self.CATCH_UP, self.SKIP), overrun_policy
+        self.clock = clock
+        self.period = 1.0 / rate_hz
+        self.overrun_policy = overrun_policy
+        self.max_catch_up = max_catch_up
+        self.stats = SchedulerStats()
+        self.next_deadline = None
+        self.last_tick = None
+
+    def reset(self):
+        self.next_deadline = None
+        self.last_tick = None
+
+    def wait(self, wake=None, min_interval=0.0):
+        """
+        Block until the next deadline and return it.
+
+        With a wake event (threading.Event), also return as soon as the event is set, but not earlier than min_interval
+        after the previous tick, and clear it. An early tick restarts the schedule from itself, so the periodic ticks
+        become a fallback that runs at most one period after the last tick.
+        """
+        now = self.clock.now()
+        if self.next_deadline is None:
+            self.next_deadline = now + self.period
+
+        deadline = self.next_deadline
+        timed_out = False
+        if wake is not None and now < deadline:
+            earliest = now if self.last_tick is None else self.last_tick + min_interval
+            if now < earliest:
+                self.clock.sleep(min(earliest, deadline) - now)
+                now = self.clock.now()
+            if now < deadline and self.clock.wait(wake, deadline - now):
+                wake.clear()
+                now = self.clock.now()
+                self.stats.ticks += 1
+                self.stats.woken += 1
+                self.last_tick = now
+                self.next_deadline = now + self.period
+                return now
+            now = self.clock.now()
+            timed_out = True  # Reaching the deadline while waiting for the event is not an overrun.
+        if wake is not None:
+            wake.clear()  # This tick handles whatever set it.
+
+        if now < deadline:
+            self.clock.sleep(deadline - now)
+            now = self.clock.now()
+        elif now > deadline and (not timed_out or now - deadline >= self.period):
+            # We are already late for this deadline: the previous tick overran its slot. A tick that lands exactly on
+            # its deadline is on time.
+            self.stats.overruns += 1
+            missed = int((now - deadline) // self.period)
+            if self.overrun_policy == self.SKIP:
+                skipped = missed
+            else:
+                skipped = max(0, missed - self.max_catch_up)
+            if skipped:
+                deadline += skipped * self.period
+                self.stats.skipped_ticks += skipped
+                logger.debug("[FixedRateScheduler.wait] Tick overrun, skipped {} deadlines.".format(skipped))
+
+        jitter = now - deadline
+        self.stats.ticks += 1
+        self.stats.last_jitter = jitter
+        self.stats.max_jitter = max(self.stats.max_jitter, jitter)
+        self.stats.total_jitter += jitter
+
+        self.last_tick = now
+        self.next_deadline = deadline + self.period
+        return deadline
+
+
+@dataclass(frozen=True)
+class RobotState:
+    state: Optional[str] = None
+    bodyHeight: Optional[float] = None
+    footRaiseHeight: Optional[float] = None
+    speedLevel: Optional[int] = None
+    gait: Optional[Union[int, str]] = None
+    joystick: Optional[str] = None
+    dance: Optional[str] = None
+    continuousGait: Optional[str] = None
+    economicGait: Optional[str] = None
+
+    @classmethod
+    def from_map(cls, state_map):
+        body_height = state_map.get("bodyHeight")
+        foot_raise_height = state_map.get("footRaiseHeight")
+        speed_level = state_map.get("speedLevel")
+        return cls(
+            state=state_map.get("state"),
+            bodyHeight=None if body_height is None else float(body_height),
+            footRaiseHeight=None if foot_raise_height is None else float(foot_raise_height),
+            speedLevel=None if speed_level is None else int(speed_level),
+            gait=state_map.get("gait"),
+            joystick=state_map.get("joystick"),
+            dance=state_map.get("dance"),
+            continuousGait=state_map.get("continuousGait"),
+            economicGait=state_map.get("economicGait"),
+        )
+
+
+def parse_state_value(raw):
+    """
+    Parse one GetState value, e.g. '{"data": 0.0}', and return its "data" field.
+    """
+    try:
+        return json.loads(raw)["data"]
+    except ValueError:
+        # Not strict JSON (e.g. single quotes). Still never eval() what comes from the network.
+        return ast.literal_eval(raw)["data"]
+
+
+class RobotStateDecoder:
+    """
+    Decodes GetState replies into a state map and a typed RobotState. The hash of each raw payload is remembered per
+    key, so a value is only parsed again when its payload changed since the last poll.
+    """
+
+    def __init__(self):
+        self.raw_hashes = {}
+        self.state_map = {}
+        self.state = RobotState()
+
+        self.num_decoded = 0
+        self.num_skipped = 0
+
+    def decode(self, raw_map):
+        """
+        Update the decoded state from a raw GetState reply. Return True if any value changed.
+        """
+        changed = False
+        for key, raw in raw_map.items():
+            raw_hash = hash(raw)
+            if self.raw_hashes.get(key) == raw_hash:
+                self.num_skipped += 1
+                continue
+            value = parse_state_value(raw)
+            self.num_decoded += 1
+            self.raw_hashes[key] = raw_hash
+            if not changed:
+                # Copy on write: published state maps are shared with readers and never mutated.
+                self.state_map = dict(self.state_map)
+                changed = True
+            self.state_map[key] = value
+
+        if changed:
+            self.state = RobotState.from_map(self.state_map)
+        return changed
+
+
+@dataclass(frozen=True)
+class RobotStateSnapshot:
+    code: int
+    state_map: dict  # Shared between threads, treat it as read-only.
+    state: RobotState
+    time: float  # clock.now() when the reply was received.
+
+
+class RobotStatePoller(threading.Thread):
+    """
+    Polls SportClient.GetState in a background thread at its own rate. Each successful reply is published as an
+    immutable RobotStateSnapshot with a single reference assignment, so the control tick reads the latest state without
+    taking a lock and never waits for a state RPC.
+    """
+
+    def __init__(self, client, rate_hz=STATE_POLL_RATE_HZ, state_keys=STATE_KEYS, clock=DEFAULT_CLOCK):
+        super().__init__(name="RobotStatePoller", daemon=True)
+        self.client = client
+        self.state_keys = list(state_keys)
+        self.clock = clock
+        self.scheduler = FixedRateScheduler(rate_hz=rate_hz, overrun_policy=FixedRateScheduler.SKIP, clock=clock)
+        self.stop_event = threading.Event()
+        self.decoder = RobotStateDecoder()
+
+        self.snapshot = None
+        self.last_code = STATE_CODE_STALE
+        self.num_polls = 0
+        self.num_failures = 0
+
+    def poll(self):
+        code, state_map = self.client.GetState(self.state_keys)
+        self.num_polls += 1
+        self.last_code = code
+        if code != 0 or state_map is None:
+            self.num_failures += 1
+            return
+
+        self.decoder.decode(state_map)
+        self.snapshot = RobotStateSnapshot(
+            code=code, state_map=self.decoder.state_map, state=self.decoder.state, time=self.clock.now()
+        )
+
+    def get(self, max_age=STATE_MAX_AGE) -> Optional[RobotStateSnapshot]:
+        """
+        Return the latest snapshot, or None if there is none younger than max_age seconds.
+        """
+        snapshot = self.snapshot
+        if snapshot is None or self.clock.now() - snapshot.time > max_age:
+            return None
+        return snapshot
+
+    def run(self):
+        self.scheduler.reset()
+        while not self.stop_event.is_set():
+            self.scheduler.wait()
+            try:
+                self.poll()
+            except Exception as e:
+                self.num_failures += 1
+                logger.warning("[RobotStatePoller] Failed to get robot state: {}".format(e))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+@dataclass
+class PendingCommand:
+    request_id: int
+    channel: str
+    method: str
+    args: tuple
+    callback: Optional[Callable] = None  # callback(command, code)
+    submit_time: float = 0.0
+
+    def __repr__(self):
+        return "{}{} #{}".format(self.method, self.args, self.request_id)
+
+
+@dataclass
+class DispatcherStats:
+    submitted: int = 0
+    superseded: int = 0  # Queued commands replaced by a newer command on the same channel before being sent.
+    preempted: int = 0  # Queued commands dropped by block().
+    rejected: int = 0  # Commands submitted while blocked.
+    completed: int = 0
+    failed: int = 0
+    max_in_flight: int = 0
+
+    def __repr__(self):
+        return "DispatcherStats(submitted={}, superseded={}, preempted={}, rejected={}, completed={}, failed={}, " \
+               "max_in_flight={})".format(self.submitted, self.superseded, self.preempted, self.rejected,
+                                          self.completed, self.failed, self.max_in_flight)
+
+
+class CommandDispatcher:
+    """
+    Sends SportClient commands from a pool of worker threads, so the control thread never waits for a reply.
+
+    At most one command per channel is in flight, which keeps the commands of a channel in order, and a queued command
+    is replaced by a newer one on the same channel (only the latest velocity matters). Up to max_in_flight channels
+    are served at the same time, so e.g. a slow SwitchGait does not hold back the next Move. Every reply is matched to
+    its PendingCommand and reported through the command callback; failures (non-zero code, or an exception in the SDK)
+    additionally go to on_error. A superseded command is reported to its callback with CODE_SUPERSEDED, from submit().
+    """
+
+    def __init__(self, client, max_in_flight=COMMAND_MAX_IN_FLIGHT, on_error=None, clock=DEFAULT_CLOCK):
+        assert max_in_flight >= 1
+        self.client = client
+        self.clock = clock
+        self.max_in_flight = max_in_flight
+        self.on_error = on_error
+        self.stats = DispatcherStats()
+
+        self.cond = threading.Condition()
+        self.queued = OrderedDict()  # channel -> PendingCommand
+        self.in_flight = {}  # request_id -> PendingCommand
+        self.busy_channels = set()
+        self.next_request_id = 0
+        self.stopped = False
+        self.blocked = False
+        self.workers = [
+            threading.Thread(target=self.worker, name="CommandDispatcher-{}".format(i), daemon=True)
+            for i in range(max_in_flight)
+        ]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, channel, method, *args, callback=None):
+        """
+        Queue self.client.<method>(*args) and return the request id without waiting for the reply, or None if the
+        dispatcher is blocked. If a command was still queued on the channel, its callback gets CODE_SUPERSEDED before
+        this returns.
+        """
+        with self.cond:
+            if self.blocked:
+                self.stats.rejected += 1
+                return None
+            self.next_request_id += 1
+            command = PendingCommand(self.next_request_id, channel, method, args, callback, self.clock.now())
+            superseded = self.queued.pop(channel, None)
+            if superseded is not None:
+                self.stats.superseded += 1
+            self.queued[channel] = command
+            self.stats.submitted += 1
+            self.cond.notify()
+        if superseded is not None:
+            self.report(superseded, CODE_SUPERSEDED)
+        return command.request_id
+
+    def block(self):
+        """
+        Drop every queued command and reject new ones until unblock(), e.g. during an emergency stop. Commands already
+        in flight cannot be recalled.
+        """
+        with self.cond:
+            self.blocked = True
+            self.stats.preempted += len(self.queued)
+            self.queued.clear()
+
+    def unblock(self):
+        with self.cond:
+            self.blocked = False
+
+    def num_in_flight(self):
+        return len(self.in_flight)
+
+    def next_command(self):
+        # Oldest queued command whose channel has nothing in flight. Called with self.cond held.
+        for channel, command in self.queued.items():
+            if channel not in self.busy_channels:
+                del self.queued[channel]
+                return command
+        return None
+
+    def worker(self):
+        while True:
+            with self.cond:
+                command = self.next_command()
+                while command is None and not self.stopped:
+                    self.cond.wait()
+                    command = self.next_command()
+                if command is None:
+                    return
+                self.busy_channels.add(command.channel)
+                self.in_flight[command.request_id] = command
+                self.stats.max_in_flight = max(self.stats.max_in_flight, len(self.in_flight))
+
+            try:
+                code = getattr(self.client, command.method)(*command.args)
+            except Exception as e:
+                logger.exception("[CommandDispatcher] {} raised: {}".format(command, e))
+                code = None
+
+            with self.cond:
+                self.busy_channels.discard(command.channel)
+                del self.in_flight[command.request_id]
+                self.stats.completed += 1
+                if code != 0:
+                    self.stats.failed += 1
+                # The channel is free again, another worker may be waiting for it.
+                self.cond.notify_all()
+
+            self.report(command, code)
+
+    def report(self, command, code):
+        # A failing callback must not take the worker down with it, that would silently lower max_in_flight.
+        handlers = [command.callback, self.on_error if code not in (0, CODE_SUPERSEDED) else None]
+        for handler in handlers:
+            if handler is None:
+                continue
+            try:
+                handler(command, code)
+            except Exception as e:
+                logger.exception("[CommandDispatcher] Callback of {} raised: {}".format(command, e))
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.queued.clear()
+            self.cond.notify_all()
+
 
-class History(deque):
-    def __init__(self, default, maxlen=20):
-        super().__init__(maxlen=maxlen)
-        self.default = default
-        self.num_valid = 0
-        self.clear()
+@dataclass
+class CommandStats:
+    sent: int = 0
+    suppressed: int = 0  # RPCs saved because the robot already acknowledged (or is receiving) the same command.
+    failed: int = 0
 
-    def append(self, data):
-        super().append(data)
-        self.num_valid += 1
-        self.num_valid = min(self.num_valid, len(self))
+    def __repr__(self):
+        return "CommandStats(sent={}, suppressed={}, failed={})".format(self.sent, self.suppressed, self.failed)
+
+
+class CommandCoalescer:
+    """
+    Deduplicates commands before they reach the CommandDispatcher. The last command (method and arguments) is
+    remembered per channel from the moment it is submitted; a command equal to it is suppressed while it is in flight
+    or acknowledged, unless keepalive_interval seconds have passed since it was sent. A failed reply forgets it, so the
+    next tick sends it again. Move and StopMove share the velocity channel, so e.g. repeated StopMove calls while the
+    robot is idle collapse into one RPC.
+    """
+
+    def __init__(self, dispatcher, keepalive_interval=COMMAND_KEEPALIVE_INTERVAL, clock=DEFAULT_CLOCK):
+        self.dispatcher = dispatcher
+        self.clock = clock
+        self.keepalive_interval = keepalive_interval
+        # Replies arrive on the dispatcher threads, and superseded ones from within dispatcher.submit() in send().
+        self.lock = threading.RLock()
+        self.last_sent = {}  # channel -> (request_id, (method, args), time sent)
+        self.stats = CommandStats()
+
+    def send(self, channel, method, *args, resets=(), callback=None, force=False):
+        """
+        Submit self.client.<method>(*args) unless it is redundant on its channel (always with force=True, e.g. for a
+        safety stop whose reply must be observed). Return the request id, or None if the command was suppressed.
+        When the robot acknowledges the command, the channels in resets are forgotten: this is for commands that
+        reset the robot posture, such as SwitchGait. callback(command, code) is called with the reply, on a
+        dispatcher thread, or with CODE_SUPERSEDED if a later send() on the channel replaces the command before it
+        goes out.
+        """
+        command = (method, args)
+        now = self.clock.now()
+        with self.lock:
+            last = self.last_sent.get(channel)
+            if not force and last is not None and last[1] == command and (
+                    self.keepalive_interval is None or now - last[2] < self.keepalive_interval):
+                self.stats.suppressed += 1
+                return None
+            # Hold the lock while submitting so that a fast reply cannot be processed before last_sent is recorded.
+            request_id = self.dispatcher.submit(
+                channel, method, *args, callback=lambda cmd, code: self.on_reply(cmd, code, resets, callback)
+            )
+            if request_id is None:
+                return None  # Dispatcher blocked
+            self.stats.sent += 1
+            self.last_sent[channel] = (request_id, command, now)
+        return request_id
+
+    def on_reply(self, command, code, resets, callback=None):
+        with self.lock:
+            if code == 0:
+                for channel in resets:
+                    self.last_sent.pop(channel, None)
+            else:
+                if code != CODE_SUPERSEDED:
+                    self.stats.failed += 1
+                last = self.last_sent.get(command.channel)
+                if last is not None and last[0] == command.request_id:
+                    del self.last_sent[command.channel]
+        if callback is not None:
+            callback(command, code)
+
+    def invalidate(self, channel=None):
+        """
+        Forget what was sent, e.g. after a command that bypassed this layer such as Damp().
+        """
+        with self.lock:
+            if channel is None:
+                self.last_sent.clear()
+            else:
+                self.last_sent.pop(channel, None)
+
+
+@dataclass
+class EmergencyStopStats:
+    triggered: int = 0
+    acknowledged: int = 0
+    failed: int = 0  # Damp() calls that were not acknowledged
+    last_latency: float = float("nan")  # seconds from trigger() to the acknowledgment of Damp()
+    max_latency: float = 0.0
+
+    def __repr__(self):
+        return "EmergencyStopStats(triggered={}, acknowledged={}, failed={}, last_latency={:.1f}ms, " \
+               "max_latency={:.1f}ms)".format(self.triggered, self.acknowledged, self.failed,
+                                              self.last_latency * 1e3, self.max_latency * 1e3)
+
+
+class EmergencyStop(threading.Thread):
+    """
+    Sends Damp() from a dedicated thread, on a SportClient used for nothing else, so an emergency stop never waits
+    behind the control loop, a command in flight or a state poll.
+
+    trigger() only records the time, runs preempt() (e.g. dropping queued motion commands) and wakes the thread, so it
+    is safe to call from the controller callback. The stop stays engaged, and motion should stay blocked, until
+    release().
+    """
+
+    def __init__(self, client, preempt=None, clock=DEFAULT_CLOCK):
+        super().__init__(name="EmergencyStop", daemon=True)
+        self.client = client
+        self.preempt = preempt
+        self.clock = clock
+        self.engaged = threading.Event()
+        self.requested = threading.Event()
+        self.stop_event = threading.Event()
+        self.trigger_time = None
+        self.stats = EmergencyStopStats()
+
+    def trigger(self):
+        self.trigger_time = self.clock.now()
+        self.stats.triggered += 1
+        self.engaged.set()
+        self.requested.set()
+        if self.preempt is not None:
+            self.preempt()
+
+    def release(self):
+        self.engaged.clear()
+
+    def damp(self):
+        for attempt in range(1, ESTOP_MAX_ATTEMPTS + 1):
+            try:
+                code = self.client.Damp()
+            except Exception as e:
+                logger.exception("[EmergencyStop] Damp raised: {}".format(e))
+                code = None
+            if code == 0:
+                return True
+            self.stats.failed += 1
+            logger.error("[EmergencyStop] Damp failed (attempt {}/{}): code {}".format(
+                attempt, ESTOP_MAX_ATTEMPTS, code))
+        return False
+
+    def run(self):
+        while True:
+            self.requested.wait()
+            if self.stop_event.is_set():
+                return
+            self.requested.clear()
+            trigger_time = self.trigger_time
+            if self.damp():
+                latency = self.clock.now() - trigger_time
+                self.stats.acknowledged += 1
+                self.stats.last_latency = latency
+                self.stats.max_latency = max(self.stats.max_latency, latency)
+                logger.warning("[EmergencyStop] Damp acknowledged {:.1f}ms after the trigger.".format(latency * 1e3))
+
+    def stop(self):
+        self.stop_event.set()
+        self.requested.set()
+
+
+@dataclass
+class WatchdogStats:
+    beats: int = 0
+    stalls: int = 0
+    stops: int = 0  # Stalls whose stop the robot acknowledged, see HeartbeatWatchdog.stop_acknowledged.
+    last_time_to_stop: float = float("nan")  # seconds from the last action to the acknowledged stop
+    max_time_to_stop: float = 0.0
+
+    def __repr__(self):
+        return "WatchdogStats(beats={}, stalls={}, stops={}, last_time_to_stop={:.1f}ms, max_time_to_stop={:.1f}ms)" \
+            .format(self.beats, self.stalls, self.stops, self.last_time_to_stop * 1e3, self.max_time_to_stop * 1e3)
+
+
+class HeartbeatWatchdog(threading.Thread):
+    """
+    Calls on_stall() once when beat() has not been called for timeout seconds, and is re-armed by the next beat().
+
+    The watchdog sleeps on its own timer until the deadline of the last beat, so a stall is detected within timeout
+    plus the thread wake-up latency, independently of the control rate (and of a control loop that is stuck). It
+    is not armed before the first beat. All waits go through the clock.
+
+    on_stall() typically only queues a stop command: call stop_acknowledged() when the robot acknowledges it, to
+    record the time from the last beat to the stop. It is called with self.lock held, so a thread that checks stalled
+    under the lock before sending a command is ordered with it: its command is either sent before on_stall() or not
+    at all.
+    """
+
+    def __init__(self, on_stall, timeout=HEARTBEAT_TIMEOUT, clock=DEFAULT_CLOCK):
+        super().__init__(name="HeartbeatWatchdog", daemon=True)
+        self.on_stall = on_stall
+        self.timeout = timeout
+        self.clock = clock
+        self.lock = threading.RLock()  # Reentrant, for a reply to on_stall() that is reported right away.
+        self.beat_event = threading.Event()  # Wakes the thread when it waits for the first beat after a stall.
+        self.stop_event = threading.Event()
+        self.last_beat = None
+        self.stalled = False
+        self.stalled_beat = None  # last_beat of the current stall, until its stop is acknowledged
+        self.stats = WatchdogStats()
+
+    def beat(self):
+        with self.lock:
+            self.last_beat = self.clock.now()
+            self.stats.beats += 1
+            if self.stalled:
+                self.stalled = False
+                logger.info("[HeartbeatWatchdog] Actions resumed.")
+        self.beat_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                last_beat = None if self.stalled else self.last_beat
+            if last_beat is None:
+                self.clock.wait(self.beat_event, None)
+                self.beat_event.clear()
+                continue
+
+            remaining = last_beat + self.timeout - self.clock.now()
+            if remaining > 0:
+                # A beat in the meantime only moves the deadline later, so it does not need to wake us.
+                self.clock.wait(self.stop_event, remaining)
+                continue
+
+            with self.lock:
+                if self.last_beat != last_beat:
+                    continue  # Beaten just now
+                self.stalled = True
+                self.stalled_beat = last_beat
+                self.stats.stalls += 1
+                try:
+                    self.on_stall()
+                except Exception as e:
+                    logger.exception("[HeartbeatWatchdog] on_stall raised: {}".format(e))
+
+    def stop_acknowledged(self):
+        """
+        Record that the robot acknowledged the stop of the current stall. Safe to call from any thread.
+        """
+        with self.lock:
+            if self.stalled_beat is None:
+                return  # Acknowledged twice, or a stop not sent for a stall
+            time_to_stop = self.clock.now() - self.stalled_beat
+            self.stalled_beat = None
+            self.stats.stops += 1
+            self.stats.last_time_to_stop = time_to_stop
+            self.stats.max_time_to_stop = max(self.stats.max_time_to_stop, time_to_stop)
+
+    def stop(self):
+        self.stop_event.set()
+        self.beat_event.set()
+
+
+@dataclass
+class ChordBinding:
+    mask: int
+    callback: Callable[[], None]
+    kind: str = CHORD_PRESS
+    debounce: float = 0.0  # seconds. Minimum time between two firings.
+    hold_duration: float = 1.0  # seconds, CHORD_HOLD only
+    double_tap_interval: float = 0.4  # seconds, CHORD_DOUBLE_TAP only
+    exact: bool = False  # Only match when no other key is held.
+    name: str = ""
+
+    # Runtime state
+    last_fired: float = -np.inf
+    completed_at: Optional[float] = None  # When the chord was last completed (its last key went down).
+    hold_fired: bool = False
+    last_tap: float = -np.inf
+
+    def __repr__(self):
+        return "ChordBinding({}: {} {})".format(self.name, "+".join(key_names(self.mask)), self.kind)
+
+
+class ChordEngine:
+    """
+    Registry of controller bindings, evaluated in one pass per WirelessController_ message:
+
+    - CHORD_PRESS fires when all keys of the chord are down, at the moment the last of them goes down.
+    - CHORD_HOLD fires once the chord has been held for hold_duration.
+    - CHORD_DOUBLE_TAP fires when the chord is completed twice within double_tap_interval.
+
+    Bindings are compiled into lookup tables indexed by the 16-bit key mask, giving the bindings satisfied by each
+    mask. A message therefore costs one table lookup plus the work of the bindings that are actually satisfied, no
+    matter how many bindings are registered. Holds are checked on every message, even when the mask did not change,
+    since the controller keeps publishing while keys are held.
+    """
+
+    def __init__(self, clock=DEFAULT_CLOCK):
+        self.clock = clock
+        self.bindings = []
+        self.keys = 0
+        self.table = None  # mask -> bindings satisfied by mask
+        self.hold_table = None  # mask -> CHORD_HOLD bindings satisfied by mask
+
+    def register(self, keys, callback, kind=CHORD_PRESS, debounce=0.0, hold_duration=1.0, double_tap_interval=0.4,
+                 exact=False, name=None):
+        assert kind in (CHORD_PRESS, CHORD_HOLD, CHORD_DOUBLE_TAP), kind
+        mask = chord_mask(keys)
+        assert 0 < mask < NUM_KEY_MASKS, keys
+        binding = ChordBinding(mask, callback, kind=kind, debounce=debounce, hold_duration=hold_duration,
+                               double_tap_interval=double_tap_interval, exact=exact,
+                               name=name or getattr(callback, "__name__", ""))
+        self.bindings.append(binding)
+        self.table = None
+        return binding
+
+    def compile(self):
+        table = [()] * NUM_KEY_MASKS
+        for binding in self.bindings:
+            if binding.exact:
+                table[binding.mask] += (binding,)
+                continue
+            # Every superset of the chord: enumerate the subsets of the other keys.
+            free = ~binding.mask & (NUM_KEY_MASKS - 1)
+            subset = free
+            while True:
+                table[binding.mask | subset] += (binding,)
+                if subset == 0:
+                    break
+                subset = (subset - 1) & free
+        self.table = table
+        self.hold_table = [tuple(b for b in bindings if b.kind == CHORD_HOLD) if bindings else ()
+                           for bindings in table]
+
+    def fire(self, binding, now):
+        if now - binding.last_fired < binding.debounce:
+            return
+        binding.last_fired = now
+        try:
+            binding.callback()
+        except Exception as e:
+            logger.error("[ChordEngine.fire] {} failed: {}".format(binding, e))
+
+    def handle(self, keys):
+        if self.table is None:
+            self.compile()
+        changed = keys ^ self.keys
+        if changed:
+            pressed = changed & keys  # Press edges
+            self.keys = keys
+            if pressed:
+                now = self.clock.now()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[ChordEngine.handle] Keys pressed: {}".format(key_names(keys)))
+                for binding in self.table[keys]:
+                    if not pressed & binding.mask:
+                        continue  # Completed earlier and still held.
+                    binding.completed_at = now
+                    if binding.kind == CHORD_PRESS:
+                        self.fire(binding, now)
+                    elif binding.kind == CHORD_HOLD:
+                        binding.hold_fired = False
+                    elif now - binding.last_tap <= binding.double_tap_interval:
+                        binding.last_tap = -np.inf
+                        self.fire(binding, now)
+                    else:
+                        binding.last_tap = now
+
+        holds = self.hold_table[keys]
+        if holds:
+            now = self.clock.now()
+            for binding in holds:
+                if not binding.hold_fired and binding.completed_at is not None and \
+                        now - binding.completed_at >= binding.hold_duration:
+                    binding.hold_fired = True
+                    self.fire(binding, now)
+
+
+# Record layout of RingHistory. Discrete actions are stored in "action"; continuous (vx, vyaw) actions are stored in
+# "vx" / "vyaw" with action = CONTINUOUS_ACTION. For velocity history, "action" holds the stop flag.
+HISTORY_DTYPE = np.dtype([
+    ("time", np.float64),
+    ("vx", np.float64),
+    ("vy", np.float64),
+    ("vyaw", np.float64),
+    ("action", np.int64),
+])
+CONTINUOUS_ACTION = -1
+
+
+class RingHistory:
+    """
+    Fixed-capacity ring buffer of HISTORY_DTYPE records over a preallocated numpy structured array, with O(1) append
+    and clear and vectorized queries over the valid window.
+
+    It is safe for one writer thread (append) and one reader thread (everything else, including clear). The writer
+    fills a slot before publishing it by incrementing count, and there is one spare slot, so the slot being written is
+    never one of the `capacity` published records. The reader copies what it needs and then re-reads count to drop
+    the records that the writer may have overwritten in the meantime.
+    """
+
+    def __init__(self, default, capacity=20):
+        assert capacity > 0
+        self.capacity = capacity
+        self.num_slots = capacity + 1
+        self.buffer = np.zeros(self.num_slots, dtype=HISTORY_DTYPE).view(np.recarray)
+        self.default = np.rec.array(tuple(default[name] for name in HISTORY_DTYPE.names), dtype=HISTORY_DTYPE)[()]
+        self.count = 0  # Number of records ever appended. Written by the writer only.
+        self.start = 0  # Value of count at the last clear(). Written by the reader only.
+
+    def append(self, time, vx=np.nan, vy=np.nan, vyaw=np.nan, action=0):
+        i = self.count % self.num_slots
+        buffer = self.buffer
+        buffer.time[i] = time
+        buffer.vx[i] = vx
+        buffer.vy[i] = vy
+        buffer.vyaw[i] = vyaw
+        buffer.action[i] = action
+        self.count += 1  # Publish the record.
 
     def clear(self):
-        super().clear()
-        self.extend([self.default] * self.maxlen)
-        self.num_valid = 0
+        self.start = self.count
+
+    def valid_range(self, count):
+        return max(self.start, count - self.capacity), count
+
+    def __len__(self):
+        first, last = self.valid_range(self.count)
+        return last - first
+
+    def __getitem__(self, index):
+        """
+        Return the index-th valid record (negative indices count from the newest), or the default record if the
+        history is empty. Only integer indices are supported, use window() for slices.
+        """
+        first, last = self.valid_range(self.count)
+        if first == last:
+            return self.default
+        position = last + index if index < 0 else first + index
+        if not first <= position < last:
+            raise IndexError(index)
+        record = self.buffer[position % self.num_slots].copy()
+        if position < self.count - self.capacity:
+            # Overwritten while we were reading. Only possible when index points at the oldest records.
+            raise IndexError(index)
+        return record
+
+    def window(self):
+        """
+        Return a copy of the valid records, oldest first.
+        """
+        first, last = self.valid_range(self.count)
+        positions = np.arange(first, last)
+        records = self.buffer[positions % self.num_slots]  # Fancy indexing copies.
+        # Keep only the records that cannot have been overwritten during the copy above.
+        return records[positions >= self.count - self.capacity]
+
+    def since(self, t):
+        records = self.window()
+        return records[records.time >= t]
+
+    def mean(self, field, duration, now):
+        """
+        Mean of a field over the records of the last duration seconds, e.g. history.mean("vx", 0.5, now).
+        Return NaN if there is none.
+        """
+        values = self.since(now - duration)[field]
+        values = values[~np.isnan(values)] if values.dtype.kind == "f" else values
+        return float(values.mean()) if len(values) else float("nan")
+
+    def __iter__(self):
+        return iter(self.window())
+
+    def __reversed__(self):
+        return iter(self.window()[::-1])
 
     def __repr__(self):
-        return "History: [\n" + "\n".join(["\t" + str(x) for x in self]) + "\n]"
+        return "RingHistory: [\n" + "\n".join(["\t" + str(x) for x in self.window()]) + "\n]"
 
 
 class ActionPostprocessor:
     debounce_time = 0.3  # debounce time in seconds
 
-    in_emergency_stop = False
-
     state_map = None
-
-    action_history = History(StepAction(action=0, time=time.time()), maxlen=20)
-    velocity_history = History(Velocity(vx=0, vy=0, vyaw=0, stop=True, time=time.time()), maxlen=20)
-
-    start_time = time.time()
+    robot_state = None
 
     current_velocity = None
 
     running = False
 
-    def __init__(self, config=None, debug=False, init_channel=True):
-        self.key_state = {
-            "R1": 0,
-            "L1": 0,
-            "start": 0,
-            "select": 0,
-            "R2": 0,
-            "L2": 0,
-            "F1": 0,
-            "F2": 0,
-            "A": 0,
-            "B": 0,
-            "X": 0,
-            "Y": 0,
-            "up": 0,
-            "right": 0,
-            "down": 0,
-            "left": 0,
-        }
-        self.key_map = [
-            "R1", "L1", "start", "select", "R2", "L2", "F1", "F2", "A", "B", "X", "Y", "up", "right", "down", "left"
-        ]
-        self.last_pressed_time = {key: 0 for key in self.key_map}
+    def __init__(self, config=None, debug=False, init_channel=True, control_rate=CONTROL_RATE_HZ,
+                 overrun_policy=FixedRateScheduler.SKIP, state_poll_rate=STATE_POLL_RATE_HZ,
+                 state_max_age=STATE_MAX_AGE, command_keepalive_interval=COMMAND_KEEPALIVE_INTERVAL,
+                 max_in_flight=COMMAND_MAX_IN_FLIGHT, heartbeat_timeout=HEARTBEAT_TIMEOUT, tick_mode=TICK_HYBRID,
+                 min_tick_interval=MIN_TICK_INTERVAL, clock=DEFAULT_CLOCK):
+        self.clock = clock
+        self.start_time = clock.now()
+
+        # Controller bindings. Emergency stop has no debounce: it must fire every time the chord is completed.
+        self.chords = ChordEngine(clock=clock)
+        self.chords.register(KEY_L2_B, self.emergency_stop)
+        # self.chords.register(KEY_L2_A, self.resume)
+        # self.chords.register("start", lambda: self.toggle_joystick(allow_joystick_control=None),
+        #                      debounce=self.debounce_time)
+        self.chords.register("down", self.print_robot_state, debounce=self.debounce_time)
+        self.chords.compile()
 
         from unitree_sdk2py.go2.obstacles_avoid.obstacles_avoid_client import ObstaclesAvoidClient
         from unitree_sdk2py.core.channel import ChannelSubscriber, ChannelFactoryInitialize
@@ -276,6 +1350,24 @@ class ActionPostprocessor:
         self.client.SetTimeout(TIMEOUT)
 
         self.client.Init()
+        self.dispatcher = CommandDispatcher(self.client, max_in_flight=max_in_flight,
+                                            on_error=self.on_command_failed, clock=clock)
+        self.commands = CommandCoalescer(self.dispatcher, keepalive_interval=command_keepalive_interval, clock=clock)
+
+        # State polling uses its own client so that a slow GetState never queues up behind (or in front of) a command.
+        self.state_client = SportClient()
+        self.state_client.SetTimeout(TIMEOUT)
+        self.state_client.Init()
+        self.state_poller = RobotStatePoller(self.state_client, rate_hz=state_poll_rate, clock=clock)
+        self.state_max_age = state_max_age
+        self.state_code = STATE_CODE_STALE
+
+        # Emergency stop on a third client and its own thread, running from now on: the controller is already live.
+        self.estop_client = SportClient()
+        self.estop_client.SetTimeout(TIMEOUT)
+        self.estop_client.Init()
+        self.estop = EmergencyStop(self.estop_client, preempt=self.preempt_motion, clock=clock)
+        self.estop.start()
 
         print("==============================================================================")
         self.obstacle_avoid_client = ObstaclesAvoidClient()
@@ -340,45 +1432,35 @@ class ActionPostprocessor:
 
         self.stop_event = threading.Event()  # Event to signal stopping
 
-    def update_key_state(self, keys):
-        for i in range(16):
-            self.key_state[self.key_map[i]] = (keys & (1 << i)) >> i
-
-    def is_key_pressed(self, key):
-        return self.key_state.get(key, 0) == 1
-
-    def debounce(self, key):
-        current_time = time.time()
-        if current_time - self.last_pressed_time[key] > self.debounce_time:
-            self.last_pressed_time[key] = current_time
-            return True
-        return False
+        # Written by the thread calling action_callback, read by the control thread.
+        self.action_history = RingHistory(dict(time=clock.now(), vx=np.nan, vy=np.nan, vyaw=np.nan, action=0),
+                                          capacity=20)
+        # Written and read by the control thread.
+        self.velocity_history = RingHistory(dict(time=clock.now(), vx=0.0, vy=0.0, vyaw=0.0, action=1), capacity=20)
+
+        self.scheduler = FixedRateScheduler(rate_hz=control_rate, overrun_policy=overrun_policy, clock=clock)
+        self.watchdog = HeartbeatWatchdog(self.on_action_stall, timeout=heartbeat_timeout, clock=clock)
+
+        # In hybrid mode, action_callback wakes the control loop right away instead of waiting for the next deadline.
+        assert tick_mode in (TICK_PERIODIC, TICK_HYBRID), tick_mode
+        self.tick_mode = tick_mode
+        self.min_tick_interval = min_tick_interval
+        self.action_event = threading.Event()
+        # Seconds from the arrival of an action to the first move() after it. Written by the control thread.
+        self.action_latencies = deque(maxlen=ACTION_LATENCY_SAMPLES)
+        self.last_measured_action_time = None
+
+    def is_key_pressed(self, keys):
+        """
+        True if all keys (a mask or names, e.g. KEY_L2_B or "L2+B") are held.
+        """
+        mask = chord_mask(keys)
+        return self.chords.keys & mask == mask
 
     def wireless_controller_handler(self, msg):
-        self.update_key_state(msg.keys)
-
-        pressed_keys = [key for key, state in self.key_state.items() if state == 1]
-        if pressed_keys:
-            self.logger.log(logging.DEBUG, "Keys pressed: {}".format(pressed_keys))
-
-        if self.is_key_pressed("L2") and self.is_key_pressed("B"):
-            self.emergency_stop()
-
-        # if self.is_key_pressed("L2") and self.is_key_pressed("A"):
-        #     self.resume()
-
-        # if self.is_key_pressed("start") and self.debounce("start"):
-        #     self.toggle_joystick(allow_joystick_control=None)
-
-        if self.is_key_pressed("down") and self.debounce("down"):
-            self.print_robot_state()
+        self.chords.handle(msg.keys)
 
     def update_robot_state(self):
-        state_keys = [
-            "state", "bodyHeight", "footRaiseHeight", "speedLevel",
-            "gait", "joystick", "dance", "continuousGait", "economicGait"
-        ]
-
         if self.debug:
             self.state_code = 0
             self.state_map = {
@@ -392,16 +1474,22 @@ class ActionPostprocessor:
                 "continuousGait": "none",
                 "economicGait": "none"
             }
+            self.robot_state = RobotState.from_map(self.state_map)
             return
 
-        code, state_map = self.client.GetState(state_keys)
-
-        self.state_code = code
-        if self.state_code == 0 and state_map is not None:
-            self.state_map = state_map
-            for key, value in self.state_map.items():
-                value = eval(value)["data"]
-                self.state_map[key] = value
+        # Read the cached snapshot from the state poller instead of doing a GetState round trip in the tick.
+        snapshot = self.state_poller.get(max_age=self.state_max_age)
+        if snapshot is None:
+            if self.state_map is not None:
+                logger.warning("[update_robot_state] Robot state is older than {:.2f}s, treat it as unknown.".format(
+                    self.state_max_age))
+            self.state_code = STATE_CODE_STALE
+            self.state_map = None
+            self.robot_state = None
+        else:
+            self.state_code = snapshot.code
+            self.state_map = snapshot.state_map
+            self.robot_state = snapshot.state
 
     def print_robot_state(self):
         if self.state_code == 0 and self.state_map is not None:
@@ -412,28 +1500,50 @@ class ActionPostprocessor:
         else:
             print("Failed to get robot state. Error code:", self.state_code)
 
+    @property
+    def in_emergency_stop(self):
+        return self.estop.engaged.is_set()
+
     def emergency_stop(self):
-        if self.in_emergency_stop:
-            return
-        self.logger.warning("[L2 + B] Emergency stop is executing...")
-        self.client.Damp()
-        self.in_emergency_stop = True
-        time.sleep(self.debounce_time)
-        self.logger.info("[L2 + B] Emergency stop activated. Press [L2 + A] to resume.")
+        # Runs on the controller callback thread: hand over to the e-stop thread, never wait for the RPC here.
+        self.estop.trigger()
+        self.logger.warning("[L2 + B] Emergency stop triggered. Press [L2 + A] to resume.")
+
+    def preempt_motion(self):
+        # Drop the queued motion commands and refuse new ones. After Damp(), the robot posture no longer matches what
+        # was sent, so nothing sent before may be suppressed as a duplicate either.
+        self.dispatcher.block()
+        self.commands.invalidate()
+
+    def resume(self):
+        self.estop.release()
+        self.dispatcher.unblock()
+        self.logger.info("[L2 + A] Emergency stop released.")
 
     def action_callback(self, action):
         """
         This function should be called explicitly by the RL env.
         """
+        self.watchdog.beat()
         logger.debug("[action_callback] Safety Layer: Received action: {}".format(RemixAction.get_string(action)))
-        self.action_history.append(StepAction(action=action, time=time.time()))
+        if isinstance(action, tuple):
+            vx, vyaw = action
+            self.action_history.append(self.clock.now(), vx=vx, vyaw=vyaw, action=CONTINUOUS_ACTION)
+        else:
+            self.action_history.append(self.clock.now(), action=action)
+        self.action_event.set()
 
     def run(self):
+        if not self.debug:
+            self.state_poller.start()
+            self.dispatcher.start()
+        self.watchdog.start()
+        self.scheduler.reset()
+        wake = self.action_event if self.tick_mode == TICK_HYBRID else None
         try:
-            while True:
-                action_postprocessor_tick_interval = 0.02
-
-                time.sleep(action_postprocessor_tick_interval)  # Run in 50HZ
+            while not self.stop_event.is_set():
+                # Run in 50HZ by default, and in hybrid mode also as soon as an action arrives.
+                self.scheduler.wait(wake=wake, min_interval=self.min_tick_interval)
                 self.update_robot_state()
                 self.tick()
         finally:
@@ -483,26 +1593,19 @@ class ActionPostprocessor:
 
     def tick(self):
 
-        t = time.time()
+        t = self.clock.now()
 
         logger.debug("[Tick] {:.2f}s Enter tick. Current history: {}".format(
             t - self.start_time, self.action_history)
         )
 
-        if not self.running:
+        if not self.running or self.in_emergency_stop:
             # self.action_history.clear()
             return
 
-        # if t > self.action_history[-1].time and (t - self.action_history[-1].time) > 0.2:
-        #     # Something wrong, clear the action sequence
-        #     self.execute_stop()
-        #
-        #     if not self.debug:
-        #         logger.warning("[Tick] {:.2f}s No action received since past {:.2f}s. Clear action history.".format(
-        #             t - self.start_time, t - self.action_history[-1].time)
-        #         )
-        #
-        #     self.action_history.clear()
+        if self.watchdog.stalled:
+            # The watchdog already stopped the robot, don't act on stale actions.
+            return
 
         # if len(self.action_history) == 0:
         #     return
@@ -511,7 +1614,7 @@ class ActionPostprocessor:
         # vel = self.update_velocity_profile()
 
         # Save velocity
-        # self.velocity_history.append(vel)
+        # self.velocity_history.append(vel.time, vx=vel.vx, vy=vel.vy, vyaw=vel.vyaw, action=vel.stop)
 
         # Execute the velocity profile.
         # should_run = self.should_run()
@@ -543,7 +1646,7 @@ class ActionPostprocessor:
     #     if self.always_use_run:
     #         return True
     #
-    #     t = time.time()
+    #     t = self.clock.now()
     #     accumulated_time = 0.0
     #     for v in reversed(self.velocity_history):
     #         dt = t - v.time
@@ -564,39 +1667,24 @@ class ActionPostprocessor:
             return
 
         if self.always_use_run:
-            ret = self.client.Euler(0, 0.0, 0)
-            if ret != 0:
-                logger.error("[stop_move] Failed to set euler")
-
-            ret = self.client.BodyHeight(0.0)
-            if ret != 0:
-                logger.error("[stop_move] Failed to set body height")
+            # Failures are reported asynchronously through on_command_failed.
+            self.commands.send(CHANNEL_EULER, "Euler", 0, 0.0, 0)
+            self.commands.send(CHANNEL_BODY_HEIGHT, "BodyHeight", 0.0)
+            self.commands.send(CHANNEL_VELOCITY, "StopMove")
 
-            ret = self.client.StopMove()
-            if ret != 0:
-                logger.error("[stop_move] Failed to stop move")
-
-        elif self.state_map is None or self.state_map["gait"] != "walk":
-            ret = self.switch_gait(1)
+        elif self.robot_state is None or self.robot_state.gait != "walk":
+            self.switch_gait(1)
 
         else:
-            ret = self.client.Euler(0, 0.0, 0)
-            if ret != 0:
-                logger.error("[stop_move] Failed to set euler")
-
-            ret = self.client.BodyHeight(0.0)
-            if ret != 0:
-                logger.error("[stop_move] Failed to set body height")
-
-            ret = self.client.StopMove()
-            if ret != 0:
-                logger.error("[stop_move] Failed to stop move")
+            self.commands.send(CHANNEL_EULER, "Euler", 0, 0.0, 0)
+            self.commands.send(CHANNEL_BODY_HEIGHT, "BodyHeight", 0.0)
+            self.commands.send(CHANNEL_VELOCITY, "StopMove")
 
     def execute_walk_velocity(self, vel: Velocity):
         if self.debug:
             return
 
-        if self.state_map is None or self.state_map["gait"] != "walk":
+        if self.robot_state is None or self.robot_state.gait != "walk":
             self.switch_gait(1)
             logger.info("[execute_walk_velocity] Not in walk state, switch to walk state. Current state: {}".format(
                 self.state_map))
@@ -609,7 +1697,7 @@ class ActionPostprocessor:
         if self.debug:
             return
 
-        if self.state_map is None or self.state_map["gait"] != "run":
+        if self.robot_state is None or self.robot_state.gait != "run":
             self.switch_gait(2)
             logger.info("[execute_run_velocity] Not in run state, switch to run state. Current state: {}".format(
                 self.state_map))
@@ -622,9 +1710,9 @@ class ActionPostprocessor:
             return
 
         # roll:  取值范围  [-0.75~0.75] (rad)； pitch:  取值范围  [-0.75~0.75] (rad)； yaw:  取值范围  [-0.6~0.6] (rad)。
-        if self.state_map is not None and self.state_map["state"] != "locomotion":
-            self.client.Euler(0, 0.75, 0)
-            self.client.BodyHeight(-0.07)
+        if self.robot_state is not None and self.robot_state.state != "locomotion":
+            self.commands.send(CHANNEL_EULER, "Euler", 0, 0.75, 0)
+            self.commands.send(CHANNEL_BODY_HEIGHT, "BodyHeight", -0.07)
             # self.client.Wallow()
             # self.client.Pose(True)
             # self.client.FrontFlip()
@@ -643,29 +1731,71 @@ class ActionPostprocessor:
         if self.debug:
             return
 
-        ret = self.client.SwitchGait(gait)
-        if ret != 0:
-            logger.warning("Failed to switch gait to: {}".format(gait))
+        self.commands.send(CHANNEL_MODE, "SwitchGait", gait,
+                           resets=(CHANNEL_VELOCITY, CHANNEL_EULER, CHANNEL_BODY_HEIGHT))
 
     def balance_stand(self):
         if self.debug:
             return
 
-        ret = self.client.BalanceStand()
-        if ret != 0:
-            logger.warning("Failed to balance stand")
+        self.commands.send(CHANNEL_MODE, "BalanceStand",
+                           resets=(CHANNEL_VELOCITY, CHANNEL_EULER, CHANNEL_BODY_HEIGHT))
 
     def move(self, x, y, z):
+        self.record_action_latency()
         if self.debug:
             return
-        ret = self.client.Move(x, y, z)
-        if ret != 0:
-            logger.warning("Failed to move")
+        with self.watchdog.lock:
+            # Checked under the lock on_action_stall() runs with: a Move submitted before the stall StopMove is
+            # superseded by it or sent before it, and none is submitted after it until the next action.
+            if self.watchdog.stalled:
+                return
+            self.commands.send(CHANNEL_VELOCITY, "Move", x, y, z)
+
+    def record_action_latency(self):
+        if not len(self.action_history):
+            return
+        action_time = self.action_history[-1].time
+        if action_time != self.last_measured_action_time:
+            self.last_measured_action_time = action_time
+            self.action_latencies.append(self.clock.now() - action_time)
+
+    def median_action_latency(self):
+        return float(np.median(self.action_latencies)) if self.action_latencies else float("nan")
+
+    def on_action_stall(self):
+        # Called on the watchdog thread, with the watchdog lock held. StopMove goes through the thread-safe command
+        # path; the posture commands of execute_stop() depend on the robot state owned by the control thread, so they
+        # are left to it. It is forced past the coalescer: an idle StopMove sent just before must not suppress it, or
+        # its acknowledgement would never be recorded.
+        logger.warning("[on_action_stall] {:.2f}s No action received for {:.2f}s, stopping.".format(
+            self.clock.now() - self.start_time, self.watchdog.timeout))
+        if not self.debug:
+            self.commands.send(CHANNEL_VELOCITY, "StopMove", callback=self.on_stall_stop_reply, force=True)
+
+    def on_stall_stop_reply(self, command: PendingCommand, code):
+        # Called on a dispatcher thread.
+        if code == 0:
+            self.watchdog.stop_acknowledged()
+
+    def on_command_failed(self, command: PendingCommand, code):
+        # Called on a dispatcher thread, never on the control thread.
+        logger.warning("Failed to execute {} on channel {}: code {}".format(command, command.channel, code))
 
     def close(self):
         # self.toggle_joystick(allow_joystick_control=True)
         # self.resume()
         self.sub.Close()
+        self.state_poller.stop()
+        self.dispatcher.close()
+        self.estop.stop()
+        self.watchdog.stop()
+        self.logger.info("Control loop stats: {}".format(self.scheduler.stats))
+        self.logger.info("Command stats: {}, {}".format(self.commands.stats, self.dispatcher.stats))
+        self.logger.info("Emergency stop stats: {}".format(self.estop.stats))
+        self.logger.info("Action watchdog stats: {}".format(self.watchdog.stats))
+        self.logger.info("Median action-to-Move latency: {:.1f}ms over {} actions".format(
+            self.median_action_latency() * 1e3, len(self.action_latencies)))
         self.logger.info("UnitreeMiddleware shutdown complete.")
 
 
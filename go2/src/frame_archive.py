@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Append-only container for recorded image frames, used by save_image_topics.py --output-format archive.
+
+Writing one file per frame creates hundreds of thousands of small files per hour of capture. Instead, an archive is a
+directory with:
+
+    meta.json            Topic and encoding names, referenced by id from the index.
+    index.bin            One fixed-size INDEX_DTYPE record per frame: header stamp, segment, offset, length, ids.
+    segment_00000.bin    Large, preallocated files holding the encoded frames back to back.
+    ...
+
+The index is append-only, so an archive whose recorder crashed can still be read up to the last flushed record.
+
+Usage:
+    python3 frame_archive.py images_20250101_120000    # Print a summary of an archive
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+ARCHIVE_VERSION = 1
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024  # bytes
+
+INDEX_DTYPE = np.dtype([
+    ("stamp_ns", "<i8"),
+    ("offset", "<u8"),
+    ("length", "<u4"),
+    ("segment", "<u4"),
+    ("topic", "<u2"),
+    ("encoding", "<u2"),
+])
+INDEX_STRUCT = struct.Struct("<qQIIHH")
+assert INDEX_STRUCT.size == INDEX_DTYPE.itemsize
+
+META_FILENAME = "meta.json"
+INDEX_FILENAME = "index.bin"
+
+Frame = namedtuple("Frame", ["topic", "stamp_ns", "encoding", "data"])
+
+
+def segment_filename(segment):
+    return f"segment_{segment:05d}.bin"
+
+
+def stamp_to_ns(stamp):
+    # builtin_interfaces/Time -> integer nanoseconds.
+    return stamp.sec * 1000000000 + stamp.nanosec
+
+
+class FrameArchiveWriter:
+    """
+    Appends encoded frames to an archive directory. Thread-safe: frames may be appended from several writer threads.
+
+    If the directory already holds an archive, e.g. the recorder was restarted, the new frames are appended after its
+    last indexed frame.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.encodings = {}
+        self.segment = -1
+        self.segment_file = None
+        self.offset = 0
+        self.num_frames = 0
+        if os.path.exists(os.path.join(directory, META_FILENAME)):
+            self.resume()
+        else:
+            self.index_file = open(os.path.join(directory, INDEX_FILENAME), "wb")
+        self.write_meta()
+
+    def resume(self):
+        with open(os.path.join(self.directory, META_FILENAME)) as f:
+            meta = json.load(f)
+        if meta["version"] != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported archive version: {meta['version']}")
+        self.topics = {name: i for i, name in enumerate(meta["topics"])}
+        self.encodings = {name: i for i, name in enumerate(meta["encodings"])}
+
+        path = os.path.join(self.directory, INDEX_FILENAME)
+        self.index_file = open(path, "ab")
+        size = self.index_file.seek(0, os.SEEK_END)
+        # Drop a partially written last record.
+        self.num_frames = size // INDEX_STRUCT.size
+        self.index_file.truncate(self.num_frames * INDEX_STRUCT.size)
+        if self.num_frames == 0:
+            return
+
+        # Segments and offsets only grow, so the last record tells where to continue. Whatever follows it in its
+        # segment was never indexed and is overwritten.
+        with open(path, "rb") as f:
+            f.seek((self.num_frames - 1) * INDEX_STRUCT.size)
+            _, offset, length, self.segment, _, _ = INDEX_STRUCT.unpack(f.read(INDEX_STRUCT.size))
+        self.offset = offset + length
+        self.segment_file = open(os.path.join(self.directory, segment_filename(self.segment)), "r+b", buffering=0)
+        self.segment_file.seek(self.offset)
+
+    def write_meta(self):
+        meta = {
+            "version": ARCHIVE_VERSION,
+            "topics": sorted(self.topics, key=self.topics.get),
+            "encodings": sorted(self.encodings, key=self.encodings.get),
+        }
+        # Write-then-rename, so a reader never sees a half-written meta.json.
+        path = os.path.join(self.directory, META_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def lookup(self, table, name):
+        if name not in table:
+            table[name] = len(table)
+            self.write_meta()
+        return table[name]
+
+    def close_segment(self):
+        if self.segment_file is not None:
+            # Give back the preallocated space that was not used.
+            self.segment_file.truncate(self.offset)
+            self.segment_file.close()
+            self.segment_file = None
+
+    def open_segment(self, min_size):
+        self.close_segment()
+        self.segment += 1
+        self.offset = 0
+        path = os.path.join(self.directory, segment_filename(self.segment))
+        self.segment_file = open(path, "w+b", buffering=0)
+        size = max(self.segment_size, min_size)
+        try:
+            os.posix_fallocate(self.segment_file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # Not supported by this platform or file system, reserve the size without allocating blocks.
+            self.segment_file.truncate(size)
+
+    def append(self, topic, stamp_ns, encoding, payload):
+        """
+        Append one encoded frame (any bytes-like object) and return its index.
+        """
+        payload = memoryview(payload).cast("B")
+        length = payload.nbytes
+        with self.lock:
+            if self.segment_file is None or self.offset + length > self.segment_size:
+                self.open_segment(length)
+            written = 0
+            while written < length:
+                written += self.segment_file.write(payload[written:])
+            self.index_file.write(INDEX_STRUCT.pack(
+                stamp_ns, self.offset, length, self.segment,
+                self.lookup(self.topics, topic), self.lookup(self.encodings, encoding)
+            ))
+            self.offset += length
+            self.num_frames += 1
+            return self.num_frames - 1
+
+    def flush(self):
+        with self.lock:
+            self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+            self.index_file.close()
+            self.write_meta()
+
+
+class FrameArchiveReader:
+    """
+    Random access to the frames of an archive. Segments are memory-mapped, so Frame.data is a memoryview into the
+    page cache rather than a copy.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILENAME)) as f:
+            meta = json.load(f)
+        if meta["version"] != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported archive version: {meta['version']}")
+        self.topics = meta["topics"]
+        self.encodings = meta["encodings"]
+
+        with open(os.path.join(directory, INDEX_FILENAME), "rb") as f:
+            raw = f.read()
+        # Ignore a partially written last record.
+        usable = len(raw) - len(raw) % INDEX_DTYPE.itemsize
+        self.index = np.frombuffer(raw[:usable], dtype=INDEX_DTYPE)
+        self.segments = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def segment(self, segment):
+        if segment not in self.segments:
+            with open(os.path.join(self.directory, segment_filename(segment)), "rb") as f:
+                self.segments[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.segments[segment]
+
+    def __getitem__(self, i):
+        record = self.index[i]
+        start = int(record["offset"])
+        data = memoryview(self.segment(int(record["segment"])))[start:start + int(record["length"])]
+        return Frame(self.topics[record["topic"]], int(record["stamp_ns"]), self.encodings[record["encoding"]], data)
+
+    def select(self, topic=None, start_ns=None, end_ns=None):
+        """
+        Indices of the frames of a topic (all topics if None) within [start_ns, end_ns), in header stamp order.
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        if topic is not None:
+            mask &= self.index["topic"] == self.topics.index(topic)
+        if start_ns is not None:
+            mask &= self.index["stamp_ns"] >= start_ns
+        if end_ns is not None:
+            mask &= self.index["stamp_ns"] < end_ns
+        indices = np.flatnonzero(mask)
+        return indices[np.argsort(self.index["stamp_ns"][indices], kind="stable")]
+
+    def frames(self, topic=None):
+        for i in self.select(topic):
+            yield self[i]
+
+    def close(self):
+        segments, self.segments = self.segments, {}
+        for segment in segments.values():
+            try:
+                segment.close()
+            except BufferError:
+                # A Frame.data still points into this segment, it is unmapped once the last one is released.
+                pass
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python3 frame_archive.py <archive_directory>")
+        sys.exit(1)
+
+    reader = FrameArchiveReader(sys.argv[1])
+    print(f"{len(reader)} frames")
+    for topic_id, topic in enumerate(reader.topics):
+        records = reader.index[reader.index["topic"] == topic_id]
+        if len(records) == 0:
+            continue
+        duration = (records["stamp_ns"].max() - records["stamp_ns"].min()) / 1e9
+        print(f"  {topic}: {len(records)} frames, {records['length'].sum() / 1e6:.1f} MB, {duration:.1f} s")
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
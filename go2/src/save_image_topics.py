@@ -3,108 +3,836 @@
 Simple script to save images from ROS2 topics to files.
 This is useful for visualizing image topics without a display.
 
+Topics ending with "/compressed" or "/compressedDepth" are subscribed as sensor_msgs/CompressedImage and their
+JPEG/PNG payload is written to disk as-is, without decoding and re-encoding. Encoding and disk writes run on a pool of
+writer threads, never in the ROS callback.
+
+With --output-format archive, frames are appended to large segment files with a compact index instead of one file
+per frame (see frame_archive.py, which can also read them back).
+
+Depth topics are stored losslessly as 16-bit PNG (fast compression by default) or, with --depth-codec zstd, as
+row-delta + zstd frames (see decode_depth_zstd). An 8-bit normalized preview is only rendered every
+--depth-preview-every frames.
+
+With --sync-slop, frames of all topics are matched by header stamp (e.g. color/depth pairs) and only complete sets
+are saved, with a shared "pair" prefix in the filenames.
+
+Capture policies decide which frames are saved at all: --every-n, --max-rate (by header stamp) and
+--change-threshold, which skips frames that barely differ from the last saved one. Change detection compares ~64
+pixel wide grayscale thumbnails, taken with a strided view of raw images or a reduced-size decode of compressed ones,
+so skipped frames are never fully decoded. --policy overrides the defaults for one topic. With --sync-slop, the
+policy of the first topic decides for the whole set.
+
+Callbacks run on a MultiThreadedExecutor with one callback group per topic, so a slow topic does not hold back the
+others. Subscriptions are best-effort by default (--qos-reliability, --qos-depth).
+
+With --shm-ring NAME, every received frame is also decoded once and published into a shared-memory ring per topic
+(see shm_frame_ring.py), where other processes on the same machine can read the newest frame without copying it.
+
 Usage:
     python3 save_image_topics.py /camera/camera/color/image_raw
     python3 save_image_topics.py /camera/camera/color/image_raw /camera/camera/aligned_depth_to_color/image_raw
+    python3 save_image_topics.py /camera/camera/color/image_raw/compressed
+    python3 save_image_topics.py --writers 4 --queue-size 64 --backpressure block /camera/camera/color/image_raw
+    python3 save_image_topics.py --output-format archive /camera/camera/color/image_raw/compressed
+    python3 save_image_topics.py --depth-preview-every 30 /camera/camera/aligned_depth_to_color/image_raw
+    python3 save_image_topics.py --sync-slop 0.01 /camera/camera/color/image_raw \
+        /camera/camera/aligned_depth_to_color/image_raw
+    python3 save_image_topics.py --shm-ring go2_frames /camera/camera/color/image_raw
+    python3 save_image_topics.py --change-threshold 4 --policy /camera/camera/color/image_raw/compressed:rate=2 \
+        /camera/camera/color/image_raw/compressed
 """
 
+import argparse
+import bisect
+import struct
 import sys
+import threading
+import time
+from collections import deque
+
 import rclpy
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
-from sensor_msgs.msg import Image
+from rclpy.qos import HistoryPolicy, QoSProfile, ReliabilityPolicy
+from rclpy.utilities import remove_ros_args
+from sensor_msgs.msg import CompressedImage, Image
 from cv_bridge import CvBridge
 import cv2
 import numpy as np
 import os
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from frame_archive import DEFAULT_SEGMENT_SIZE, FrameArchiveWriter, stamp_to_ns
+from shm_frame_ring import DEFAULT_NUM_SLOTS, FrameRingWriter, ring_name
+
+
+# Encodings that can be viewed directly from the message buffer: encoding -> (dtype, channels)
+RAW_ENCODINGS = {
+    'rgb8': (np.uint8, 3),
+    'bgr8': (np.uint8, 3),
+    'rgba8': (np.uint8, 4),
+    'bgra8': (np.uint8, 4),
+    'mono8': (np.uint8, 1),
+    '8UC1': (np.uint8, 1),
+    '8UC3': (np.uint8, 3),
+    'mono16': (np.uint16, 1),
+    '16UC1': (np.uint16, 1),
+    '32FC1': (np.float32, 1),
+}
+
+# Conversions to the BGR layout that cv2.imencode expects for color images.
+TO_BGR = {
+    'rgb8': cv2.COLOR_RGB2BGR,
+    'rgba8': cv2.COLOR_RGBA2BGR,
+    'bgra8': cv2.COLOR_BGRA2BGR,
+}
+
+# Encodings of the images returned by cv2.imdecode(..., cv2.IMREAD_UNCHANGED): channels -> encoding
+DECODED_ENCODINGS = {
+    1: 'mono8',
+    3: 'bgr8',
+    4: 'bgra8',
+}
+
+# Header that image_transport's compressedDepth format puts in front of the PNG/RVL payload.
+COMPRESSED_DEPTH_HEADER_SIZE = 12
+
+
+STATS_PERIOD = 5.0  # seconds
+
+OUTPUT_FILES = 'files'
+OUTPUT_ARCHIVE = 'archive'
+
+DEPTH_CODEC_PNG = 'png'
+DEPTH_CODEC_ZSTD = 'zstd'
+DEPTH_ZSTD_EXTENSION = 'zdepth'
+DEPTH_ZSTD_HEADER = struct.Struct('<4sII')  # magic, height, width
+DEPTH_ZSTD_MAGIC = b'DZS1'
+DEFAULT_PNG_COMPRESSION = 1  # 0-9. Depth PNGs barely shrink past 1 but take several times longer to encode.
+
+QOS_RELIABILITY = {
+    'best_effort': ReliabilityPolicy.BEST_EFFORT,
+    'reliable': ReliabilityPolicy.RELIABLE,
+}
+DEFAULT_QOS_DEPTH = 10
+
+THUMBNAIL_WIDTH = 64  # pixels, approximate width of the images compared by change detection
+
+# --policy keys -> CapturePolicy arguments
+POLICY_KEYS = {
+    'rate': ('max_rate', float),
+    'every': ('every_n', int),
+    'change': ('change_threshold', float),
+}
+
+
+def write_bytes(filename, payload):
+    with open(filename, 'wb') as f:
+        f.write(payload)
+
+
+class FrameWriterPool:
+    """
+    Bounded queue of write jobs served by a pool of threads, so that encoding and disk I/O never block the ROS
+    executor. cv2.imencode and file writes release the GIL, so threads are enough to keep several cores busy.
+
+    When the queue is full, the backpressure policy decides what happens to a new job:
+
+    - "drop-oldest": discard the oldest queued job to make room (keeps the saved stream as fresh as possible).
+    - "drop-newest": discard the new job.
+    - "block": wait until a worker frees a slot. This stalls the ROS callback, and DDS drops frames upstream instead.
+    """
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    BLOCK = 'block'
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+    def __init__(self, logger, num_workers=2, max_queue=32, policy=DROP_OLDEST):
+        assert num_workers >= 1 and max_queue >= 1
+        assert policy in self.POLICIES, policy
+        self.logger = logger
+        self.max_queue = max_queue
+        self.policy = policy
+
+        self.jobs = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.workers = [
+            threading.Thread(target=self.worker, name=f"FrameWriter-{i}", daemon=True) for i in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, description, job):
+        """
+        Queue job() for a writer thread. description names the job in error messages (e.g. the filename).
+        Return False if the job was dropped.
+        """
+        with self.lock:
+            if len(self.jobs) >= self.max_queue:
+                if self.policy == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.policy == self.DROP_OLDEST:
+                    self.jobs.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.jobs) >= self.max_queue and not self.closed:
+                        self.not_full.wait()
+            if self.closed:
+                self.dropped += 1
+                return False
+            self.jobs.append((description, job))
+            self.not_empty.notify()
+            return True
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while not self.jobs and not self.closed:
+                    self.not_empty.wait()
+                if not self.jobs:
+                    return
+                description, job = self.jobs.popleft()
+                self.not_full.notify()
+
+            try:
+                job()
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                self.logger.error(f"Error writing {description}: {str(e)}")
+            else:
+                with self.lock:
+                    self.written += 1
+                self.logger.debug(f"Saved: {description}")
+
+    def queue_size(self):
+        return len(self.jobs)
+
+    def close(self):
+        """
+        Stop accepting jobs, write what is still queued and wait for the workers.
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+class ApproximateTimeSynchronizer:
+    """
+    Matches messages of several topics by header stamp and calls callback(msgs) with one message per topic (in the
+    order of topics) whose stamps are all within slop of each other.
+
+    Each topic keeps a queue sorted by stamp, bounded to queue_size messages (the oldest is dropped when full). When a
+    message arrives, the closest stamp in every other queue is found by bisection, so a lookup costs O(log n) per
+    topic rather than a scan. If the stamps of the resulting set span at most slop (highest - lowest, also with three
+    or more topics), the set is emitted and every queue is trimmed up to and including its matched message. Messages
+    trimmed without being matched count as dropped.
+    """
+
+    def __init__(self, topics, slop_ns, callback, queue_size=10):
+        assert len(topics) >= 2 and queue_size >= 1
+        self.topics = list(topics)
+        self.slop_ns = slop_ns
+        self.callback = callback
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.stamps = {topic: [] for topic in self.topics}
+        self.msgs = {topic: [] for topic in self.topics}
+
+        self.received = {topic: 0 for topic in self.topics}
+        self.dropped = {topic: 0 for topic in self.topics}
+        self.matched = 0
+
+    def closest(self, topic, stamp_ns):
+        # Index of the queued message of topic closest to stamp_ns, or None if the queue is empty.
+        stamps = self.stamps[topic]
+        i = bisect.bisect_left(stamps, stamp_ns)
+        if i == len(stamps):
+            return i - 1 if stamps else None
+        if i > 0 and stamp_ns - stamps[i - 1] <= stamps[i] - stamp_ns:
+            return i - 1
+        return i
+
+    def add(self, topic, stamp_ns, msg):
+        with self.lock:
+            self.received[topic] += 1
+            stamps, msgs = self.stamps[topic], self.msgs[topic]
+            i = bisect.bisect_right(stamps, stamp_ns)
+            stamps.insert(i, stamp_ns)
+            msgs.insert(i, msg)
+            if len(stamps) > self.queue_size:
+                del stamps[0], msgs[0]
+                self.dropped[topic] += 1
+                i -= 1
+                if i < 0:
+                    # The new message itself was the oldest one.
+                    return
+
+            matches = {topic: i}
+            lowest = highest = stamp_ns
+            for other in self.topics:
+                if other == topic:
+                    continue
+                j = self.closest(other, stamp_ns)
+                if j is None:
+                    return
+                other_stamp = self.stamps[other][j]
+                lowest, highest = min(lowest, other_stamp), max(highest, other_stamp)
+                if highest - lowest > self.slop_ns:
+                    return
+                matches[other] = j
+
+            matched = tuple(self.msgs[t][matches[t]] for t in self.topics)
+            for t, j in matches.items():
+                self.dropped[t] += j  # Older messages that can no longer be matched.
+                del self.stamps[t][:j + 1], self.msgs[t][:j + 1]
+            self.matched += 1
+
+        self.callback(matched)
+
+    def stats(self):
+        with self.lock:
+            received = max(self.received.values())
+            return {
+                'matched': self.matched,
+                'match_rate': self.matched / received if received else 0.0,
+                'received': dict(self.received),
+                'dropped': dict(self.dropped),
+                'queued': {topic: len(stamps) for topic, stamps in self.stamps.items()},
+            }
+
+
+class CapturePolicy:
+    """
+    Decides which frames of one topic are saved. Checks run from the cheapest to the most expensive one:
+
+    - every_n: keep one frame out of every_n received.
+    - max_rate: skip frames whose header stamp is less than 1 / max_rate seconds after the last saved frame.
+    - change_threshold: skip frames whose thumbnail differs from the one of the last saved frame by less than this
+      mean absolute difference (in gray levels, or millimeters for raw 16-bit / float depth).
+
+    thumbnail(msg) returns a small float32 image, or None when it cannot be made cheaply (the frame is then kept).
+    """
+
+    def __init__(self, thumbnail, max_rate=None, every_n=1, change_threshold=None):
+        assert every_n >= 1
+        self.thumbnail = thumbnail
+        self.min_interval_ns = int(1e9 / max_rate) if max_rate else 0
+        self.every_n = every_n
+        self.change_threshold = change_threshold
+
+        self.received = 0
+        self.skipped = 0
+        self.last_saved_ns = None
+        self.last_thumbnail = None
+
+    def accept(self, msg, stamp_ns):
+        self.received += 1
+        if not stamp_ns:
+            stamp_ns = time.monotonic_ns()  # Unstamped messages are rate limited by arrival time.
+        if (self.received - 1) % self.every_n != 0:
+            self.skipped += 1
+            return False
+        # A stamp going backwards (e.g. a bag played in a loop) resets the rate limit.
+        if self.min_interval_ns and self.last_saved_ns is not None and \
+                0 <= stamp_ns - self.last_saved_ns < self.min_interval_ns:
+            self.skipped += 1
+            return False
+        if self.change_threshold is not None:
+            thumbnail = self.thumbnail(msg)
+            last = self.last_thumbnail
+            if thumbnail is not None and last is not None and thumbnail.shape == last.shape and \
+                    np.mean(np.abs(thumbnail - last)) < self.change_threshold:
+                self.skipped += 1
+                return False
+            self.last_thumbnail = thumbnail
+        self.last_saved_ns = stamp_ns
+        return True
+
+
+def depth_to_uint16(depth):
+    """
+    16-bit depth is returned as-is. Float depth (32FC1, in meters) is converted to millimeters, invalid pixels to 0.
+    """
+    if depth.dtype == np.uint16:
+        return depth
+    depth_mm = np.nan_to_num(depth * 1000.0, nan=0.0, posinf=0.0, neginf=0.0)
+    return np.clip(depth_mm, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+
+def encode_depth_zstd(depth, level=1):
+    """
+    Lossless 16-bit depth codec: horizontal delta (neighbouring pixels are close, so the residuals are small) followed
+    by zstd. Usually smaller than PNG and several times faster to encode.
+    """
+    height, width = depth.shape
+    delta = np.empty_like(depth)
+    delta[:, 0] = depth[:, 0]
+    np.subtract(depth[:, 1:], depth[:, :-1], out=delta[:, 1:])  # Wraps around in uint16, undone by decode.
+    payload = zstandard.ZstdCompressor(level=level).compress(delta.tobytes())
+    return DEPTH_ZSTD_HEADER.pack(DEPTH_ZSTD_MAGIC, height, width) + payload
+
+
+def decode_depth_zstd(blob):
+    magic, height, width = DEPTH_ZSTD_HEADER.unpack_from(blob)
+    if magic != DEPTH_ZSTD_MAGIC:
+        raise ValueError("Not a zstd depth frame")
+    raw = zstandard.ZstdDecompressor().decompress(bytes(blob[DEPTH_ZSTD_HEADER.size:]))
+    delta = np.frombuffer(raw, dtype=np.uint16).reshape(height, width)
+    return np.cumsum(delta, axis=1, dtype=np.uint16)
+
+
+def render_depth_preview(depth):
+    # Normalize depth image for visualization
+    preview = cv2.normalize(depth, None, 0, 255, cv2.NORM_MINMAX)
+    return preview.astype(np.uint8)
+
+
+def is_compressed_topic(topic):
+    # image_transport publishes color images on ".../compressed" and depth images on ".../compressedDepth".
+    return topic.rstrip('/').endswith(('/compressed', '/compressedDepth'))
+
+
+def image_msg_as_array(msg):
+    """
+    Return an ndarray that views the data of a sensor_msgs/Image without copying it, or None if the encoding is not
+    in RAW_ENCODINGS (or needs a byte swap). Row padding (step > width * pixel size) is skipped with strides, not
+    removed by a copy.
+    """
+    if msg.encoding not in RAW_ENCODINGS:
+        return None
+    dtype, channels = RAW_ENCODINGS[msg.encoding]
+    dtype = np.dtype(dtype)
+    if msg.is_bigendian != (sys.byteorder == 'big') and dtype.itemsize > 1:
+        return None
+    rows = np.frombuffer(memoryview(msg.data), dtype=np.uint8).reshape(msg.height, msg.step)
+    row_bytes = msg.width * channels * dtype.itemsize
+    image = rows[:, :row_bytes].view(dtype).reshape(msg.height, msg.width, channels)
+    return image[:, :, 0] if channels == 1 else image
+
+
+def image_thumbnail(msg):
+    """
+    Grayscale thumbnail of a sensor_msgs/Image, read through a strided view: only ~THUMBNAIL_WIDTH pixels per row are
+    touched and nothing is converted at full size.
+    """
+    image = image_msg_as_array(msg)
+    if image is None:
+        return None
+    step = max(1, msg.width // THUMBNAIL_WIDTH)
+    small = image[::step, ::step]
+    if small.ndim == 3:
+        return small[:, :, :3].mean(axis=2, dtype=np.float32)
+    if small.dtype != np.uint8:
+        small = depth_to_uint16(small)
+    return small.astype(np.float32)
+
+
+def compressed_thumbnail(msg):
+    """
+    Grayscale thumbnail of a sensor_msgs/CompressedImage. JPEG is decoded at 1/8 scale, which skips most of the work
+    of a full decode.
+    """
+    payload, extension = compressed_payload(msg)
+    if extension == 'rvl':
+        return None
+    small = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if small is None:
+        return None
+    step = max(1, small.shape[1] // THUMBNAIL_WIDTH)
+    return small[::step, ::step].astype(np.float32)
+
+
+def parse_capture_policy(spec):
+    """
+    Parse a --policy argument, "TOPIC:KEY=VALUE[,KEY=VALUE...]" with keys from POLICY_KEYS, into
+    (topic, CapturePolicy keyword arguments).
+    """
+    topic, sep, settings = spec.rpartition(':')
+    if not sep or not topic:
+        raise argparse.ArgumentTypeError(f"Expected TOPIC:KEY=VALUE[,KEY=VALUE...], got {spec!r}")
+    kwargs = {}
+    for setting in settings.split(','):
+        key, _, value = setting.partition('=')
+        if key not in POLICY_KEYS:
+            raise argparse.ArgumentTypeError(f"Unknown policy key {key!r}, expected one of {', '.join(POLICY_KEYS)}")
+        name, convert = POLICY_KEYS[key]
+        try:
+            kwargs[name] = convert(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid value for policy key {key!r}: {value!r}")
+    return topic, kwargs
+
+
+def compressed_payload(msg):
+    """
+    Return (payload, file extension) of a sensor_msgs/CompressedImage, as a memoryview of the message data.
+    """
+    data = memoryview(msg.data)
+    fmt = msg.format.lower()
+    if 'compresseddepth' in fmt:
+        data = data[COMPRESSED_DEPTH_HEADER_SIZE:]
+        if 'rvl' in fmt:
+            return data, 'rvl'
+    return data, ('png' if 'png' in fmt else 'jpg')
+
 
 class ImageSaver(Node):
-    def __init__(self, topics):
+    def __init__(self, topics, num_writers=2, queue_size=32, backpressure=FrameWriterPool.DROP_OLDEST,
+                 output_format=OUTPUT_FILES, segment_size=DEFAULT_SEGMENT_SIZE, depth_codec=DEPTH_CODEC_PNG,
+                 png_compression=DEFAULT_PNG_COMPRESSION, depth_preview_every=0, sync_slop=None,
+                 sync_queue_size=10, capture_policies=None, qos_reliability='best_effort',
+                 qos_depth=DEFAULT_QOS_DEPTH, shm_ring=None, shm_slots=DEFAULT_NUM_SLOTS):
         super().__init__('image_saver')
         self.bridge = CvBridge()
         self.topics = topics
         self.subscribers = []
         self.save_count = {}
-        
+        self.local = threading.local()  # Per writer thread: reused RGB -> BGR conversion output.
+        self.depth_codec = depth_codec
+        self.png_compression = png_compression
+        self.depth_preview_every = depth_preview_every
+        if depth_codec == DEPTH_CODEC_ZSTD and zstandard is None:
+            raise ImportError("--depth-codec zstd requires the zstandard package: pip3 install zstandard")
+
         # Create output directory
         self.output_dir = f"images_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         os.makedirs(self.output_dir, exist_ok=True)
         self.get_logger().info(f"Saving images to: {self.output_dir}")
-        
-        # Create subscribers for each topic
+        self.archive = None
+        if output_format == OUTPUT_ARCHIVE:
+            self.archive = FrameArchiveWriter(self.output_dir, segment_size=segment_size)
+
+        self.writer = FrameWriterPool(self.get_logger(), num_workers=num_writers, max_queue=queue_size,
+                                      policy=backpressure)
+        self.stats_timer = self.create_timer(STATS_PERIOD, self.report_stats)
+
+        self.synchronizer = None
+        self.num_synchronized = 0
+        if sync_slop is not None and len(topics) > 1:
+            self.synchronizer = ApproximateTimeSynchronizer(topics, int(sync_slop * 1e9), self.synchronized_callback,
+                                                            queue_size=sync_queue_size)
+
+        # Best-effort subscriptions match both best-effort and reliable publishers, and never make a camera driver
+        # retransmit frames that would be dropped here anyway.
+        qos = QoSProfile(history=HistoryPolicy.KEEP_LAST, depth=qos_depth,
+                         reliability=QOS_RELIABILITY[qos_reliability])
+        self.sync_lock = threading.Lock()
+
+        # Shared-memory rings, created on the first frame of each topic since their slot size is the frame size. A
+        # topic whose ring cannot be created or written (e.g. a later frame larger than the first) is disabled.
+        self.shm_ring = shm_ring
+        self.shm_slots = shm_slots
+        self.rings = {}
+        self.disabled_rings = set()
+
+        # Create subscribers for each topic. Each topic has its own mutually exclusive callback group: callbacks of
+        # one topic never overlap (CapturePolicy and save_count are per topic), callbacks of different topics run
+        # in parallel on the executor threads.
+        self.handlers = {}
+        self.policies = {}
+        self.callback_groups = {}
+        capture_policies = capture_policies or {}
         for topic in topics:
-            topic_name = topic.replace('/', '_').replace('_', '')
             self.save_count[topic] = 0
+            if is_compressed_topic(topic):
+                self.handlers[topic] = self.compressed_image_callback
+                thumbnail = compressed_thumbnail
+                msg_type = CompressedImage
+            else:
+                self.handlers[topic] = self.image_callback
+                thumbnail = image_thumbnail
+                msg_type = Image
+            self.policies[topic] = CapturePolicy(thumbnail, **capture_policies.get(topic, {}))
+            self.callback_groups[topic] = MutuallyExclusiveCallbackGroup()
             sub = self.create_subscription(
-                Image,
+                msg_type,
                 topic,
-                lambda msg, t=topic: self.image_callback(msg, t),
-                10
+                lambda msg, t=topic: self.message_callback(msg, t),
+                qos,
+                callback_group=self.callback_groups[topic]
             )
             self.subscribers.append(sub)
             self.get_logger().info(f"Subscribed to: {topic}")
-    
-    def image_callback(self, msg, topic):
+
+    def next_filename(self, topic, extension, stamp_ns, prefix=''):
+        topic_name = topic.replace('/', '_').replace('_', '')
+        self.save_count[topic] = self.save_count.get(topic, 0) + 1
+        # Name frames after their header stamp, so frames of different topics can be paired afterwards.
+        stamp = datetime.fromtimestamp(stamp_ns / 1e9) if stamp_ns else datetime.now()
+        timestamp = stamp.strftime('%Y%m%d_%H%M%S_%f')[:-3]
+        return f"{self.output_dir}/{prefix}{topic_name}_{self.save_count[topic]:04d}_{timestamp}.{extension}"
+
+    def report_stats(self):
+        if self.archive is not None:
+            self.archive.flush()
+        self.get_logger().info(
+            f"Written: {self.writer.written}, dropped: {self.writer.dropped}, failed: {self.writer.failed}, "
+            f"queued: {self.writer.queue_size()}"
+        )
+        skipped = {topic: policy.skipped for topic, policy in self.policies.items() if policy.skipped}
+        if skipped:
+            self.get_logger().info(f"Skipped by capture policy: {skipped}")
+        if self.synchronizer is not None:
+            stats = self.synchronizer.stats()
+            self.get_logger().info(
+                f"Synchronized sets: {stats['matched']} (match rate {stats['match_rate']:.1%}), "
+                f"dropped: {stats['dropped']}, queued: {stats['queued']}"
+            )
+
+    def message_callback(self, msg, topic):
+        stamp_ns = stamp_to_ns(msg.header.stamp)
+        if self.shm_ring is not None and topic not in self.disabled_rings:
+            try:
+                self.publish_frame(msg, topic, stamp_ns)
+            except Exception as e:
+                self.get_logger().error(f"Error publishing {topic} to shared memory: {str(e)}")
+        if self.synchronizer is not None:
+            self.synchronizer.add(topic, stamp_ns, msg)
+            return
+        try:
+            if not self.policies[topic].accept(msg, stamp_ns):
+                return
+        except Exception as e:
+            self.get_logger().error(f"Error evaluating capture policy of {topic}: {str(e)}")
+        self.handlers[topic](msg, topic)
+
+    def publish_frame(self, msg, topic, stamp_ns):
+        """
+        Decode a frame and copy it into the shared-memory ring of its topic. Runs on the callback group of the topic,
+        so each ring has a single writer.
+        """
+        if is_compressed_topic(topic):
+            payload, extension = compressed_payload(msg)
+            if extension == 'rvl':
+                return
+            image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise IOError(f"cv2.imdecode of {extension} failed")
+            channels = image.shape[2] if image.ndim == 3 else 1
+            encoding = '16UC1' if image.dtype == np.uint16 else DECODED_ENCODINGS[channels]
+        else:
+            image = image_msg_as_array(msg)
+            if image is None:
+                image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='passthrough')
+            encoding = msg.encoding
+
+        try:
+            ring = self.rings.get(topic)
+            if ring is None:
+                # A block of the same name can only be left over from a saver that did not shut down cleanly.
+                ring = self.rings[topic] = FrameRingWriter(ring_name(self.shm_ring, topic), image.nbytes,
+                                                           num_slots=self.shm_slots, replace=True)
+                self.get_logger().info(f"Publishing {topic} to shared memory ring: {ring.name}")
+            ring.publish(image, stamp_ns, encoding)
+        except (OSError, ValueError) as e:
+            # Would fail the same way on every frame: report it once and stop publishing this topic.
+            self.disabled_rings.add(topic)
+            self.get_logger().error(f"Stopped publishing {topic} to shared memory: {str(e)}")
+
+    def synchronized_callback(self, msgs):
+        # Called from the callback thread of whichever topic completed the set, so sets of different threads may
+        # arrive concurrently. Handlers only queue work for the writer pool, holding the lock here is cheap.
+        reference = self.topics[0]
+        with self.sync_lock:
+            try:
+                if not self.policies[reference].accept(msgs[0], stamp_to_ns(msgs[0].header.stamp)):
+                    return
+            except Exception as e:
+                self.get_logger().error(f"Error evaluating capture policy of {reference}: {str(e)}")
+            self.num_synchronized += 1
+            prefix = f"pair{self.num_synchronized:06d}_"
+            for topic, msg in zip(self.topics, msgs):
+                self.handlers[topic](msg, topic, prefix)
+
+    def save(self, topic, msg, extension, encode, prefix=''):
+        """
+        Queue a frame for the writer pool. encode() runs on a writer thread and returns the bytes to store.
+        """
+        stamp_ns = stamp_to_ns(msg.header.stamp)
+        if self.archive is None:
+            filename = self.next_filename(topic, extension, stamp_ns, prefix)
+            self.writer.submit(filename, lambda: write_bytes(filename, encode()))
+        else:
+            # Synchronized frames share their stamps within the slop, they are paired again with
+            # FrameArchiveReader.select.
+            self.save_count[topic] = self.save_count.get(topic, 0) + 1
+            self.writer.submit(f"{topic} @ {stamp_ns}",
+                               lambda: self.archive.append(topic, stamp_ns, extension, encode()))
+
+    def compressed_image_callback(self, msg, topic, prefix=''):
+        try:
+            payload, extension = compressed_payload(msg)
+            # The memoryview keeps msg alive until the payload is written.
+            self.save(topic, msg, extension, lambda: payload, prefix)
+
+        except Exception as e:
+            self.get_logger().error(f"Error processing image from {topic}: {str(e)}")
+
+    def to_bgr(self, image, encoding):
+        # Called on writer threads, so the conversion buffer is per thread.
+        shape = image.shape[:2] + (3,)
+        buffer = getattr(self.local, 'bgr_buffer', None)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.local.bgr_buffer = np.empty(shape, dtype=np.uint8)
+        return cv2.cvtColor(image, TO_BGR[encoding], dst=buffer)
+
+    def image_callback(self, msg, topic, prefix=''):
         try:
-            # Determine encoding based on topic name
-            if 'depth' in topic.lower():
-                # For depth images, use 16UC1 or passthrough
-                cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='passthrough')
-                # Normalize depth image for visualization
-                if cv_image.dtype != np.uint8:
-                    cv_image_normalized = cv2.normalize(cv_image, None, 0, 255, cv2.NORM_MINMAX)
-                    cv_image_normalized = cv_image_normalized.astype(np.uint8)
-                    cv_image = cv_image_normalized
-            else:
-                # For color images, try to get RGB8 encoding
-                try:
-                    cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='rgb8')
-                    # cv_bridge returns RGB, but OpenCV imwrite expects BGR for color images
-                    if len(cv_image.shape) == 3 and cv_image.shape[2] == 3:
-                        cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
-                except:
-                    # Fallback to passthrough if rgb8 doesn't work
-                    cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding='passthrough')
-            
-            # Generate filename
-            topic_name = topic.replace('/', '_').replace('_', '')
-            self.save_count[topic] += 1
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]
-            
             if 'depth' in topic.lower():
-                filename = f"{self.output_dir}/{topic_name}_{self.save_count[topic]:04d}_{timestamp}.png"
+                extension = DEPTH_ZSTD_EXTENSION if self.depth_codec == DEPTH_CODEC_ZSTD else 'png'
+                self.save(topic, msg, extension, lambda: self.encode_depth(msg), prefix)
+                if self.depth_preview_every and self.save_count[topic] % self.depth_preview_every == 0:
+                    self.save(topic + '/preview', msg, 'jpg', lambda: self.encode_depth_preview(msg), prefix)
             else:
-                filename = f"{self.output_dir}/{topic_name}_{self.save_count[topic]:04d}_{timestamp}.jpg"
-            
-            cv2.imwrite(filename, cv_image)
-            self.get_logger().info(f"Saved: {filename}")
-            
+                self.save(topic, msg, 'jpg', lambda: self.encode_color(msg), prefix)
+
         except Exception as e:
             self.get_logger().error(f"Error processing image from {topic}: {str(e)}")
 
+    def msg_to_array(self, msg, desired_encoding):
+        cv_image = image_msg_as_array(msg)
+        if cv_image is None:
+            # Exotic encoding (e.g. yuv422), let cv_bridge convert it.
+            cv_image = self.bridge.imgmsg_to_cv2(msg, desired_encoding=desired_encoding)
+        return cv_image
+
+    def encode_color(self, msg):
+        cv_image = self.msg_to_array(msg, 'bgr8')
+        if msg.encoding in TO_BGR:
+            # OpenCV expects BGR for color images
+            cv_image = self.to_bgr(cv_image, msg.encoding)
+        return self.imencode('.jpg', cv_image)
+
+    def encode_depth(self, msg):
+        depth = self.msg_to_array(msg, 'passthrough')
+        if depth.dtype != np.uint8:
+            # Keep metric depth: no normalization, no conversion to 8 bits.
+            depth = depth_to_uint16(depth)
+        if self.depth_codec == DEPTH_CODEC_ZSTD:
+            return encode_depth_zstd(np.ascontiguousarray(depth))
+        return self.imencode('.png', depth, [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+
+    def encode_depth_preview(self, msg):
+        return self.imencode('.jpg', render_depth_preview(self.msg_to_array(msg, 'passthrough')))
+
+    @staticmethod
+    def imencode(extension, image, params=()):
+        ok, encoded = cv2.imencode(extension, image, list(params))
+        if not ok:
+            raise IOError(f"cv2.imencode to {extension} failed")
+        return encoded
+
+    def close(self):
+        self.writer.close()
+        self.report_stats()
+        if self.archive is not None:
+            self.archive.close()
+        for ring in self.rings.values():
+            ring.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Save images from ROS2 topics to files.")
+    parser.add_argument("topics", nargs="+", help="Image topics, e.g. /camera/camera/color/image_raw")
+    parser.add_argument("--writers", type=int, default=2, help="Number of writer threads")
+    parser.add_argument("--queue-size", type=int, default=32, help="Maximum number of frames waiting to be written")
+    parser.add_argument("--backpressure", choices=FrameWriterPool.POLICIES, default=FrameWriterPool.DROP_OLDEST,
+                        help="What to do with a new frame when the write queue is full")
+    parser.add_argument("--output-format", choices=(OUTPUT_FILES, OUTPUT_ARCHIVE), default=OUTPUT_FILES,
+                        help="One image file per frame, or an append-only archive of segment files")
+    parser.add_argument("--segment-size", type=int, default=DEFAULT_SEGMENT_SIZE // (1024 * 1024),
+                        help="Size of archive segment files, in MB")
+    parser.add_argument("--depth-codec", choices=(DEPTH_CODEC_PNG, DEPTH_CODEC_ZSTD), default=DEPTH_CODEC_PNG,
+                        help="Lossless codec for 16-bit depth frames (zstd needs the zstandard package)")
+    parser.add_argument("--png-compression", type=int, default=DEFAULT_PNG_COMPRESSION, choices=range(10),
+                        help="PNG compression level for depth frames, 0-9")
+    parser.add_argument("--depth-preview-every", type=int, default=0,
+                        help="Also save an 8-bit preview of every N-th depth frame (0: never)")
+    parser.add_argument("--sync-slop", type=float, default=None,
+                        help="Only save sets of frames (one per topic) whose header stamps are within this many "
+                             "seconds of each other")
+    parser.add_argument("--sync-queue-size", type=int, default=10,
+                        help="Messages kept per topic while waiting for a match")
+    parser.add_argument("--every-n", type=int, default=1, help="Save one frame out of every N received")
+    parser.add_argument("--max-rate", type=float, default=None, help="Save at most this many frames per second")
+    parser.add_argument("--change-threshold", type=float, default=None,
+                        help="Skip frames whose thumbnail differs from the last saved one by less than this mean "
+                             "absolute difference (gray levels)")
+    parser.add_argument("--policy", type=parse_capture_policy, action="append", default=[],
+                        metavar="TOPIC:KEY=VALUE[,...]",
+                        help="Capture policy of one topic, overriding the defaults above. Keys: "
+                             "rate (Hz), every (N), change (threshold)")
+    parser.add_argument("--qos-reliability", choices=tuple(QOS_RELIABILITY), default='best_effort',
+                        help="Reliability of the image subscriptions")
+    parser.add_argument("--qos-depth", type=int, default=DEFAULT_QOS_DEPTH,
+                        help="Keep-last history depth of the image subscriptions")
+    parser.add_argument("--executor-threads", type=int, default=None,
+                        help="Number of executor threads (default: one per topic, plus one for timers)")
+    parser.add_argument("--shm-ring", default=None, metavar="NAME",
+                        help="Also publish decoded frames to shared memory rings named NAME_<topic>")
+    parser.add_argument("--shm-slots", type=int, default=DEFAULT_NUM_SLOTS,
+                        help="Number of frames kept in each shared memory ring")
+    return parser.parse_args(argv)
+
 
 def main(args=None):
     if len(sys.argv) < 2:
         print("Usage: python3 save_image_topics.py <topic1> [topic2] ...")
         print("Example: python3 save_image_topics.py /camera/camera/color/image_raw")
         sys.exit(1)
-    
-    topics = sys.argv[1:]
-    
+
+    options = parse_args(remove_ros_args(args=sys.argv)[1:])
+    default_policy = dict(max_rate=options.max_rate, every_n=options.every_n,
+                          change_threshold=options.change_threshold)
+    capture_policies = {topic: dict(default_policy) for topic in options.topics}
+    for topic, overrides in options.policy:
+        if topic not in capture_policies:
+            print(f"--policy topic {topic} is not one of the saved topics")
+            sys.exit(1)
+        capture_policies[topic].update(overrides)
+
     rclpy.init(args=args)
-    node = ImageSaver(topics)
-    
+    node = ImageSaver(options.topics, num_writers=options.writers, queue_size=options.queue_size,
+                      backpressure=options.backpressure, output_format=options.output_format,
+                      segment_size=options.segment_size * 1024 * 1024, depth_codec=options.depth_codec,
+                      png_compression=options.png_compression, depth_preview_every=options.depth_preview_every,
+                      sync_slop=options.sync_slop, sync_queue_size=options.sync_queue_size,
+                      capture_policies=capture_policies, qos_reliability=options.qos_reliability,
+                      qos_depth=options.qos_depth, shm_ring=options.shm_ring, shm_slots=options.shm_slots)
+    executor = MultiThreadedExecutor(num_threads=options.executor_threads or len(options.topics) + 1)
+    executor.add_node(node)
+
     try:
-        rclpy.spin(node)
+        executor.spin()
     except KeyboardInterrupt:
         pass
     finally:
-        node.get_logger().info(f"\nSaved {sum(node.save_count.values())} images total")
+        executor.shutdown()
+        node.close()
+        node.get_logger().info(f"\nSaved {node.writer.written} images total")
         node.destroy_node()
         rclpy.shutdown()
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Shared-memory ring of decoded image frames, filled by save_image_topics.py --shm-ring so that co-located processes
+(e.g. the RL environment publishing ACTION_TOPIC) can read the newest camera frame without a second DDS subscription
+and a second decode.
+
+One ring per topic, in a multiprocessing.shared_memory block:
+
+    ring header          RING_HEADER: magic, version, number of slots, slot payload capacity, frames published.
+    slot 0               SLOT_HEADER (sequence, frame index, stamp, shape, dtype, encoding) followed by the pixels.
+    slot 1
+    ...
+
+Each slot is guarded by a seqlock: the writer makes the slot sequence odd before touching the slot and even again
+once the frame is complete. A reader checks that the sequence is even and unchanged around its read, and retries
+otherwise, so a single writer never waits for readers. Frame n goes to slot n % num_slots, so a reader holding a
+zero-copy view of the newest frame has num_slots - 1 frame periods before that slot is overwritten.
+
+Usage:
+    python3 shm_frame_ring.py go2_frames /camera/camera/color/image_raw    # Print the newest frames of a ring
+"""
+
+import struct
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+RING_VERSION = 1
+RING_MAGIC = b"SFR1"
+
+DEFAULT_NUM_SLOTS = 4
+
+RING_HEADER = struct.Struct("<4sIIIQ")  # magic, version, num_slots, slot_capacity, count
+SLOT_HEADER = struct.Struct("<QQqIII8s16s")  # seq, index, stamp_ns, height, width, channels, dtype, encoding
+HEADER_ALIGN = 64  # bytes, headers and payloads start on their own cache line
+COUNT_OFFSET = 16
+assert RING_HEADER.size <= HEADER_ALIGN and SLOT_HEADER.size <= HEADER_ALIGN
+
+MAX_READ_ATTEMPTS = 100
+
+RingFrame = namedtuple("RingFrame", ["index", "seq", "stamp_ns", "encoding", "image"])
+
+
+def align(size):
+    return (size + HEADER_ALIGN - 1) // HEADER_ALIGN * HEADER_ALIGN
+
+
+def ring_name(name, topic):
+    # Shared memory names cannot contain "/".
+    return name + "_" + topic.strip("/").replace("/", "_")
+
+
+def attach_shared_memory(name):
+    """
+    Open an existing block without taking ownership of it: before Python 3.13, the resource tracker of every process
+    that opens a block unlinks it when that process exits, which would pull the ring from under the writer.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class FrameRingWriter:
+    """
+    Creates a ring and publishes frames into it. There must be a single writer per ring.
+
+    With replace=True, an existing block of the same name is unlinked first, e.g. one left behind by a writer that
+    crashed before close(). Readers still attached to it keep reading the old block.
+    """
+
+    def __init__(self, name, slot_capacity, num_slots=DEFAULT_NUM_SLOTS, replace=False):
+        assert num_slots >= 2
+        self.name = name
+        self.num_slots = num_slots
+        self.slot_capacity = slot_capacity
+        self.slot_size = HEADER_ALIGN + align(slot_capacity)
+        size = HEADER_ALIGN + num_slots * self.slot_size
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            if not replace:
+                raise
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.seqs = [0] * num_slots
+        self.count = 0
+        RING_HEADER.pack_into(self.shm.buf, 0, RING_MAGIC, RING_VERSION, num_slots, slot_capacity, 0)
+
+    def publish(self, image, stamp_ns, encoding):
+        """
+        Copy an image (any ndarray, strided views included) into the next slot and return its frame index.
+        """
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+        if image.nbytes > self.slot_capacity:
+            raise ValueError(f"Frame of {image.nbytes} bytes does not fit the {self.slot_capacity} byte slots of "
+                             f"ring {self.name}")
+
+        index = self.count
+        slot = index % self.num_slots
+        offset = HEADER_ALIGN + slot * self.slot_size
+        buf = self.shm.buf
+
+        self.seqs[slot] += 1  # Odd: slot being written.
+        SLOT_HEADER.pack_into(buf, offset, self.seqs[slot], index, stamp_ns, height, width, channels,
+                              image.dtype.str.encode(), encoding.encode())
+        np.ndarray(image.shape, dtype=image.dtype, buffer=buf, offset=offset + HEADER_ALIGN)[...] = image
+        self.seqs[slot] += 1  # Even: slot complete.
+        struct.pack_into("<Q", buf, offset, self.seqs[slot])
+
+        self.count += 1
+        struct.pack_into("<Q", buf, COUNT_OFFSET, self.count)
+        return index
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class FrameRingReader:
+    """
+    Reads the newest frame of a ring created by FrameRingWriter, from any process.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.shm = attach_shared_memory(name)
+        magic, version, self.num_slots, self.slot_capacity, _ = RING_HEADER.unpack_from(self.shm.buf, 0)
+        if magic != RING_MAGIC or version != RING_VERSION:
+            self.shm.close()
+            raise ValueError(f"{name} is not a version {RING_VERSION} frame ring")
+        self.slot_size = HEADER_ALIGN + align(self.slot_capacity)
+
+    def count(self):
+        # Number of frames published so far.
+        return struct.unpack_from("<Q", self.shm.buf, COUNT_OFFSET)[0]
+
+    def slot_offset(self, index):
+        return HEADER_ALIGN + index % self.num_slots * self.slot_size
+
+    def seq(self, frame):
+        return struct.unpack_from("<Q", self.shm.buf, self.slot_offset(frame.index))[0]
+
+    def is_valid(self, frame):
+        """
+        True if the slot of a frame returned by latest(copy=False) has not been overwritten since. Check it after
+        using the image.
+        """
+        return self.seq(frame) == frame.seq
+
+    def latest(self, newer_than=-1, copy=True):
+        """
+        Return the newest frame as a RingFrame, or None if no frame with an index above newer_than was published.
+
+        With copy=False, image is a view into shared memory: nothing is copied, but the frame must be checked with
+        is_valid() after use.
+        """
+        buf = self.shm.buf
+        for _ in range(MAX_READ_ATTEMPTS):
+            count = self.count()
+            if count == 0 or count - 1 <= newer_than:
+                return None
+            offset = self.slot_offset(count - 1)
+            seq, index, stamp_ns, height, width, channels, dtype, encoding = SLOT_HEADER.unpack_from(buf, offset)
+            if seq % 2 or index != count - 1:
+                continue  # Being written, or already reused for a newer frame.
+            shape = (height, width, channels) if channels > 1 else (height, width)
+            image = np.ndarray(shape, dtype=np.dtype(dtype.rstrip(b"\0").decode()), buffer=buf,
+                               offset=offset + HEADER_ALIGN)
+            if copy:
+                image = image.copy()
+            if struct.unpack_from("<Q", buf, offset)[0] != seq:
+                continue
+            return RingFrame(index, seq, stamp_ns, encoding.rstrip(b"\0").decode(), image)
+        raise TimeoutError(f"Could not read a consistent frame from ring {self.name}")
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # An image returned with copy=False still points into the ring, it is unmapped once released.
+            pass
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: python3 shm_frame_ring.py <ring_name> <topic>")
+        sys.exit(1)
+
+    reader = FrameRingReader(ring_name(sys.argv[1], sys.argv[2]))
+    last = -1
+    try:
+        while True:
+            frame = reader.latest(newer_than=last, copy=False)
+            if frame is not None:
+                latency = (time.time_ns() - frame.stamp_ns) / 1e6
+                print(f"frame {frame.index}: {frame.encoding} {frame.image.shape}, {latency:.1f} ms after stamp")
+                last = frame.index
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frame = None
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Microbenchmark of the per-tick cost of decoding a SportClient.GetState reply.
+
+Usage:
+    python3 tests/bench_state_decoder.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from example_send_action import STATE_KEYS, RobotStateDecoder  # noqa: E402
+
+NUMBER = 20000
+
+REPLY = {
+    "state": '{"data": "locomotion"}',
+    "bodyHeight": '{"data": 0.0}',
+    "footRaiseHeight": '{"data": 0.09}',
+    "speedLevel": '{"data": 0}',
+    "gait": '{"data": "walk"}',
+    "joystick": '{"data": "normal"}',
+    "dance": '{"data": "none"}',
+    "continuousGait": '{"data": "none"}',
+    "economicGait": '{"data": "none"}',
+}
+assert sorted(REPLY) == sorted(STATE_KEYS)
+
+
+def decode_with_eval():
+    # The previous implementation in update_robot_state().
+    state_map = dict(REPLY)
+    for key, value in state_map.items():
+        state_map[key] = eval(value)["data"]
+    return state_map
+
+
+def make_decode_changed():
+    # Every payload differs from the previous poll, so every key is parsed.
+    replies = [{k: v.replace("}", " " * (i % 2) + "}") for k, v in REPLY.items()} for i in range(2)]
+    decoder = RobotStateDecoder()
+    counter = [0]
+
+    def decode():
+        counter[0] += 1
+        decoder.decode(replies[counter[0] % 2])
+
+    return decode
+
+
+def make_decode_unchanged():
+    decoder = RobotStateDecoder()
+    decoder.decode(REPLY)
+
+    def decode():
+        # Payloads are fresh string objects on every reply, as they would be coming off the wire.
+        decoder.decode({k: "".join(v) for k, v in REPLY.items()})
+
+    return decode
+
+
+def report(name, fn):
+    seconds = min(timeit.repeat(fn, number=NUMBER, repeat=5)) / NUMBER
+    print("{:<32s} {:8.2f} us/tick".format(name, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    report("eval (before)", decode_with_eval)
+    report("RobotStateDecoder, all changed", make_decode_changed())
+    report("RobotStateDecoder, unchanged", make_decode_unchanged())
@@ -0,0 +1,72 @@
+"""
+Microbenchmark of the per-message cost of ActionPostprocessor.wireless_controller_handler.
+
+Usage:
+    python3 tests/bench_wireless_controller.py
+"""
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from example_send_action import (  # noqa: E402
+    CHORD_DOUBLE_TAP, CHORD_HOLD, KEY, KEY_L2_B, KEY_NAMES, ActionPostprocessor, ChordEngine, SimulatedClock
+)
+
+NUMBER = 200000
+
+
+def make_postprocessor(num_extra_bindings=0):
+    # Only what the handler touches, without the SDK clients of __init__.
+    postprocessor = ActionPostprocessor.__new__(ActionPostprocessor)
+    postprocessor.chords = ChordEngine(clock=SimulatedClock())
+    postprocessor.chords.register(KEY_L2_B, lambda: None)
+    postprocessor.chords.register("down", lambda: None, debounce=0.3)
+    postprocessor.chords.register("R2", lambda: None, kind=CHORD_HOLD)
+    for i in range(num_extra_bindings):
+        first, second = KEY_NAMES[i % 16], KEY_NAMES[(i * 7 + 3) % 16]
+        postprocessor.chords.register([first, "select", second], lambda: None, kind=CHORD_DOUBLE_TAP)
+    postprocessor.chords.compile()
+    return postprocessor
+
+
+def handle_with_dict(key_state, msg):
+    # The previous implementation: rebuild a 16-entry dict and a list of pressed keys on every message.
+    for i in range(16):
+        key_state[KEY_NAMES[i]] = (msg.keys & (1 << i)) >> i
+    pressed_keys = [key for key, state in key_state.items() if state == 1]
+    if key_state["L2"] == 1 and key_state["B"] == 1:
+        pass
+    if key_state["down"] == 1:
+        pass
+    return pressed_keys
+
+
+def report(name, fn):
+    seconds = min(timeit.repeat(fn, number=NUMBER, repeat=5)) / NUMBER
+    print("{:<48s} {:8.3f} us/message".format(name, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    held = SimpleNamespace(keys=KEY["R2"])  # R2 has a hold binding, evaluated on every message
+    idle = SimpleNamespace(keys=0)
+    toggling = [SimpleNamespace(keys=KEY["R2"]), SimpleNamespace(keys=KEY["R2"] | KEY["A"])]
+
+    key_state = {name: 0 for name in KEY_NAMES}
+    report("dict (before), unchanged keys", lambda: handle_with_dict(key_state, held))
+
+    for num_extra_bindings in (0, 32):
+        postprocessor = make_postprocessor(num_extra_bindings)
+        suffix = ", {} bindings".format(len(postprocessor.chords.bindings))
+        report("chords, no key held" + suffix, lambda: postprocessor.wireless_controller_handler(idle))
+        report("chords, hold in progress" + suffix, lambda: postprocessor.wireless_controller_handler(held))
+
+        counter = [0]
+
+        def toggle():
+            counter[0] += 1
+            postprocessor.wireless_controller_handler(toggling[counter[0] & 1])
+
+        report("chords, keys change every message" + suffix, toggle)
@@ -0,0 +1,105 @@
+"""
+Fakes shared by the tests: SDK clients that stand in for the robot, and a helper to wait for background threads.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+REAL_TIMEOUT = 5.0  # real seconds to wait for a background thread to catch up
+ROBOT_STATE = {"state": "locomotion", "bodyHeight": 0.32, "gait": "walk", "joystick": "normal"}
+
+
+class FakeSportClient:
+    """
+    Stands in for every SDK client: records the calls, replies with codes[method] (0 by default), and reports a
+    walking robot.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.codes = {}
+        self.lock = threading.Lock()  # Called from the dispatcher threads.
+
+    def SetTimeout(self, timeout):
+        pass
+
+    def Init(self):
+        pass
+
+    def GetState(self, keys):
+        with self.lock:
+            self.calls.append(("GetState", tuple(keys)))
+        return 0, {key: json.dumps({"data": ROBOT_STATE.get(key, 0)}) for key in keys}
+
+    def SwitchGet(self):
+        return 0, False
+
+    def __getattr__(self, method):
+        def call(*args):
+            with self.lock:
+                self.calls.append((method, args))
+            return self.codes.get(method, 0)
+        return call
+
+    def methods(self):
+        with self.lock:
+            return [method for method, _ in self.calls]
+
+
+class FakeSubscriber:
+    def __init__(self, topic, message_type):
+        pass
+
+    def Init(self, handler, depth):
+        pass
+
+    def Close(self):
+        pass
+
+
+def wait_until(predicate):
+    deadline = time.monotonic() + REAL_TIMEOUT
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out waiting for a background thread"
+        time.sleep(0.001)
+
+
+@pytest.fixture(name="wait_until")
+def wait_until_fixture():
+    return wait_until
+
+
+@pytest.fixture
+def fake_client():
+    return FakeSportClient()
+
+
+@pytest.fixture
+def fake_sdk(monkeypatch):
+    # The modules ActionPostprocessor imports the SDK clients from.
+    import example_send_action
+
+    modules = {
+        "unitree_sdk2py.go2.obstacles_avoid.obstacles_avoid_client": dict(ObstaclesAvoidClient=FakeSportClient),
+        "unitree_sdk2py.core.channel": dict(ChannelSubscriber=FakeSubscriber, ChannelFactoryInitialize=print),
+        "unitree_sdk2py.idl.unitree_go.msg.dds_": dict(WirelessController_=object),
+        "unitree_sdk2py.go2.sport.sport_client": dict(SportClient=FakeSportClient),
+    }
+    for name, attributes in modules.items():
+        parts = name.split(".")
+        for i in range(1, len(parts)):
+            package = ".".join(parts[:i])
+            if package not in sys.modules:
+                monkeypatch.setitem(sys.modules, package, types.ModuleType(package))
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        monkeypatch.setitem(sys.modules, name, module)
+    # RemixAction comes from the RL environment, only its names are used here.
+    monkeypatch.setattr(example_send_action, "RemixAction", types.SimpleNamespace(get_string=str), raising=False)
@@ -0,0 +1,175 @@
+"""
+ChordEngine on a SimulatedClock: press, hold and double-tap chords, exact matching and debouncing.
+
+Usage:
+    python3 -m pytest tests/test_chord_engine.py
+"""
+import pytest
+
+from example_send_action import (
+    CHORD_DOUBLE_TAP, CHORD_HOLD, KEY, KEY_L2_A, KEY_L2_B, ChordEngine, SimulatedClock, chord_mask
+)
+
+MESSAGE_PERIOD = 0.02  # The controller keeps publishing while keys are held.
+
+
+class Recorder:
+    def __init__(self, clock):
+        self.clock = clock
+        self.fired = []
+
+    def __call__(self, name):
+        return lambda: self.fired.append((name, self.clock.now()))
+
+    def names(self):
+        return [name for name, _ in self.fired]
+
+
+@pytest.fixture
+def engine():
+    clock = SimulatedClock()
+    return ChordEngine(clock), Recorder(clock)
+
+
+def hold(engine, keys, duration):
+    # Keep publishing the same mask for duration seconds.
+    for _ in range(round(duration / MESSAGE_PERIOD)):
+        engine.clock.advance(MESSAGE_PERIOD)
+        engine.handle(keys)
+
+
+def test_chord_mask():
+    assert chord_mask("L2+B") == chord_mask(["L2", "B"]) == chord_mask(KEY_L2_B) == KEY["L2"] | KEY["B"]
+    with pytest.raises(KeyError):
+        chord_mask("L2+Z")
+
+
+def test_press_fires_when_the_last_key_goes_down(engine):
+    engine, record = engine
+    engine.register("L2+B", record("estop"))
+    engine.register("L2+A", record("stand"))
+    engine.handle(KEY["L2"])
+    assert record.fired == []
+    engine.handle(KEY_L2_B)
+    assert record.names() == ["estop"]
+
+    # Held: the repeated messages, and pressing another key on top, do not fire again.
+    hold(engine, KEY_L2_B, 0.5)
+    engine.handle(KEY_L2_B | KEY["up"])
+    assert record.names() == ["estop"]
+
+    # Releasing B and pressing A completes the other chord while L2 stays down.
+    engine.handle(KEY["L2"])
+    engine.handle(KEY_L2_A)
+    engine.handle(KEY["L2"])
+    engine.handle(KEY_L2_B)
+    assert record.names() == ["estop", "stand", "estop"]
+
+
+def test_keys_pressed_together(engine):
+    engine, record = engine
+    engine.register("L2+B", record("estop"))
+    engine.register("B", record("b"))
+    engine.handle(KEY_L2_B)
+    assert sorted(record.names()) == ["b", "estop"]
+
+
+def test_hold_fires_once_after_hold_duration(engine):
+    engine, record = engine
+    engine.register("start", record("sit"), kind=CHORD_HOLD, hold_duration=1.0)
+    engine.clock.advance(1.0)
+    engine.handle(KEY["start"])
+    hold(engine, KEY["start"], 0.9)
+    assert record.fired == []
+    hold(engine, KEY["start"], 0.2)
+    # On the first message at least hold_duration after the press.
+    assert record.names() == ["sit"] and 2.0 - 1e-9 <= record.fired[0][1] <= 2.0 + MESSAGE_PERIOD + 1e-9
+    hold(engine, KEY["start"], 2.0)
+    assert len(record.fired) == 1
+
+    # Released early: nothing. Pressed again and held: fires again.
+    engine.handle(0)
+    engine.handle(KEY["start"])
+    hold(engine, KEY["start"], 0.5)
+    engine.handle(0)
+    hold(engine, 0, 1.0)
+    assert len(record.fired) == 1
+    engine.handle(KEY["start"])
+    hold(engine, KEY["start"], 1.1)
+    assert len(record.fired) == 2
+
+
+def test_double_tap(engine):
+    engine, record = engine
+    engine.register("select", record("toggle"), kind=CHORD_DOUBLE_TAP, double_tap_interval=0.4)
+
+    def tap(gap):
+        hold(engine, 0, gap)
+        engine.handle(KEY["select"])
+        engine.handle(0)
+
+    tap(1.0)
+    assert record.fired == []
+    tap(0.3)
+    assert record.names() == ["toggle"]
+    # A third tap starts a new double tap rather than completing another one with the second.
+    tap(0.3)
+    assert record.names() == ["toggle"]
+    tap(0.3)
+    assert record.names() == ["toggle", "toggle"]
+    # Too slow.
+    tap(1.0)
+    tap(0.5)
+    assert len(record.fired) == 2
+
+
+def test_exact_chord_rejects_extra_keys(engine):
+    engine, record = engine
+    engine.register("L2+B", record("exact"), exact=True)
+    engine.register("L2+B", record("loose"))
+    engine.handle(KEY_L2_B | KEY["R1"])
+    assert record.names() == ["loose"]
+    engine.handle(KEY["R1"])
+    engine.handle(0)
+    engine.handle(KEY_L2_B)
+    assert record.names() == ["loose", "exact", "loose"]
+
+
+def test_debounce(engine):
+    engine, record = engine
+    engine.register("A", record("jump"), debounce=0.5)
+
+    def press(gap):
+        hold(engine, 0, gap)
+        engine.handle(KEY["A"])
+        engine.handle(0)
+
+    press(0.2)
+    press(0.2)
+    press(0.2)
+    assert record.fired == [("jump", pytest.approx(0.2))]
+    # 0.6 s after the last firing, 0.2 s after the last press: suppressed presses do not restart the debounce window.
+    press(0.2)
+    assert record.fired == [("jump", pytest.approx(0.2)), ("jump", pytest.approx(0.8))]
+
+
+def test_failing_callback_does_not_stop_other_bindings(engine):
+    engine, record = engine
+
+    def fail():
+        raise RuntimeError("boom")
+
+    engine.register("B", fail)
+    engine.register("B", record("b"))
+    engine.handle(KEY["B"])
+    assert record.names() == ["b"]
+
+
+def test_registering_recompiles(engine):
+    engine, record = engine
+    engine.register("A", record("a"))
+    engine.handle(KEY["A"])
+    engine.handle(0)
+    engine.register("B", record("b"))
+    engine.handle(KEY["B"])
+    assert record.names() == ["a", "b"]
@@ -0,0 +1,143 @@
+"""
+CommandCoalescer in front of a CommandDispatcher and a fake SportClient: deduplication, keepalive resends, failed
+replies and posture resets.
+
+Usage:
+    python3 -m pytest tests/test_command_coalescer.py
+"""
+import pytest
+
+from example_send_action import (
+    CHANNEL_MODE, CHANNEL_VELOCITY, CODE_SUPERSEDED, CommandCoalescer, CommandDispatcher, SimulatedClock
+)
+
+KEEPALIVE = 0.5
+
+
+@pytest.fixture
+def clock():
+    return SimulatedClock()
+
+
+@pytest.fixture
+def make_coalescer(fake_client, clock, wait_until):
+    dispatchers = []
+
+    def make(keepalive_interval=KEEPALIVE, start=True):
+        dispatcher = CommandDispatcher(fake_client, max_in_flight=2, clock=clock)
+        if start:
+            dispatcher.start()
+        dispatchers.append(dispatcher)
+        commands = CommandCoalescer(dispatcher, keepalive_interval=keepalive_interval, clock=clock)
+
+        def settle():
+            # Wait for every submitted command to be replied to.
+            wait_until(lambda: dispatcher.stats.completed + dispatcher.stats.superseded == dispatcher.stats.submitted)
+        return commands, settle
+
+    yield make
+    for dispatcher in dispatchers:
+        dispatcher.close()
+
+
+def test_identical_commands_are_suppressed(make_coalescer, fake_client):
+    commands, settle = make_coalescer()
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is not None
+    settle()
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is None
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is None
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.6, 0.0, 0.0) is not None
+    settle()
+
+    assert fake_client.calls == [("Move", (0.5, 0.0, 0.0)), ("Move", (0.6, 0.0, 0.0))]
+    assert (commands.stats.sent, commands.stats.suppressed, commands.stats.failed) == (2, 2, 0)
+
+
+def test_in_flight_duplicates_are_suppressed(make_coalescer):
+    # The last command is remembered from the moment it is submitted, not only once it is acknowledged.
+    commands, settle = make_coalescer()
+    assert commands.send(CHANNEL_VELOCITY, "StopMove") is not None
+    assert commands.send(CHANNEL_VELOCITY, "StopMove") is None
+    settle()
+    assert commands.stats.suppressed == 1
+
+
+def test_channels_are_independent(make_coalescer, fake_client):
+    commands, settle = make_coalescer()
+    commands.send(CHANNEL_VELOCITY, "StopMove")
+    commands.send(CHANNEL_MODE, "BalanceStand")
+    settle()
+    assert commands.send(CHANNEL_MODE, "BalanceStand") is None
+    assert sorted(fake_client.methods()) == ["BalanceStand", "StopMove"]
+
+
+def test_keepalive_resends(make_coalescer, clock, fake_client):
+    commands, settle = make_coalescer()
+    commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0)
+    settle()
+    clock.advance(KEEPALIVE - 0.01)
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is None
+    clock.advance(0.01)
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is not None
+    settle()
+    assert fake_client.methods() == ["Move", "Move"]
+    assert (commands.stats.sent, commands.stats.suppressed) == (2, 1)
+
+
+def test_no_keepalive(make_coalescer, clock):
+    commands, settle = make_coalescer(keepalive_interval=None)
+    commands.send(CHANNEL_VELOCITY, "StopMove")
+    settle()
+    clock.advance(3600.0)
+    assert commands.send(CHANNEL_VELOCITY, "StopMove") is None
+
+
+def test_failed_command_is_sent_again(make_coalescer, fake_client):
+    commands, settle = make_coalescer()
+    fake_client.codes["Move"] = 3104
+    commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0)
+    settle()
+    assert commands.stats.failed == 1
+
+    fake_client.codes["Move"] = 0
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is not None
+    settle()
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0) is None
+    assert (commands.stats.sent, commands.stats.suppressed, commands.stats.failed) == (2, 1, 1)
+
+
+def test_resets_and_invalidate_forget_channels(make_coalescer):
+    commands, settle = make_coalescer()
+    commands.send(CHANNEL_VELOCITY, "StopMove")
+    settle()
+    # SwitchGait resets the posture, so the velocity channel has to be sent again once it is acknowledged.
+    commands.send(CHANNEL_MODE, "SwitchGait", 1, resets=(CHANNEL_VELOCITY,))
+    settle()
+    assert commands.send(CHANNEL_VELOCITY, "StopMove") is not None
+    settle()
+
+    commands.invalidate()
+    assert commands.send(CHANNEL_VELOCITY, "StopMove") is not None
+    assert commands.send(CHANNEL_MODE, "SwitchGait", 1) is not None
+    settle()
+    assert commands.stats.suppressed == 0
+
+
+def test_superseded_command_is_reported(make_coalescer, fake_client):
+    # Workers not started yet: the first Move is still queued when the second one replaces it.
+    commands, settle = make_coalescer(start=False)
+    replies = []
+    commands.send(CHANNEL_VELOCITY, "Move", 0.5, 0.0, 0.0, callback=lambda cmd, code: replies.append((cmd, code)))
+    assert replies == []
+    commands.send(CHANNEL_VELOCITY, "Move", 0.6, 0.0, 0.0, callback=lambda cmd, code: replies.append((cmd, code)))
+    assert [code for _, code in replies] == [CODE_SUPERSEDED]
+    assert replies[0][0].args == (0.5, 0.0, 0.0)
+
+    commands.dispatcher.start()
+    settle()
+    assert [code for _, code in replies] == [CODE_SUPERSEDED, 0]
+    assert fake_client.calls == [("Move", (0.6, 0.0, 0.0))]
+    assert commands.dispatcher.stats.superseded == 1 and commands.dispatcher.stats.failed == 0
+    assert commands.stats.failed == 0
+    # The replacement is what the robot acknowledged, so it is the one remembered.
+    assert commands.send(CHANNEL_VELOCITY, "Move", 0.6, 0.0, 0.0) is None
@@ -0,0 +1,94 @@
+"""
+FrameArchiveWriter / FrameArchiveReader round trip, including an archive reopened after a restart or a crash.
+
+Usage:
+    python3 -m pytest tests/test_frame_archive.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from frame_archive import (  # noqa: E402
+    INDEX_FILENAME, INDEX_STRUCT, FrameArchiveReader, FrameArchiveWriter, segment_filename
+)
+
+SEGMENT_SIZE = 1000
+
+
+def make_frames(start, count):
+    # (topic, stamp_ns, encoding, payload): two interleaved topics, of different sizes so segments fill unevenly.
+    frames = []
+    for i in range(start, start + count):
+        topic, encoding = ("/camera/color", "jpeg") if i % 2 == 0 else ("/camera/depth", "zstd")
+        frames.append((topic, 1_000_000 * i, encoding, bytes([i % 256]) * (100 + 37 * (i % 5))))
+    return frames
+
+
+def write(directory, frames, close=True):
+    writer = FrameArchiveWriter(str(directory), segment_size=SEGMENT_SIZE)
+    indices = [writer.append(*frame) for frame in frames]
+    if close:
+        writer.close()
+    else:
+        writer.flush()
+    return indices
+
+
+def read(directory):
+    reader = FrameArchiveReader(str(directory))
+    frames = [(frame.topic, frame.stamp_ns, frame.encoding, bytes(frame.data)) for frame in reader.frames()]
+    reader.close()
+    return frames
+
+
+def test_round_trip(tmp_path):
+    frames = make_frames(0, 30)
+    assert write(tmp_path, frames) == list(range(30))
+    assert read(tmp_path) == frames
+    assert os.path.exists(tmp_path / segment_filename(2))
+    # Closed segments give back their unused preallocated space.
+    assert all(os.path.getsize(tmp_path / name) <= SEGMENT_SIZE for name in os.listdir(tmp_path)
+               if name.startswith("segment_"))
+
+    reader = FrameArchiveReader(str(tmp_path))
+    depth = reader.select("/camera/depth", start_ns=10_000_000, end_ns=20_000_000)
+    assert [reader[i].stamp_ns for i in depth] == [11_000_000, 13_000_000, 15_000_000, 17_000_000, 19_000_000]
+    assert {reader[i].encoding for i in depth} == {"zstd"}
+    reader.close()
+
+
+def test_frames_are_sorted_by_stamp(tmp_path):
+    frames = make_frames(0, 6)
+    write(tmp_path, frames[::-1])
+    assert read(tmp_path) == frames
+
+
+def test_reopened_archive_is_appended_to(tmp_path):
+    first, second = make_frames(0, 15), make_frames(15, 15)
+    write(tmp_path, first)
+    assert write(tmp_path, second) == list(range(15, 30))
+    assert read(tmp_path) == first + second
+
+
+def test_new_topic_after_reopening(tmp_path):
+    write(tmp_path, make_frames(0, 4))
+    extra = ("/camera/ir", 100_000_000, "png", b"ir")
+    write(tmp_path, [extra])
+    reader = FrameArchiveReader(str(tmp_path))
+    assert reader.topics == ["/camera/color", "/camera/depth", "/camera/ir"]
+    assert reader.encodings == ["jpeg", "zstd", "png"]
+    assert reader[4].topic == "/camera/ir" and bytes(reader[4].data) == b"ir"
+    reader.close()
+
+
+def test_archive_of_a_crashed_recorder_is_resumed(tmp_path):
+    first, second = make_frames(0, 12), make_frames(12, 12)
+    write(tmp_path, first, close=False)  # Never closed: the last segment is still preallocated.
+    with open(tmp_path / INDEX_FILENAME, "ab") as f:
+        f.write(b"\xff" * (INDEX_STRUCT.size // 2))  # Partially written record
+    assert read(tmp_path) == first
+
+    assert write(tmp_path, second) == list(range(12, 24))
+    assert os.path.getsize(tmp_path / INDEX_FILENAME) == 24 * INDEX_STRUCT.size
+    assert read(tmp_path) == first + second
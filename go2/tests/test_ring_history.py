@@ -0,0 +1,137 @@
+"""
+RingHistory: wraparound, clear(), the vectorized queries, and the records a concurrent writer overwrites mid-read.
+
+Usage:
+    python3 -m pytest tests/test_ring_history.py
+"""
+import math
+
+import numpy as np
+import pytest
+
+from example_send_action import CONTINUOUS_ACTION, RingHistory
+
+DEFAULT = dict(time=0.0, vx=0.0, vy=0.0, vyaw=0.0, action=0)
+
+
+class RacingBuffer:
+    """
+    Stands in for RingHistory.buffer: the writer appends `appends` more records right after the first read of the
+    buffer, as if it ran between the reader's copy and its check of count.
+    """
+
+    def __init__(self, history, appends):
+        self.history = history
+        self.records = history.buffer
+        self.appends = appends
+
+    def __getattr__(self, name):
+        return getattr(self.records, name)
+
+    def __getitem__(self, index):
+        record = self.records[index]
+        if self.appends:
+            appends, self.appends = self.appends, 0
+            for _ in range(appends):
+                self.history.append(self.history.count)
+        return record
+
+
+def filled(capacity, count):
+    # Record i has time i and vx 10 * i.
+    history = RingHistory(DEFAULT, capacity=capacity)
+    for i in range(count):
+        history.append(float(i), vx=10.0 * i)
+    return history
+
+
+def test_empty_history_returns_default():
+    history = RingHistory(dict(DEFAULT, action=7), capacity=3)
+    assert len(history) == 0
+    assert history[0].action == 7 and history[-1].action == 7
+    assert len(history.window()) == 0
+    assert math.isnan(history.mean("vx", 1.0, now=0.0))
+
+
+def test_wraparound_keeps_the_newest_records():
+    history = filled(capacity=4, count=11)
+    assert len(history) == 4
+    assert list(history.window().time) == [7.0, 8.0, 9.0, 10.0]
+    assert [history[i].time for i in range(4)] == [7.0, 8.0, 9.0, 10.0]
+    assert history[-1].time == 10.0 and history[-4].time == 7.0
+    assert [record.time for record in reversed(history)] == [10.0, 9.0, 8.0, 7.0]
+    with pytest.raises(IndexError):
+        history[4]
+    with pytest.raises(IndexError):
+        history[-5]
+
+
+def test_records_are_copies():
+    history = filled(capacity=2, count=2)
+    record, window = history[-1], history.window()
+    history.append(2.0, vx=20.0)
+    history.append(3.0, vx=30.0)
+    assert record.time == 1.0 and list(window.time) == [0.0, 1.0]
+
+
+def test_clear():
+    history = filled(capacity=4, count=6)
+    history.clear()
+    assert len(history) == 0 and history[-1].time == DEFAULT["time"]
+    history.append(6.0, vx=60.0, vyaw=0.5, action=CONTINUOUS_ACTION)
+    assert len(history) == 1
+    assert history[0].time == 6.0 and history[0].action == CONTINUOUS_ACTION
+    assert list(history.window().vx) == [60.0]
+
+
+def test_valid_range_of_a_stale_count():
+    # A reader that sampled count before the writer appended capacity more records must drop all it saw.
+    history = filled(capacity=4, count=6)
+    count = history.count
+    assert history.valid_range(count) == (2, 6)
+    for i in range(6, 10):
+        history.append(float(i))
+    assert history.valid_range(count)[1] <= history.count - history.capacity
+    assert history.valid_range(history.count) == (6, 10)
+
+
+@pytest.mark.parametrize("appends, index, time", [(1, 1, 3.0), (1, -1, 5.0), (3, 3, 5.0)])
+def test_getitem_outside_overwritten_records(appends, index, time):
+    history = filled(capacity=4, count=6)
+    history.buffer = RacingBuffer(history, appends)
+    assert history[index].time == time
+
+
+@pytest.mark.parametrize("appends, index", [(1, 0), (2, 1), (4, -1)])
+def test_getitem_detects_overwrite(appends, index):
+    history = filled(capacity=4, count=6)
+    history.buffer = RacingBuffer(history, appends)
+    with pytest.raises(IndexError):
+        history[index]
+
+
+def test_window_drops_overwritten_records():
+    history = filled(capacity=4, count=6)
+    history.buffer = RacingBuffer(history, 2)
+    # Records 2 to 5 were copied, then 6 and 7 overwrote the slots of 2 and 3.
+    assert list(history.window().time) == [4.0, 5.0]
+
+
+def test_since_and_mean():
+    history = filled(capacity=8, count=20)
+    assert list(history.since(17.0).time) == [17.0, 18.0, 19.0]
+    assert len(history.since(20.5)) == 0
+    assert history.mean("vx", 2.0, now=19.0) == pytest.approx(180.0)
+    # Only the valid window counts, however long the duration.
+    assert history.mean("vx", 100.0, now=19.0) == pytest.approx(np.mean(np.arange(12, 20)) * 10.0)
+    assert math.isnan(history.mean("vx", 1.0, now=100.0))
+
+
+def test_mean_skips_missing_values():
+    history = RingHistory(DEFAULT, capacity=4)
+    history.append(0.0, vx=1.0, action=1)
+    history.append(1.0, vyaw=0.5, action=0)  # vx not given: NaN
+    history.append(2.0, vx=3.0, action=1)
+    assert history.mean("vx", 5.0, now=2.0) == pytest.approx(2.0)
+    assert history.mean("vyaw", 5.0, now=2.0) == pytest.approx(0.5)
+    assert history.mean("action", 5.0, now=2.0) == pytest.approx(2 / 3)
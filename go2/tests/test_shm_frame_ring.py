@@ -0,0 +1,99 @@
+"""
+FrameRingWriter / FrameRingReader round trip through shared memory: wraparound, newer_than, and reused slots.
+
+Usage:
+    python3 -m pytest tests/test_shm_frame_ring.py
+"""
+import os
+import sys
+import uuid
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from shm_frame_ring import FrameRingReader, FrameRingWriter, ring_name  # noqa: E402
+
+HEIGHT, WIDTH = 4, 6
+NUM_SLOTS = 3
+
+
+def make_image(i, channels=3):
+    shape = (HEIGHT, WIDTH, channels) if channels > 1 else (HEIGHT, WIDTH)
+    return np.full(shape, i % 256, dtype=np.uint8)
+
+
+@pytest.fixture
+def ring():
+    name = ring_name("test_" + uuid.uuid4().hex[:8], "/camera/color/image_raw")
+    writer = FrameRingWriter(name, slot_capacity=HEIGHT * WIDTH * 3, num_slots=NUM_SLOTS)
+    reader = FrameRingReader(name)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def test_ring_name():
+    assert ring_name("go2_frames", "/camera/color/image_raw") == "go2_frames_camera_color_image_raw"
+
+
+def test_round_trip(ring):
+    writer, reader = ring
+    assert reader.latest() is None and reader.count() == 0
+
+    color = np.arange(HEIGHT * WIDTH * 3, dtype=np.uint8).reshape(HEIGHT, WIDTH, 3)
+    assert writer.publish(color, 1_000, "rgb8") == 0
+    frame = reader.latest()
+    assert (frame.index, frame.stamp_ns, frame.encoding) == (0, 1_000, "rgb8")
+    np.testing.assert_array_equal(frame.image, color)
+
+    # Single channel, another dtype, and a strided view.
+    depth = np.arange(HEIGHT * WIDTH * 2, dtype=np.uint16).reshape(HEIGHT, WIDTH * 2)[:, ::2]
+    writer.publish(depth, 2_000, "16UC1")
+    frame = reader.latest()
+    assert frame.image.dtype == np.uint16 and frame.encoding == "16UC1"
+    np.testing.assert_array_equal(frame.image, depth)
+
+
+def test_wraparound_returns_the_newest_frame(ring):
+    writer, reader = ring
+    for i in range(2 * NUM_SLOTS + 1):
+        assert writer.publish(make_image(i), 1_000 * i, "rgb8") == i
+        frame = reader.latest()
+        assert frame.index == i and frame.stamp_ns == 1_000 * i
+        np.testing.assert_array_equal(frame.image, make_image(i))
+    assert reader.count() == 2 * NUM_SLOTS + 1
+
+
+def test_newer_than(ring):
+    writer, reader = ring
+    writer.publish(make_image(0), 0, "rgb8")
+    writer.publish(make_image(1), 1, "rgb8")
+    assert reader.latest(newer_than=0).index == 1
+    assert reader.latest(newer_than=1) is None
+    writer.publish(make_image(2), 2, "rgb8")
+    assert reader.latest(newer_than=1).index == 2
+
+
+def test_view_is_invalid_once_its_slot_is_reused(ring):
+    writer, reader = ring
+    writer.publish(make_image(0), 0, "rgb8")
+    frame = reader.latest(copy=False)
+    copied = reader.latest()
+    for i in range(1, NUM_SLOTS):
+        writer.publish(make_image(i), i, "rgb8")
+        assert reader.is_valid(frame)
+    np.testing.assert_array_equal(frame.image, make_image(0))
+
+    writer.publish(make_image(NUM_SLOTS), NUM_SLOTS, "rgb8")  # Lands in the slot of frame 0.
+    assert not reader.is_valid(frame)
+    np.testing.assert_array_equal(copied.image, make_image(0))
+    frame = None  # Release the view before the reader unmaps the ring.
+
+
+def test_oversized_frame_is_rejected(ring):
+    writer, reader = ring
+    with pytest.raises(ValueError):
+        writer.publish(np.zeros((HEIGHT + 1, WIDTH, 3), dtype=np.uint8), 0, "rgb8")
+    assert reader.count() == 0 and reader.latest() is None
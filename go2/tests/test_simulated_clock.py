@@ -0,0 +1,212 @@
+"""
+Runs the postprocessing pipeline on a SimulatedClock, with fake SDK clients in place of the robot (see conftest.py).
+
+Usage:
+    python3 -m pytest tests/test_simulated_clock.py
+"""
+import threading
+import time
+
+import pytest
+
+from example_send_action import (
+    CHANNEL_VELOCITY, TICK_HYBRID, TICK_PERIODIC, ActionPostprocessor, Clock, FixedRateScheduler, HeartbeatWatchdog,
+    RobotStatePoller, SimulatedClock
+)
+
+CONTROL_PERIOD = 0.02
+
+
+def test_clock_is_abstract():
+    with pytest.raises(TypeError):
+        Clock()
+
+
+def test_scheduler_runs_on_simulated_time():
+    clock = SimulatedClock()
+    scheduler = FixedRateScheduler(rate_hz=1 / CONTROL_PERIOD, clock=clock)
+    deadlines = [scheduler.wait() for _ in range(50)]
+    assert deadlines == pytest.approx([CONTROL_PERIOD * (i + 1) for i in range(50)])
+    assert clock.now() == deadlines[-1]
+    assert scheduler.stats.overruns == 0 and scheduler.stats.max_jitter == 0.0
+
+
+def test_tick_on_its_deadline_is_not_an_overrun():
+    clock = SimulatedClock()
+    scheduler = FixedRateScheduler(rate_hz=1 / CONTROL_PERIOD, clock=clock)
+    scheduler.wait()
+    clock.advance(CONTROL_PERIOD)  # The tick took exactly one period: the next one is due right now.
+    assert scheduler.wait() == clock.now()
+    assert scheduler.stats.overruns == 0 and scheduler.stats.max_jitter == 0.0
+
+    clock.advance(CONTROL_PERIOD * 1.5)
+    scheduler.wait()
+    assert scheduler.stats.overruns == 1
+
+
+def test_mean_jitter_ignores_woken_ticks():
+    clock = SimulatedClock()
+    scheduler = FixedRateScheduler(rate_hz=1 / CONTROL_PERIOD, clock=clock)
+    wake = threading.Event()
+    scheduler.wait(wake=wake)
+    clock.advance(0.03)  # The next tick is 10 ms late.
+    scheduler.wait(wake=wake)
+    wake.set()
+    scheduler.wait(wake=wake)
+    assert (scheduler.stats.ticks, scheduler.stats.woken) == (3, 1)
+    assert scheduler.stats.mean_jitter == pytest.approx(0.005)
+
+
+def test_background_thread_follows_driver(fake_client, wait_until):
+    # The poller waits for the simulated time instead of advancing it, so only the driver moves the clock.
+    clock = SimulatedClock()
+    poller = RobotStatePoller(fake_client, rate_hz=10.0, clock=clock)
+    poller.start()
+    wait_until(lambda: poller.scheduler.next_deadline is not None)  # Scheduled from t = 0.
+    expected = 0.0
+    for polls in range(1, 11):
+        clock.advance(0.1)
+        expected += 0.1
+        wait_until(lambda: poller.num_polls == polls)
+    assert clock.now() == expected
+    poller.stop()
+    clock.advance(0.1)  # Release its last wait.
+    poller.join(5.0)
+
+    assert not poller.is_alive()
+    assert poller.num_polls == 11 and poller.num_failures == 0
+    assert poller.get().state.state == "locomotion"
+
+
+@pytest.mark.parametrize("tick_mode", [TICK_PERIODIC, TICK_HYBRID])
+def test_run_on_simulated_clock(fake_sdk, tick_mode):
+    clock = SimulatedClock()
+    postprocessor = ActionPostprocessor(init_channel=False, tick_mode=tick_mode, clock=clock)
+    ticks = []
+
+    def tick():
+        # Stands in for the velocity profile: record the tick, move, and receive an action every 5 ticks.
+        ticks.append(clock.now())
+        postprocessor.move(0.5, 0.0, 0.0)
+        if len(ticks) % 5 == 0:
+            postprocessor.action_callback((0.5, 0.0))
+        if len(ticks) == 100:
+            postprocessor.stop_event.set()
+
+    postprocessor.tick = tick
+    postprocessor.run()
+
+    if tick_mode == TICK_PERIODIC:
+        assert ticks == pytest.approx([CONTROL_PERIOD * (i + 1) for i in range(100)])
+        assert postprocessor.median_action_latency() == pytest.approx(CONTROL_PERIOD)
+    else:
+        # Each action starts a tick min_tick_interval after the one that sent it, then the period restarts from it.
+        assert postprocessor.scheduler.stats.woken == 19
+        assert postprocessor.median_action_latency() == pytest.approx(postprocessor.min_tick_interval)
+    assert postprocessor.scheduler.stats.overruns == 0
+    assert clock.now() == ticks[-1]
+
+
+def test_watchdog_runs_on_simulated_time(wait_until):
+    clock = SimulatedClock()
+    stalls = []
+    watchdog = HeartbeatWatchdog(lambda: stalls.append(clock.now()), timeout=0.5, clock=clock)
+    watchdog.start()
+    watchdog.beat()
+    clock.advance(0.49)
+    time.sleep(0.05)  # Real time passing must not matter.
+    assert not watchdog.stalled and not stalls
+
+    clock.advance(0.02)
+    wait_until(lambda: stalls)
+    assert watchdog.stalled and stalls == [pytest.approx(0.51)]
+
+    # The time to stop runs until the stop is acknowledged, not until on_stall returns.
+    clock.advance(0.03)
+    watchdog.stop_acknowledged()
+    watchdog.stop_acknowledged()
+    assert watchdog.stats.stalls == 1 and watchdog.stats.stops == 1
+    assert watchdog.stats.last_time_to_stop == pytest.approx(0.54)
+
+    watchdog.beat()
+    assert not watchdog.stalled
+    watchdog.stop()
+    watchdog.join(5.0)
+    assert not watchdog.is_alive()
+
+
+def test_stalled_actions_stop_the_robot(fake_sdk, wait_until):
+    clock = SimulatedClock()
+    postprocessor = ActionPostprocessor(init_channel=False, heartbeat_timeout=0.5, clock=clock)
+    ticks = []
+
+    def tick():
+        # Actions for the first 10 ticks (until t = 0.2), then none.
+        ticks.append(clock.now())
+        if len(ticks) <= 10:
+            postprocessor.action_callback((0.5, 0.0))
+        elif len(ticks) == 36:
+            # t = 0.72, the first tick past the stall at t = 0.7: wait for the watchdog and the acknowledged StopMove.
+            wait_until(lambda: postprocessor.watchdog.stats.stops == 1)
+            postprocessor.stop_event.set()
+
+    postprocessor.tick = tick
+    postprocessor.run()
+
+    assert ("StopMove", ()) in postprocessor.client.calls
+    stats = postprocessor.watchdog.stats
+    assert stats.stalls == 1
+    assert 0.5 <= stats.last_time_to_stop <= 0.52 + 1e-9
+
+
+def test_idle_stop_does_not_suppress_the_stall_stop(fake_sdk, wait_until):
+    clock = SimulatedClock()
+    postprocessor = ActionPostprocessor(init_channel=False, heartbeat_timeout=0.5, clock=clock)
+    ticks = []
+
+    def tick():
+        ticks.append(clock.now())
+        if len(ticks) <= 10:
+            postprocessor.action_callback((0.5, 0.0))
+        elif len(ticks) == 30:
+            # t = 0.6: the robot is idle and told to stay so, within the keepalive interval of the stall at t = 0.7.
+            postprocessor.commands.send(CHANNEL_VELOCITY, "StopMove")
+            wait_until(lambda: postprocessor.dispatcher.stats.completed == 1)
+        elif len(ticks) == 36:
+            wait_until(lambda: postprocessor.watchdog.stats.stops == 1)
+            postprocessor.stop_event.set()
+
+    postprocessor.tick = tick
+    postprocessor.run()
+
+    assert postprocessor.client.methods() == ["StopMove", "StopMove"]
+    assert postprocessor.watchdog.stats.stops == 1
+
+
+def test_no_move_between_stall_and_next_action(fake_sdk, wait_until):
+    clock = SimulatedClock()
+    postprocessor = ActionPostprocessor(init_channel=False, heartbeat_timeout=0.5, clock=clock)
+    stats = postprocessor.dispatcher.stats
+    ticks = []
+    before_resume = []
+
+    def tick():
+        # Moves on every tick, as the velocity profile does, while the actions stop after t = 0.2 and resume at 0.82.
+        ticks.append(clock.now())
+        if len(ticks) <= 10 or len(ticks) == 41:
+            postprocessor.action_callback((0.5, 0.0))
+        postprocessor.move(0.5, 0.0, 0.0)
+        if len(ticks) == 36:
+            wait_until(lambda: postprocessor.watchdog.stats.stops == 1)
+        elif len(ticks) in (40, 45):
+            wait_until(lambda: stats.completed + stats.superseded == stats.submitted)
+            if len(ticks) == 40:
+                before_resume.extend(postprocessor.client.methods())
+            else:
+                postprocessor.stop_event.set()
+
+    postprocessor.tick = tick
+    postprocessor.run()
+
+    assert before_resume[-1] == "StopMove" and before_resume.count("StopMove") == 1
+    assert postprocessor.client.methods() == before_resume + ["Move"]
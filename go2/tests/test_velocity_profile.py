@@ -0,0 +1,86 @@
+"""
+VelocityProfile.rollout must give exactly the same velocities as calling update() once per step.
+
+Usage:
+    python3 -m pytest tests/test_velocity_profile.py
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from example_send_action import SimulatedClock, VelocityProfile  # noqa: E402
+
+NUM_EPISODES = 20
+NUM_STEPS = 200
+
+
+def make_profile(clock, vx=0.0, vy=0.0, vyaw=0.0):
+    return VelocityProfile(
+        vx_decrease_rate_positive=0.8, vx_decrease_rate_negative=1.2, vy_decrease_rate=0.5, vyaw_decrease_rate=1.5,
+        vx=vx, vy=vy, vyaw=vyaw,
+        deadzone_vx=0.1, deadzone_vy=0.1, deadzone_vyaw=0.001,
+        vx_max=2.0, vx_min=-0.5, vy_max=5.0, vy_min=-2.5, vyaw_max=4.0, vyaw_min=-4.0,
+        clock=clock,
+    )
+
+
+def random_commands(rng, shape):
+    # Each step gets an acceleration, a target or nothing (NaN) on vx and vyaw, sometimes a vy target, rarely a stop.
+    kind = rng.integers(0, 3, size=(2,) + shape)
+    dvx = np.where(kind[0] == 0, rng.uniform(-3.0, 3.0, shape), np.nan)
+    vx = np.where(kind[0] == 1, rng.uniform(-1.0, 2.5, shape), np.nan)
+    dvyaw = np.where(kind[1] == 0, rng.uniform(-5.0, 5.0, shape), np.nan)
+    vyaw = np.where(kind[1] == 1, rng.uniform(-5.0, 5.0, shape), np.nan)
+    vy = np.where(rng.random(shape) < 0.2, rng.uniform(-3.0, 6.0, shape), np.nan)
+    stop = rng.random(shape) < 0.02
+    return dict(dvx=dvx, dvyaw=dvyaw, vx=vx, vy=vy, vyaw=vyaw, stop=stop)
+
+
+def random_times(rng, shape):
+    # Mostly 50 Hz, with occasional gaps above the 0.2 s limit of update().
+    dt = np.where(rng.random(shape) < 0.03, rng.uniform(0.2, 0.4, shape), rng.uniform(0.0, 0.05, shape))
+    return 100.0 + np.cumsum(dt, axis=-1)
+
+
+def step_by_step(profile, clock, times, commands):
+    # The per-step reference: one update() per timestamp, None wherever rollout() gets NaN.
+    out = np.empty((3,) + times.shape)
+    for t, now in enumerate(times):
+        clock.time = now
+        kwargs = {name: None if np.isnan(value[t]) else float(value[t])
+                  for name, value in commands.items() if name != "stop"}
+        vel = profile.update(stop=bool(commands["stop"][t]), **kwargs)
+        out[:, t] = vel.vx, vel.vy, vel.vyaw
+    return out
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rollout_matches_update(seed):
+    rng = np.random.default_rng(seed)
+    shape = (NUM_EPISODES, NUM_STEPS)
+    times = random_times(rng, shape)
+    commands = random_commands(rng, shape)
+    start = rng.uniform(-1.0, 2.0, size=3)
+    start_time = times[:, 0] - rng.uniform(0.0, 0.05, NUM_EPISODES)
+
+    clock = SimulatedClock()
+    trajectory = make_profile(clock, *start).rollout(times, start_time=start_time, **commands)
+
+    for episode in range(NUM_EPISODES):
+        clock.time = start_time[episode]
+        profile = make_profile(clock, *start)
+        expected = step_by_step(profile, clock, times[episode], {k: v[episode] for k, v in commands.items()})
+        np.testing.assert_array_equal(trajectory.vx[episode], expected[0])
+        np.testing.assert_array_equal(trajectory.vy[episode], expected[1])
+        np.testing.assert_array_equal(trajectory.vyaw[episode], expected[2])
+
+
+def test_rollout_does_not_modify_profile():
+    clock = SimulatedClock()
+    profile = make_profile(clock, vx=1.0, vyaw=0.5)
+    profile.rollout(np.arange(10) * 0.02, dvx=1.0)
+    assert (profile.vx, profile.vy, profile.vyaw) == (1.0, 0.0, 0.5)
@@ -1,13 +1,48 @@
 #!/usr/bin/env python3
+"""
+Minimal UDP probe.
+
+Modes:
+  probe  Send one datagram and print the reply (default).
+  bench  Send a stream of sequence-numbered, timestamped datagrams to an echo endpoint and report RTT percentiles,
+         jitter, loss and reordering, as a text histogram and optionally as JSON (--json).
+  serve  Echo every datagram back to its sender, optionally with injected delay, loss and reordering, so that bench
+         can be tried without the robot (e.g. on loopback).
+  scan   Send --message to every address of --targets (CIDR ranges) and every port of --ports, concurrently and
+         rate limited, and list the endpoints that reply.
+"""
 import argparse
+import asyncio
+import ipaddress
+import json
+import math
 import os
+import random
 import socket
+import struct
 import sys
 import time
+from typing import Dict, List, Optional
+
+# Benchmark datagram header: magic, sequence number, send time (time.monotonic_ns of the sender).
+BENCH_HEADER = struct.Struct("!4sIQ")
+BENCH_MAGIC = b"UPB1"
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+# Upper bounds of the RTT histogram buckets, in milliseconds.
+HISTOGRAM_BOUNDS_MS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0, math.inf)
+HISTOGRAM_WIDTH = 50
+
+SERVE_STATS_PERIOD = 5.0  # seconds
+
+MAX_SCAN_PROBES = 1 << 20
 
 
 def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(description="Minimal UDP send/receive probe.")
+    p.add_argument("--mode", choices=("probe", "bench", "serve", "scan"), default="probe",
+                   help="What to do (see module docstring)")
     p.add_argument("--robot-ip", default=os.environ.get("ROBOT_IP", ""), help="Robot IP address")
     p.add_argument(
         "--robot-port",
@@ -17,19 +52,76 @@ def parse_args() -> argparse.Namespace:
     )
     p.add_argument("--message", default="hello-from-laptop", help="Message to send as UTF-8")
     p.add_argument("--timeout", type=float, default=1.0, help="Seconds to wait for reply")
+
+    bench = p.add_argument_group("bench mode")
+    bench.add_argument("--rate", type=float, default=50.0, help="Datagrams per second")
+    bench.add_argument("--size", type=int, default=64, help=f"Datagram size in bytes (>= {BENCH_HEADER.size})")
+    bench.add_argument("--count", type=int, default=500, help="Number of datagrams to send")
+    bench.add_argument("--json", default=None, metavar="PATH", help="Also write the results as JSON ('-': stdout)")
+
+    serve = p.add_argument_group("serve mode")
+    serve.add_argument("--bind-ip", default="0.0.0.0", help="Address to listen on")
+    serve.add_argument("--bind-port", type=int, default=9000, help="UDP port to listen on")
+    serve.add_argument("--delay", type=float, default=0.0, help="Delay added to every echo, in ms")
+    serve.add_argument("--delay-jitter", type=float, default=0.0,
+                       help="Random extra delay, uniform in [0, DELAY_JITTER] ms")
+    serve.add_argument("--loss", type=float, default=0.0, help="Probability of dropping a datagram")
+    serve.add_argument("--reorder", type=float, default=0.0,
+                       help="Probability of holding a datagram back until after the next one")
+    serve.add_argument("--duration", type=float, default=0.0, help="Stop after this many seconds (0: run forever)")
+    serve.add_argument("--seed", type=int, default=None, help="Seed of the loss/reorder/jitter random generator")
+
+    scan = p.add_argument_group("scan mode")
+    scan.add_argument("--targets", default=None,
+                      help="Comma-separated IPv4 addresses or CIDR ranges, e.g. 192.168.1.0/24,10.21.31.103 "
+                           "(default: --robot-ip)")
+    scan.add_argument("--ports", default=None,
+                      help="Comma-separated ports or ranges, e.g. 8001,43893,9000-9010 (default: --robot-port)")
+    scan.add_argument("--scan-rate", type=float, default=1000.0, help="Maximum datagrams sent per second")
     return p.parse_args()
 
 
-def main() -> int:
-    args = parse_args()
+def percentile(sorted_values: List[float], q: float) -> float:
+    # Nearest-rank percentile of an already sorted list.
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(q / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def histogram(values_ms: List[float]) -> List[Dict]:
+    counts = [0] * len(HISTOGRAM_BOUNDS_MS)
+    for value in values_ms:
+        for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+            if value <= bound:
+                counts[i] += 1
+                break
+    return [{"le_ms": bound, "count": count} for bound, count in zip(HISTOGRAM_BOUNDS_MS, counts)]
 
-    if not args.robot_ip:
-        print("ERROR: --robot-ip (or ROBOT_IP env) is required", file=sys.stderr)
-        return 2
-    if args.robot_port <= 0 or args.robot_port > 65535:
-        print("ERROR: --robot-port (or ROBOT_UDP_PORT env) must be 1..65535", file=sys.stderr)
-        return 2
 
+def print_histogram(buckets: List[Dict]) -> None:
+    peak = max((b["count"] for b in buckets), default=0) or 1
+    lower = 0.0
+    for bucket in buckets:
+        upper = bucket["le_ms"]
+        label = f"> {lower:g} ms" if math.isinf(upper) else f"<= {upper:g} ms"
+        bar = "#" * math.ceil(bucket["count"] * HISTOGRAM_WIDTH / peak)
+        print(f"  {label:>12s} {bucket['count']:7d} {bar}")
+        lower = upper
+
+
+def json_safe(value):
+    # JSON has no NaN or Infinity: report them as null.
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {k: json_safe(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [json_safe(v) for v in value]
+    return value
+
+
+def run_probe(args: argparse.Namespace) -> int:
     payload = args.message.encode("utf-8", errors="replace")
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -62,6 +154,339 @@ def main() -> int:
     return 0
 
 
+class BenchReceiver:
+    """
+    Collects the echoed benchmark datagrams: RTT per sequence number, duplicates and reordering.
+    """
+
+    def __init__(self, count: int) -> None:
+        self.rtt_ns: List[Optional[int]] = [None] * count
+        self.arrival_rtts_ms: List[float] = []
+        self.duplicates = 0
+        self.reordered = 0
+        self.invalid = 0
+        self.highest_seq = -1
+
+    def on_datagram(self, data: bytes, now_ns: int) -> None:
+        if len(data) < BENCH_HEADER.size:
+            self.invalid += 1
+            return
+        magic, seq, sent_ns = BENCH_HEADER.unpack_from(data)
+        if magic != BENCH_MAGIC or seq >= len(self.rtt_ns):
+            self.invalid += 1
+            return
+        if self.rtt_ns[seq] is not None:
+            self.duplicates += 1
+            return
+        if seq < self.highest_seq:
+            self.reordered += 1
+        self.highest_seq = max(self.highest_seq, seq)
+        self.rtt_ns[seq] = now_ns - sent_ns
+        self.arrival_rtts_ms.append((now_ns - sent_ns) / 1e6)
+
+    def results(self, args: argparse.Namespace, elapsed: float, sent: int) -> Dict:
+        rtts = sorted(self.arrival_rtts_ms)
+        received = len(rtts)
+        # Jitter as the mean absolute RTT difference between consecutive replies (IPDV).
+        steps = [abs(b - a) for a, b in zip(self.arrival_rtts_ms, self.arrival_rtts_ms[1:])]
+        mean = sum(rtts) / received if received else math.nan
+        return {
+            "target": f"{args.robot_ip}:{args.robot_port}",
+            "rate_hz": args.rate,
+            "size": args.size,
+            "sent": sent,
+            "received": received,
+            "lost": sent - received,
+            "loss": (sent - received) / sent if sent else 0.0,
+            "reordered": self.reordered,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "elapsed_s": elapsed,
+            "rtt_ms": {
+                "min": rtts[0] if rtts else math.nan,
+                "mean": mean,
+                "max": rtts[-1] if rtts else math.nan,
+                "stdev": math.sqrt(sum((r - mean) ** 2 for r in rtts) / received) if received else math.nan,
+                **{f"p{q:g}": percentile(rtts, q) for q in PERCENTILES},
+            },
+            "jitter_ms": sum(steps) / len(steps) if steps else math.nan,
+            "histogram": histogram(rtts),
+        }
+
+
+def run_bench(args: argparse.Namespace) -> int:
+    if args.size < BENCH_HEADER.size or args.size > 65507:
+        print(f"ERROR: --size must be {BENCH_HEADER.size}..65507", file=sys.stderr)
+        return 2
+    if args.rate <= 0 or args.count <= 0:
+        print("ERROR: --rate and --count must be positive", file=sys.stderr)
+        return 2
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((args.robot_ip, args.robot_port))  # Only accept replies from the target.
+    payload = bytearray(args.size)
+    receiver = BenchReceiver(args.count)
+    period_ns = int(1e9 / args.rate)
+
+    print(f"Sending {args.count} x {args.size} bytes at {args.rate:g} Hz to {args.robot_ip}:{args.robot_port} ...")
+    start_ns = time.monotonic_ns()
+    sent = 0
+    deadline_ns = start_ns
+    try:
+        while True:
+            if sent < args.count:
+                deadline_ns = start_ns + sent * period_ns
+            else:
+                # Everything is sent, give the last replies --timeout to arrive.
+                deadline_ns = start_ns + (args.count - 1) * period_ns + int(args.timeout * 1e9)
+            now_ns = time.monotonic_ns()
+            if now_ns >= deadline_ns:
+                if sent >= args.count:
+                    break
+                BENCH_HEADER.pack_into(payload, 0, BENCH_MAGIC, sent, time.monotonic_ns())
+                try:
+                    sock.send(payload)
+                except ConnectionRefusedError:
+                    pass  # ICMP port unreachable from a previous datagram, the datagram counts as lost.
+                sent += 1
+                continue
+
+            sock.settimeout((deadline_ns - now_ns) / 1e9)
+            try:
+                data = sock.recv(65535)
+            except socket.timeout:
+                continue
+            except ConnectionRefusedError:
+                continue
+            receiver.on_datagram(data, time.monotonic_ns())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+    results = receiver.results(args, (time.monotonic_ns() - start_ns) / 1e9, sent)
+    rtt = results["rtt_ms"]
+    print(f"Sent {results['sent']}, received {results['received']}, lost {results['lost']} ({results['loss']:.2%}), "
+          f"reordered {results['reordered']}, duplicates {results['duplicates']}")
+    print(f"RTT ms: min {rtt['min']:.3f}  p50 {rtt['p50']:.3f}  p99 {rtt['p99']:.3f}  p99.9 {rtt['p99.9']:.3f}  "
+          f"max {rtt['max']:.3f}  jitter {results['jitter_ms']:.3f}")
+    print_histogram(results["histogram"])
+
+    if args.json == "-":
+        json.dump(json_safe(results), sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(json_safe(results), f, indent=2)
+        print(f"Results written to {args.json}")
+    return 0 if results["received"] else 1
+
+
+class Reflector(asyncio.DatagramProtocol):
+    """
+    Echoes datagrams back to their sender. Without injected delay, replies are sent straight from
+    datagram_received, so no task or timer is created per datagram.
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.delay = args.delay / 1e3
+        self.delay_jitter = args.delay_jitter / 1e3
+        self.loss = args.loss
+        self.reorder = args.reorder
+        self.random = random.Random(args.seed)
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.held = None  # (data, addr, timer) of the datagram held back for reordering
+        self.received = 0
+        self.echoed = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+
+    def send(self, data: bytes, addr) -> None:
+        self.transport.sendto(data, addr)
+        self.echoed += 1
+
+    def release_held(self) -> None:
+        if self.held is not None:
+            data, addr, timer = self.held
+            self.held = None
+            timer.cancel()
+            self.send(data, addr)
+
+    def echo(self, data: bytes, addr) -> None:
+        if self.reorder and self.held is None and self.random.random() < self.reorder:
+            # Sent after the next datagram, or on its own if none comes within a second.
+            timer = asyncio.get_running_loop().call_later(1.0, self.release_held)
+            self.held = (data, addr, timer)
+            self.reordered += 1
+            return
+        self.send(data, addr)
+        self.release_held()
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.received += 1
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.delay
+        if self.delay_jitter:
+            delay += self.random.uniform(0.0, self.delay_jitter)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.echo, data, addr)
+        else:
+            self.echo(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        # E.g. ICMP port unreachable after a client went away.
+        pass
+
+    def stats(self) -> str:
+        return (f"received {self.received}, echoed {self.echoed}, dropped {self.dropped}, "
+                f"reordered {self.reordered}")
+
+
+async def serve(args: argparse.Namespace) -> None:
+    loop = asyncio.get_running_loop()
+    transport, reflector = await loop.create_datagram_endpoint(
+        lambda: Reflector(args), local_addr=(args.bind_ip, args.bind_port)
+    )
+    print(f"Echoing UDP on {args.bind_ip}:{args.bind_port} (delay {args.delay:g}+{args.delay_jitter:g} ms, "
+          f"loss {args.loss:g}, reorder {args.reorder:g})")
+    stop_at = loop.time() + args.duration if args.duration > 0 else math.inf
+    try:
+        while loop.time() < stop_at:
+            await asyncio.sleep(min(SERVE_STATS_PERIOD, stop_at - loop.time()))
+            print(reflector.stats())
+    finally:
+        transport.close()
+
+
+def run_serve(args: argparse.Namespace) -> int:
+    if args.bind_port <= 0 or args.bind_port > 65535:
+        print("ERROR: --bind-port must be 1..65535", file=sys.stderr)
+        return 2
+    if not (0.0 <= args.loss <= 1.0 and 0.0 <= args.reorder <= 1.0):
+        print("ERROR: --loss and --reorder are probabilities, 0..1", file=sys.stderr)
+        return 2
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def parse_targets(spec: str) -> List[str]:
+    addresses: List[str] = []
+    for item in spec.split(","):
+        network = ipaddress.ip_network(item.strip(), strict=False)
+        if network.version != 4:
+            # The probes are sent from an IPv4 socket, like every other mode of this tool.
+            raise ValueError(f"{item.strip()}: only IPv4 targets are supported")
+        # hosts() leaves out the network and broadcast addresses, but is empty for /32.
+        hosts = list(network.hosts()) if network.num_addresses > 2 else list(network)
+        addresses.extend(str(host) for host in hosts)
+    return list(dict.fromkeys(addresses))
+
+
+def parse_ports(spec: str) -> List[int]:
+    ports: List[int] = []
+    for item in spec.split(","):
+        first, _, last = item.strip().partition("-")
+        ports.extend(range(int(first), int(last or first) + 1))
+    if not all(0 < port <= 65535 for port in ports):
+        raise ValueError("ports must be 1..65535")
+    return list(dict.fromkeys(ports))
+
+
+class ScanProtocol(asyncio.DatagramProtocol):
+    """
+    Records the first reply of every endpoint, with the time since the probe to that endpoint was sent.
+    """
+
+    def __init__(self) -> None:
+        self.sent_at: Dict = {}
+        self.replies: Dict = {}
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        endpoint = addr[:2]
+        if endpoint not in self.replies:
+            sent = self.sent_at.get(endpoint)
+            rtt = time.monotonic() - sent if sent is not None else math.nan
+            self.replies[endpoint] = (rtt, data)
+
+    def error_received(self, exc: Exception) -> None:
+        pass
+
+
+async def scan(args: argparse.Namespace, endpoints: List) -> Dict:
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(ScanProtocol, family=socket.AF_INET)
+    payload = args.message.encode("utf-8", errors="replace")
+    start = loop.time()
+    try:
+        for i, endpoint in enumerate(endpoints):
+            # Pace to --scan-rate: sleep only when ahead of schedule, then send everything that is due.
+            ahead = start + i / args.scan_rate - loop.time()
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+            protocol.sent_at[endpoint] = time.monotonic()
+            transport.sendto(payload, endpoint)
+        await asyncio.sleep(args.timeout)
+    finally:
+        transport.close()
+    return protocol.replies
+
+
+def run_scan(args: argparse.Namespace) -> int:
+    try:
+        addresses = parse_targets(args.targets or args.robot_ip)
+        ports = parse_ports(args.ports or str(args.robot_port))
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 2
+    if args.scan_rate <= 0:
+        print("ERROR: --scan-rate must be positive", file=sys.stderr)
+        return 2
+    endpoints = [(address, port) for address in addresses for port in ports]
+    if not endpoints or len(endpoints) > MAX_SCAN_PROBES:
+        print(f"ERROR: {len(endpoints)} endpoints to scan, expected 1..{MAX_SCAN_PROBES}", file=sys.stderr)
+        return 2
+
+    print(f"Probing {len(addresses)} addresses x {len(ports)} ports at up to {args.scan_rate:g} datagrams/s ...")
+    t0 = time.monotonic()
+    try:
+        replies = asyncio.run(scan(args, endpoints))
+    except KeyboardInterrupt:
+        return 1
+    dt = time.monotonic() - t0
+
+    for (address, port), (rtt, data) in sorted(replies.items(), key=lambda r: (ipaddress.ip_address(r[0][0]), r[0][1])):
+        print(f"  {address}:{port}  {len(data)} bytes in {rtt * 1e3:.1f} ms  {data[:32].hex()}")
+    print(f"{len(replies)} of {len(endpoints)} endpoints replied in {dt:.1f}s")
+    return 0 if replies else 1
+
+
+def main() -> int:
+    args = parse_args()
+
+    if args.mode == "serve":
+        return run_serve(args)
+    if args.mode == "scan":
+        return run_scan(args)
+
+    if not args.robot_ip:
+        print("ERROR: --robot-ip (or ROBOT_IP env) is required", file=sys.stderr)
+        return 2
+    if args.robot_port <= 0 or args.robot_port > 65535:
+        print("ERROR: --robot-port (or ROBOT_UDP_PORT env) must be 1..65535", file=sys.stderr)
+        return 2
+
+    if args.mode == "bench":
+        return run_bench(args)
+    return run_probe(args)
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
-
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Fixed-rate UDP transport for velocity commands and telemetry, meant as the network side of the planned /cmd_vel
+bridge (see README). Grown from udp_probe.py.
+
+Frames have a fixed, struct-packed layout (COMMAND_FRAME, TELEMETRY_FRAME): a magic, the sender's session, a sequence
+number and the sender's monotonic clock, followed by the payload. The session is the wall-clock time at which the
+sender started, so a restarted peer (whose sequence numbers start over) is followed right away instead of having its
+frames dropped as older than those of its previous run. These layouts are ours, not DeepRobotics', so both ends must run
+this module (e.g. the bridge on the laptop and a relay next to sdk_deploy on the robot).
+
+The hot path does not allocate buffers: every frame is packed into a preallocated bytearray with pack_into, sent on a
+connected socket (no address tuple per send) and received with recv_into into another preallocated bytearray.
+Sockets are nonblocking and served by one selectors loop that also keeps the send schedule, so command and telemetry
+traffic run at 500 Hz from a single thread.
+
+Usage (loopback test):
+    python3 udp_transport.py --role robot --bind-port 9100 --robot-ip 127.0.0.1 --robot-port 9101 &
+    python3 udp_transport.py --role bridge --bind-port 9101 --robot-ip 127.0.0.1 --robot-port 9100 --rate 500
+"""
+import argparse
+import os
+import selectors
+import socket
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Optional, Tuple
+
+# magic, flags, session, sequence number, sender time (time.monotonic_ns), vx, vy, vyaw
+COMMAND_FRAME = struct.Struct("<2sHqIqfff")
+COMMAND_MAGIC = b"MC"
+# magic, flags, session, sequence number, sender time, last command sequence number received, vx, vy, vyaw, state
+TELEMETRY_FRAME = struct.Struct("<2sHqIqIfffI")
+TELEMETRY_MAGIC = b"MT"
+
+FLAG_STOP = 0x1  # Command: stop / damp, Telemetry: the robot is stopped.
+
+DEFAULT_RATE_HZ = 500.0
+RECV_BUFFER_SIZE = 2048  # bytes, larger than any frame so an oversized datagram is detected instead of truncated
+STATS_PERIOD = 5.0  # seconds
+# Consecutive frames that look stale after which the peer is followed anyway, e.g. when it restarted with a wall clock
+# set back (an older session).
+RESYNC_STALE_FRAMES = 8
+
+
+class Frame:
+    """
+    Mutable decoded view of the last frame of one type. Updated in place, so receiving allocates no frame objects.
+    """
+    __slots__ = ("flags", "session", "seq", "stamp_ns", "ack_seq", "vx", "vy", "vyaw", "state", "received_ns")
+
+    def __init__(self) -> None:
+        self.flags = 0
+        self.session = 0
+        self.seq = -1
+        self.stamp_ns = 0
+        self.ack_seq = 0
+        self.vx = self.vy = self.vyaw = 0.0
+        self.state = 0
+        self.received_ns = 0
+
+
+class TransportStats:
+    def __init__(self) -> None:
+        self.sent = 0
+        self.received = 0
+        self.invalid = 0
+        self.out_of_order = 0
+        self.resyncs = 0  # Peer restarts (session changes) followed
+        self.send_errors = 0
+        self.late_sends = 0  # Send deadlines missed by more than a period
+        self.max_lag_ns = 0  # Largest delay of a send after its deadline
+
+    def __repr__(self) -> str:
+        return ("sent: {}, received: {}, invalid: {}, out of order: {}, resyncs: {}, send errors: {}, late sends: {}, "
+                "max lag: {:.3f} ms").format(self.sent, self.received, self.invalid, self.out_of_order, self.resyncs,
+                                             self.send_errors, self.late_sends, self.max_lag_ns / 1e6)
+
+
+class UdpEndpoint(ABC):
+    """
+    One nonblocking UDP socket bound to local and connected to peer, sending one outgoing frame type at a fixed rate
+    and decoding one incoming frame type.
+
+    Subclasses define the frame formats with pack_outgoing() and decode_incoming(). run() serves both directions
+    until stop() or the duration elapses.
+    """
+    OUTGOING = COMMAND_FRAME
+    INCOMING = TELEMETRY_FRAME
+    INCOMING_MAGIC = TELEMETRY_MAGIC
+
+    def __init__(self, local: Tuple[str, int], peer: Tuple[str, int], rate_hz: float = DEFAULT_RATE_HZ,
+                 on_receive: Optional[Callable[[Frame], None]] = None) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(local)
+        self.sock.connect(peer)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        self.period_ns = int(1e9 / rate_hz)
+        self.on_receive = on_receive
+        self.send_buffer = bytearray(self.OUTGOING.size)
+        self.recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self.incoming = Frame()
+        self.session = time.time_ns()
+        self.seq = 0
+        self.stale_frames = 0  # Consecutive incoming frames dropped as stale
+        self.stats = TransportStats()
+        self.running = False
+
+    @abstractmethod
+    def pack_outgoing(self, stamp_ns: int) -> None:
+        pass
+
+    @abstractmethod
+    def decode_incoming(self, fields: tuple) -> None:
+        pass
+
+    def send(self) -> None:
+        self.pack_outgoing(time.monotonic_ns())
+        try:
+            self.sock.send(self.send_buffer)
+            self.stats.sent += 1
+        except (BlockingIOError, ConnectionRefusedError):
+            # Full socket buffer, or ICMP port unreachable from the peer not listening (yet): drop this frame.
+            self.stats.send_errors += 1
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+
+    def receive(self) -> None:
+        # Drain everything that is queued, the selector only says there is at least one datagram.
+        while True:
+            try:
+                nbytes = self.sock.recv_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+            now_ns = time.monotonic_ns()
+            if nbytes != self.INCOMING.size or not self.recv_buffer.startswith(self.INCOMING_MAGIC):
+                self.stats.invalid += 1
+                continue
+            fields = self.INCOMING.unpack_from(self.recv_buffer)
+            if self.is_stale(fields[2], fields[3]):
+                self.stale_frames += 1
+                if self.stale_frames < RESYNC_STALE_FRAMES:
+                    self.stats.out_of_order += 1
+                    continue
+            if self.incoming.seq >= 0 and fields[2] != self.incoming.session:
+                self.stats.resyncs += 1
+            self.stale_frames = 0
+            self.decode_incoming(fields)
+            self.incoming.received_ns = now_ns
+            self.stats.received += 1
+            if self.on_receive is not None:
+                self.on_receive(self.incoming)
+
+    def is_stale(self, session: int, seq: int) -> bool:
+        # Older than the frame already received: from an earlier session, or earlier in the same session (modulo
+        # sequence number wrap-around).
+        frame = self.incoming
+        if frame.seq < 0 or session > frame.session:
+            return False
+        return session < frame.session or (seq - frame.seq) & 0xFFFFFFFF > 0x7FFFFFFF
+
+    def run(self, duration: float = 0.0, on_stats: Optional[Callable[[TransportStats], None]] = None) -> None:
+        """
+        Send at the fixed rate and receive in between until stop() is called or duration (seconds, 0: forever)
+        elapses. Missed send deadlines are skipped rather than bursted.
+        """
+        self.running = True
+        start_ns = time.monotonic_ns()
+        end_ns = start_ns + int(duration * 1e9) if duration > 0 else None
+        next_send_ns = start_ns
+        next_stats_ns = start_ns + int(STATS_PERIOD * 1e9)
+        while self.running:
+            now_ns = time.monotonic_ns()
+            if end_ns is not None and now_ns >= end_ns:
+                break
+            if now_ns >= next_send_ns:
+                lag_ns = now_ns - next_send_ns
+                self.stats.max_lag_ns = max(self.stats.max_lag_ns, lag_ns)
+                if lag_ns > self.period_ns:
+                    self.stats.late_sends += 1
+                    next_send_ns = now_ns  # Skip the missed deadlines.
+                self.send()
+                next_send_ns += self.period_ns
+            if on_stats is not None and now_ns >= next_stats_ns:
+                on_stats(self.stats)
+                next_stats_ns += int(STATS_PERIOD * 1e9)
+
+            timeout = max(0.0, (next_send_ns - time.monotonic_ns()) / 1e9)
+            if self.selector.select(timeout):
+                self.receive()
+
+    def stop(self) -> None:
+        self.running = False
+
+    def close(self) -> None:
+        self.selector.close()
+        self.sock.close()
+
+
+class CommandEndpoint(UdpEndpoint):
+    """
+    Bridge side: sends the current velocity command at the fixed rate, receives telemetry.
+    """
+    OUTGOING = COMMAND_FRAME
+    INCOMING = TELEMETRY_FRAME
+    INCOMING_MAGIC = TELEMETRY_MAGIC
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.vx = self.vy = self.vyaw = 0.0
+        self.flags = FLAG_STOP
+
+    def set_command(self, vx: float, vy: float, vyaw: float, stop: bool = False) -> None:
+        # Sent with the next scheduled frame, so updating faster than the rate costs nothing on the wire.
+        self.vx, self.vy, self.vyaw = vx, vy, vyaw
+        self.flags = FLAG_STOP if stop else 0
+
+    def pack_outgoing(self, stamp_ns: int) -> None:
+        COMMAND_FRAME.pack_into(self.send_buffer, 0, COMMAND_MAGIC, self.flags, self.session, self.seq, stamp_ns,
+                                self.vx, self.vy, self.vyaw)
+
+    def decode_incoming(self, fields: tuple) -> None:
+        frame = self.incoming
+        (_, frame.flags, frame.session, frame.seq, frame.stamp_ns, frame.ack_seq, frame.vx, frame.vy, frame.vyaw,
+         frame.state) = fields
+
+
+class TelemetryEndpoint(UdpEndpoint):
+    """
+    Robot side: receives velocity commands, sends telemetry at the fixed rate. The telemetry echoes the sequence
+    number of the last command received, so the bridge can measure command round trips.
+    """
+    OUTGOING = TELEMETRY_FRAME
+    INCOMING = COMMAND_FRAME
+    INCOMING_MAGIC = COMMAND_MAGIC
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.vx = self.vy = self.vyaw = 0.0
+        self.flags = FLAG_STOP
+        self.state = 0
+
+    def set_telemetry(self, vx: float, vy: float, vyaw: float, state: int = 0, stopped: bool = False) -> None:
+        self.vx, self.vy, self.vyaw, self.state = vx, vy, vyaw, state
+        self.flags = FLAG_STOP if stopped else 0
+
+    def pack_outgoing(self, stamp_ns: int) -> None:
+        TELEMETRY_FRAME.pack_into(self.send_buffer, 0, TELEMETRY_MAGIC, self.flags, self.session, self.seq, stamp_ns,
+                                  max(self.incoming.seq, 0), self.vx, self.vy, self.vyaw, self.state)
+
+    def decode_incoming(self, fields: tuple) -> None:
+        frame = self.incoming
+        _, frame.flags, frame.session, frame.seq, frame.stamp_ns, frame.vx, frame.vy, frame.vyaw = fields
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Fixed-rate UDP command/telemetry transport (loopback test).")
+    p.add_argument("--role", choices=("bridge", "robot"), required=True,
+                   help="bridge: send commands, receive telemetry. robot: the other way around")
+    p.add_argument("--robot-ip", default=os.environ.get("ROBOT_IP", ""), help="Peer IP address")
+    p.add_argument(
+        "--robot-port",
+        type=int,
+        default=int(os.environ.get("ROBOT_UDP_PORT", "0") or "0"),
+        help="Peer UDP port",
+    )
+    p.add_argument("--bind-ip", default="0.0.0.0", help="Local address")
+    p.add_argument("--bind-port", type=int, default=0, help="Local UDP port (0: any)")
+    p.add_argument("--rate", type=float, default=DEFAULT_RATE_HZ, help="Frames sent per second")
+    p.add_argument("--duration", type=float, default=0.0, help="Stop after this many seconds (0: run until Ctrl-C)")
+    return p.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+
+    if not args.robot_ip:
+        print("ERROR: --robot-ip (or ROBOT_IP env) is required", file=sys.stderr)
+        return 2
+    if args.robot_port <= 0 or args.robot_port > 65535:
+        print("ERROR: --robot-port (or ROBOT_UDP_PORT env) must be 1..65535", file=sys.stderr)
+        return 2
+
+    endpoint_type = CommandEndpoint if args.role == "bridge" else TelemetryEndpoint
+    endpoint = endpoint_type((args.bind_ip, args.bind_port), (args.robot_ip, args.robot_port), rate_hz=args.rate)
+    if args.role == "robot":
+        # Report the commanded velocity back, as a stand-in for measured state.
+        def on_command(frame: Frame) -> None:
+            endpoint.set_telemetry(frame.vx, frame.vy, frame.vyaw, stopped=bool(frame.flags & FLAG_STOP))
+        endpoint.on_receive = on_command
+    else:
+        endpoint.set_command(0.0, 0.0, 0.0)
+
+    print(f"{args.role}: {args.bind_ip}:{args.bind_port} <-> {args.robot_ip}:{args.robot_port} at {args.rate:g} Hz")
+    try:
+        endpoint.run(duration=args.duration, on_stats=print)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        endpoint.close()
+    print(endpoint.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
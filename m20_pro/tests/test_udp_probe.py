@@ -0,0 +1,130 @@
+"""
+Tests of udp_probe: scan target parsing, and bench mode over loopback against a serve-mode Reflector with seeded loss
+and reordering.
+
+Usage:
+    python3 -m pytest tests/test_udp_probe.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from udp_probe import (  # noqa: E402
+    BENCH_HEADER, BENCH_MAGIC, BenchReceiver, Reflector, parse_ports, parse_targets, percentile, run_bench
+)
+
+
+class LoopbackReflector:
+    """
+    Runs a Reflector on an ephemeral 127.0.0.1 port, on an event loop in a background thread.
+    """
+
+    def __init__(self, loss=0.0, reorder=0.0, seed=0):
+        self.args = argparse.Namespace(delay=0.0, delay_jitter=0.0, loss=loss, reorder=reorder, seed=seed)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        self.transport, self.reflector = asyncio.run_coroutine_threadsafe(self.loop.create_datagram_endpoint(
+            lambda: Reflector(self.args), local_addr=("127.0.0.1", 0)), self.loop).result()
+        self.port = self.transport.get_extra_info("sockname")[1]
+        return self
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def bench_args(port, json_path, count=400):
+    # A held datagram is released by the next one, or after 1 s by the reflector: wait longer than that.
+    return argparse.Namespace(robot_ip="127.0.0.1", robot_port=port, rate=2000.0, size=64, count=count,
+                              timeout=1.5, json=str(json_path))
+
+
+def test_parse_targets():
+    assert parse_targets("10.21.31.103") == ["10.21.31.103"]
+    assert parse_targets("192.168.1.0/30") == ["192.168.1.1", "192.168.1.2"]
+    assert parse_targets("10.0.0.8/31") == ["10.0.0.8", "10.0.0.9"]
+    # Host bits of a range are ignored, and duplicates are dropped in order.
+    assert parse_targets(" 192.168.1.2/30, 10.0.0.1,192.168.1.1") == ["192.168.1.1", "192.168.1.2", "10.0.0.1"]
+    assert len(parse_targets("192.168.0.0/24")) == 254
+
+
+@pytest.mark.parametrize("spec", ["fe80::1", "10.0.0.1,2001:db8::/126", "10.0.0.256", "robot", ""])
+def test_parse_targets_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_targets(spec)
+
+
+def test_parse_ports():
+    assert parse_ports("8001") == [8001]
+    assert parse_ports("8001, 43893,9000-9003") == [8001, 43893, 9000, 9001, 9002, 9003]
+    assert parse_ports("9001,9000-9002") == [9001, 9000, 9002]
+
+
+@pytest.mark.parametrize("spec", ["0", "65536", "65530-65536", "http", ""])
+def test_parse_ports_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_ports(spec)
+
+
+def test_percentile_is_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50.0) == 50.0
+    assert percentile(values, 99.0) == 99.0
+    assert percentile(values, 99.9) == 100.0
+    assert percentile(values, 0.0) == 1.0
+    assert math.isnan(percentile([], 50.0))
+
+
+def test_receiver_results():
+    receiver = BenchReceiver(count=5)
+    sent_ns = [0, 1_000_000, 2_000_000, 3_000_000, 4_000_000]
+    # seq 2 is lost, 1 arrives after 3, and 0 is duplicated. RTTs: 1, 4, 2, 1 ms in arrival order.
+    for seq, now_ns in [(0, 1_000_000), (3, 7_000_000), (1, 3_000_000), (0, 8_000_000), (4, 5_000_000)]:
+        receiver.on_datagram(BENCH_HEADER.pack(BENCH_MAGIC, seq, sent_ns[seq]), now_ns)
+    receiver.on_datagram(b"junk", 0)
+
+    results = receiver.results(argparse.Namespace(robot_ip="127.0.0.1", robot_port=9000, rate=50.0, size=64),
+                               elapsed=1.0, sent=5)
+    assert (results["received"], results["lost"], results["loss"]) == (4, 1, 0.2)
+    assert (results["reordered"], results["duplicates"], results["invalid"]) == (1, 1, 1)
+    rtt = results["rtt_ms"]
+    assert (rtt["min"], rtt["p50"], rtt["p99"], rtt["max"]) == (1.0, 1.0, 4.0, 4.0)
+    assert rtt["mean"] == pytest.approx(2.0)
+    assert results["jitter_ms"] == pytest.approx((3.0 + 2.0 + 1.0) / 3)
+    assert sum(bucket["count"] for bucket in results["histogram"]) == 4
+
+
+def test_bench_against_lossless_reflector(tmp_path):
+    with LoopbackReflector() as server:
+        assert run_bench(bench_args(server.port, tmp_path / "bench.json")) == 0
+    results = json.loads((tmp_path / "bench.json").read_text())
+    assert (results["sent"], results["received"], results["lost"]) == (400, 400, 0)
+    assert results["reordered"] == 0 and results["duplicates"] == 0
+    assert 0.0 <= results["rtt_ms"]["p50"] <= results["rtt_ms"]["p99"] <= results["rtt_ms"]["max"]
+
+
+def test_bench_reports_injected_loss_and_reordering(tmp_path):
+    with LoopbackReflector(loss=0.1, reorder=0.05, seed=1234) as server:
+        assert run_bench(bench_args(server.port, tmp_path / "bench.json")) == 0
+        reflector = server.reflector
+    results = json.loads((tmp_path / "bench.json").read_text())
+
+    assert reflector.received == 400
+    assert reflector.dropped > 0 and reflector.reordered > 0
+    # Every datagram dropped by the reflector is reported lost, and every held back one arrives out of order.
+    assert results["lost"] == reflector.dropped
+    assert results["reordered"] == reflector.reordered
+    assert results["loss"] == pytest.approx(reflector.dropped / 400)
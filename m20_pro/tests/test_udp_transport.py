@@ -0,0 +1,128 @@
+"""
+Loopback tests of udp_transport: sequence and session handling of incoming frames, including a restarted sender.
+
+Usage:
+    python3 -m pytest tests/test_udp_transport.py
+"""
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from udp_transport import (  # noqa: E402
+    COMMAND_FRAME, COMMAND_MAGIC, FLAG_STOP, RESYNC_STALE_FRAMES, CommandEndpoint, TelemetryEndpoint, UdpEndpoint
+)
+
+LOOPBACK = "127.0.0.1"
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((LOOPBACK, 0))
+        return sock.getsockname()[1]
+
+
+def deliver(endpoint, count=1):
+    # Wait for count datagrams to be queued on the endpoint, then receive them.
+    received = endpoint.stats.received + endpoint.stats.out_of_order + endpoint.stats.invalid
+    while endpoint.stats.received + endpoint.stats.out_of_order + endpoint.stats.invalid < received + count:
+        assert endpoint.selector.select(1.0), "Datagram lost on loopback"
+        endpoint.receive()
+
+
+@pytest.fixture
+def robot():
+    # The robot side, and the port its bridge must send from.
+    bridge_port = free_port()
+    robot = TelemetryEndpoint((LOOPBACK, 0), (LOOPBACK, bridge_port))
+    yield robot, bridge_port
+    robot.close()
+
+
+@pytest.fixture
+def raw_bridge(robot):
+    # A plain socket on the bridge port, to send hand-made command frames.
+    endpoint, bridge_port = robot
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((LOOPBACK, bridge_port))
+    sock.connect(endpoint.sock.getsockname())
+
+    def send(session, seq, vx, flags=0):
+        sock.send(COMMAND_FRAME.pack(COMMAND_MAGIC, flags, session, seq, 0, vx, 0.0, 0.0))
+        deliver(endpoint)
+
+    yield endpoint, send
+    sock.close()
+
+
+def test_endpoint_is_abstract():
+    class SendOnly(UdpEndpoint):
+        def pack_outgoing(self, stamp_ns):
+            pass
+
+    with pytest.raises(TypeError):
+        UdpEndpoint((LOOPBACK, 0), (LOOPBACK, free_port()))
+    with pytest.raises(TypeError):
+        SendOnly((LOOPBACK, 0), (LOOPBACK, free_port()))
+
+
+def test_restarted_bridge_is_followed(robot):
+    endpoint, bridge_port = robot
+    first = CommandEndpoint((LOOPBACK, bridge_port), endpoint.sock.getsockname())
+    first.set_command(0.5, 0.0, 0.0)
+    first.seq = 100000  # Long-running bridge
+    for _ in range(10):
+        first.send()
+    deliver(endpoint, 10)
+    first.close()
+    assert endpoint.incoming.vx == 0.5 and not endpoint.incoming.flags & FLAG_STOP
+
+    # The restarted bridge starts over from sequence number 0: its first frame, a stop, must take effect.
+    second = CommandEndpoint((LOOPBACK, bridge_port), endpoint.sock.getsockname())
+    second.set_command(0.0, 0.0, 0.0, stop=True)
+    second.send()
+    deliver(endpoint)
+    second.close()
+
+    assert endpoint.incoming.flags & FLAG_STOP and endpoint.incoming.vx == 0.0
+    assert endpoint.incoming.seq == 0
+    assert endpoint.stats.received == 11 and endpoint.stats.out_of_order == 0 and endpoint.stats.resyncs == 1
+
+
+def test_stale_frames_are_dropped(raw_bridge):
+    endpoint, send = raw_bridge
+    send(session=2, seq=10, vx=0.5)
+    send(session=2, seq=9, vx=0.1)  # Reordered within the session
+    send(session=1, seq=50, vx=0.2)  # Late frame of a previous run
+    assert endpoint.incoming.vx == 0.5
+    assert endpoint.stats.out_of_order == 2
+
+    send(session=2, seq=11, vx=0.6)
+    assert endpoint.incoming.vx == pytest.approx(0.6)
+    assert endpoint.stats.resyncs == 0
+
+
+def test_sequence_wraps_around(raw_bridge):
+    endpoint, send = raw_bridge
+    send(session=1, seq=0xFFFFFFFF, vx=0.5)
+    send(session=1, seq=0, vx=0.25)
+    assert endpoint.incoming.vx == 0.25 and endpoint.stats.out_of_order == 0
+
+
+def test_older_session_is_followed_after_consecutive_stale_frames(raw_bridge):
+    # E.g. the bridge restarted after its wall clock was set back.
+    endpoint, send = raw_bridge
+    send(session=2000, seq=10, vx=0.5)
+    for seq in range(RESYNC_STALE_FRAMES - 1):
+        send(session=1000, seq=seq, vx=0.0, flags=FLAG_STOP)
+    assert endpoint.incoming.vx == 0.5 and endpoint.stats.out_of_order == RESYNC_STALE_FRAMES - 1
+
+    send(session=1000, seq=RESYNC_STALE_FRAMES - 1, vx=0.0, flags=FLAG_STOP)
+    assert endpoint.incoming.session == 1000 and endpoint.incoming.flags & FLAG_STOP
+    assert endpoint.stats.resyncs == 1
+
+    send(session=1000, seq=RESYNC_STALE_FRAMES, vx=0.25)
+    assert endpoint.incoming.vx == 0.25